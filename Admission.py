@@ -0,0 +1,206 @@
+from collections import OrderedDict
+import threading
+import time
+
+'''
+Purpose: Report that a SmartHomeHub didn't accept a command
+'''
+
+
+class AdmissionError(RuntimeError):
+    pass
+
+
+'''
+Purpose: Report that a command was rejected because the hub already has max_in_flight commands
+'''
+
+
+class HubOverloadedError(AdmissionError):
+    pass
+
+
+'''
+Purpose: Report that a command was rejected because its device ran out of rate limit tokens
+'''
+
+
+class RateLimitedError(AdmissionError):
+    pass
+
+
+'''
+Purpose: Report that a queued command was dropped to make room for a newer one
+'''
+
+
+class CommandDroppedError(AdmissionError):
+    pass
+
+
+'''
+Purpose: Limit the rate of commands to one device with a token bucket
+Contract:
+    - the bucket holds up to burst tokens and refills at rate tokens per second
+    - take() spends one token and returns 0, or returns the seconds until a token is available without spending any
+    - the caller serializes calls to take()
+'''
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    # Initializes an instance of TokenBucket, full at time now
+    def __init__(self, rate, burst, now):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = rate  # Tokens added per second
+        self.burst = burst  # Maximum number of tokens
+        self.tokens = float(burst)  # Tokens available
+        self.updated = now  # Time the tokens were last refilled
+
+    # Spends a token if there is one, otherwise returns the wait in seconds for the next token
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0.0
+        self.tokens = tokens
+        return (1 - tokens) / self.rate
+
+
+'''
+Purpose: Decide which commands a SmartHomeHub accepts, so a flood of commands can't take down the hub
+Contract:
+    - max_in_flight limits the commands admitted and not yet finished across the hub, None for no limit
+    - rate and burst give every device a token bucket, limit() sets them for one device, None for no limit
+    - policy decides what happens to a command that doesn't fit:
+        "block" waits for room or a token, up to timeout seconds (None waits forever), then rejects the command
+        "reject" rejects the command straight away
+        "drop_oldest" drops the oldest admitted command that hasn't started to make room, the dropped command's
+        Future fails with CommandDroppedError, commands over their device's rate limit are rejected
+    - admit() returns once a command is admitted and raises HubOverloadedError or RateLimitedError if it isn't,
+      started() is called when an admitted command starts and returns False if it was dropped,
+      release() is called when a started command finishes, discard() when an admitted command is cancelled or
+      replaced before it started, discard() returns False if the command was dropped meanwhile
+    - admit(wait=False) rejects instead of waiting under the "block" policy, for callers that hold an admitted
+      slot themselves, like a command sending another command, which could otherwise wait on its own slot
+    - rejected and dropped count the commands turned away
+    - clock returns the current time in seconds, so tests can control time
+'''
+
+
+class AdmissionController:
+    POLICIES = ("block", "reject", "drop_oldest")
+
+    # Initializes an instance of AdmissionController
+    def __init__(self, max_in_flight=None, rate=None, burst=None, policy="block", timeout=None, clock=time.monotonic):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy '{policy}'")  # Message if the policy isn't supported
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight  # Limit of commands admitted and not finished, None for no limit
+        self.rate = rate  # Default commands per second for each device, None for no limit
+        self.burst = burst  # Default bucket size, None uses max(1, rate)
+        self.policy = policy  # What to do with a command that doesn't fit
+        self.timeout = timeout  # Seconds the "block" policy waits before rejecting
+        self.clock = clock  # Returns the current time
+        self.limits = {}  # Dictionary with device_id as key and its (rate, burst) as value, overriding the defaults
+        self.buckets = {}  # Dictionary with device_id as key and its TokenBucket (None for no limit) as value
+        self.in_flight = 0  # Commands admitted and not finished
+        # Admitted commands that haven't started, oldest first, only kept for the "drop_oldest" policy
+        self.queued = OrderedDict()
+        self.rejected = 0  # Commands rejected by admit()
+        self.dropped = 0  # Admitted commands dropped by the "drop_oldest" policy
+        self.lock = threading.Lock()  # Lock to keep the counters and buckets consistent
+        self.room = threading.Condition(self.lock)  # Signals blocked admit() calls that a command finished
+
+    # Sets the rate limit of one device, rate None removes its limit
+    def limit(self, device_id, rate, burst=None):
+        with self.lock:
+            self.limits[device_id] = (rate, burst)
+            self.buckets.pop(device_id, None)  # The bucket is rebuilt with the new limit on the next command
+
+    # Admits task, a command for device_id, or raises the AdmissionError explaining why it wasn't admitted
+    def admit(self, device_id, task, wait=True):
+        deadline = None
+        victim = None  # Command dropped to make room, its Future fails once the lock is released
+        with self.lock:  # Lock before spending a token or a slot
+            while True:
+                delay = self._take_token(device_id)  # Seconds until the device has a token, 0 if it has one
+                if delay:
+                    error = RateLimitedError(f"Device {device_id} is over its rate limit")
+                elif self.max_in_flight is None or self.in_flight < self.max_in_flight:
+                    break
+                elif self.policy == "drop_oldest" and self.queued:
+                    _, victim = self.queued.popitem(last=False)
+                    self.in_flight -= 1  # The victim's slot goes to the new command
+                    self.dropped += 1
+                    break
+                else:
+                    self._refund(device_id)  # The command isn't admitted, so it doesn't spend its device's token
+                    error = HubOverloadedError(f"The hub already has {self.max_in_flight} commands in flight")
+                if self.policy != "block" or not wait:
+                    self.rejected += 1
+                    raise error
+                now = self.clock()
+                if deadline is None and self.timeout is not None:
+                    deadline = now + self.timeout
+                if deadline is not None and deadline <= now:
+                    self.rejected += 1
+                    raise error
+                # Waits for the next token, or for a command to finish, then tries again
+                if deadline is not None:
+                    delay = min(delay or deadline - now, deadline - now)
+                self.room.wait(delay or None)
+            if self.max_in_flight is not None:
+                self.in_flight += 1
+                if self.policy == "drop_oldest":
+                    self.queued[id(task)] = task
+        if victim is not None:
+            victim.drop(CommandDroppedError("Dropped to make room for a newer command"))
+
+    # Spends a token of the device's bucket, returns 0 or the seconds until a token is available
+    # The caller holds the lock
+    def _take_token(self, device_id):
+        bucket = self.buckets.get(device_id, False)
+        if bucket is False:
+            rate, burst = self.limits.get(device_id, (self.rate, self.burst))
+            bucket = None if rate is None else TokenBucket(rate, burst or max(1, rate), self.clock())
+            self.buckets[device_id] = bucket
+        if bucket is None:
+            return 0.0
+        return bucket.take(self.clock())
+
+    # Gives back the token spent by a command that wasn't admitted, the caller holds the lock
+    def _refund(self, device_id):
+        bucket = self.buckets.get(device_id)
+        if bucket is not None:
+            bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+
+    # Marks an admitted command as started, returns False if it was dropped and must not run
+    def started(self, task):
+        if self.policy != "drop_oldest" or self.max_in_flight is None:
+            return True  # Nothing is ever dropped, so there's no need for the lock
+        with self.lock:
+            return self.queued.pop(id(task), None) is not None
+
+    # Frees the slot of an admitted command that finished
+    def release(self, task):
+        if self.max_in_flight is None:
+            return
+        with self.lock:
+            self.in_flight -= 1
+            self.room.notify_all()  # Blocked admit() calls may wait for room or for a token
+
+    # Frees the slot of an admitted command that will never start, returns False if it was dropped already
+    def discard(self, task):
+        if self.max_in_flight is None:
+            return True
+        with self.lock:
+            if self.policy == "drop_oldest" and self.queued.pop(id(task), None) is None:
+                return False  # Dropped, admit() already gave its slot to a newer command
+            self.in_flight -= 1
+            self.room.notify_all()
+            return True
@@ -0,0 +1,128 @@
+from Devices import *
+from Commands import registry, DeviceNotFoundError, UnsupportedCommandError
+import asyncio
+import functools
+
+'''
+Purpose: Hold the queue of commands for a single device of the AsyncSmartHomeHub
+Contract:
+    - queue holds the (future, spec, args) commands for the device in submission order
+    - task is the task draining the queue, None while the queue is idle
+'''
+
+
+class _AsyncLane:
+    __slots__ = ("device", "queue", "task")
+
+    # Initializes an instance of _AsyncLane
+    def __init__(self, device, mailbox_size):
+        self.device = device  # Device that receives the commands of the lane
+        self.queue = asyncio.Queue(maxsize=mailbox_size)  # FIFO queue of commands for the device
+        self.task = None  # Task draining the queue, only started while there is work
+
+
+'''
+Purpose: Act as the central hub of the smart home for asyncio applications, without a thread per command
+Contract:
+    - add_device() adds a new device to the smart home system
+    - remove_device() removes a device from the smart home system, its queued commands still run
+    - get_device_status() returns the status of a given device
+    - send_command() queues a command for the given device and returns its result once it ran
+    - shutdown() waits for the queued commands, or cancels them if drain is False
+'''
+
+
+class AsyncSmartHomeHub:
+    # Initializes instance of AsyncSmartHomeHub
+    # mailbox_size bounds the commands queued per device (0 for unbounded), executor runs blocking handlers
+    def __init__(self, mailbox_size=0, executor=None, batch=64):
+        self.devices = {}  # Dictionary to store all the devices with device_id as a key and device as value
+        self.lanes = {}  # Dictionary of command lanes with device_id as key and lane as value
+        self.mailbox_size = mailbox_size  # Maximum number of queued commands per device
+        self.executor = executor  # Executor for blocking handlers, None uses the loop's default executor
+        self.batch = batch  # Number of commands a lane runs before yielding to the event loop
+
+    # Adds a new device to the smart home system
+    async def add_device(self, device):
+        # If the device doesn't exist in the system...
+        if device.device_id not in self.devices:
+            self.devices[device.device_id] = device  # Add it to the devices dictionary
+            self.lanes[device.device_id] = _AsyncLane(device, self.mailbox_size)  # Gives the device its own lane
+            print(f"Device {device.device_id} added.")  # Print updated status that device was added
+        else:
+            print(f"Device {device.device_id} already exists in the system.")  # Message if the device already exists
+
+    # Removes an existing device from the smart home system
+    async def remove_device(self, device_id):
+        # If the device is found in the devices dictionary...
+        if device_id in self.devices:
+            del self.devices[device_id]  # Remove that device from it
+            del self.lanes[device_id]  # Drops the lane, a running drain task still finishes the queued commands
+            print(f"Device {device_id} removed.")  # Prints updated status that device was removed
+        else:
+            print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
+
+    # Gets and returns the status of a given device
+    async def get_device_status(self, device_id):
+        device = self.devices.get(device_id)
+        # If the device is in the devices dictionary...
+        if device is not None:
+            return device.get_status()  # Returns the status of it
+        print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
+        return None  # Returns None since device doesn't exist
+
+    # Queues a command for the given device and returns the handler's result once it ran
+    # Commands for one device run in submission order, use asyncio.gather() to keep many in flight
+    async def send_command(self, device_id, command, *args):
+        lane = self.lanes.get(device_id)
+        if lane is None:
+            print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
+            raise DeviceNotFoundError(device_id)
+        spec = registry.resolve(type(lane.device), command)  # Resolves the handler before queueing
+        if spec is None:
+            print(f"Command '{command}' not supported for device {device_id}")
+            raise UnsupportedCommandError(command)
+        future = asyncio.get_running_loop().create_future()  # Resolved with the handler's result
+        await lane.queue.put((future, spec, args))  # Waits for room if the mailbox is bounded
+        # Starts draining the lane if it is idle
+        if lane.task is None:
+            lane.task = asyncio.create_task(self._drain(lane))
+        return await future
+
+    # Runs the queued commands of a lane until it is empty
+    async def _drain(self, lane):
+        loop = asyncio.get_running_loop()
+        ran = 0  # Commands run since the lane last yielded to the event loop
+        while not lane.queue.empty():
+            future, spec, args = lane.queue.get_nowait()  # Oldest command for the device
+            if future.cancelled():
+                continue  # The caller gave up on the command before it ran
+            try:
+                # Blocking handlers run on the executor, every other handler runs directly on the loop
+                if spec.blocking:
+                    result = await loop.run_in_executor(self.executor,
+                                                        functools.partial(spec.function, lane.device, *args))
+                else:
+                    result = spec.function(lane.device, *args)
+                    ran += 1
+                    if ran >= self.batch:
+                        ran = 0
+                        await asyncio.sleep(0)  # Lets other lanes and callers run
+            except Exception as error:
+                if not future.cancelled():
+                    future.set_exception(error)  # Hands the failure to the caller
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+        lane.task = None  # The lane is idle, the next send_command starts a new drain
+
+    # Waits for the queued commands to run, or cancels them when drain is False
+    async def shutdown(self, drain=True):
+        lanes = list(self.lanes.values())
+        if not drain:
+            for lane in lanes:
+                while not lane.queue.empty():
+                    lane.queue.get_nowait()[0].cancel()  # Cancels the commands that haven't run
+        tasks = [lane.task for lane in lanes if lane.task is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
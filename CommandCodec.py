@@ -0,0 +1,393 @@
+from Devices import *
+from Commands import registry
+import json
+import struct
+import threading
+
+'''
+Command encoding (little-endian):
+    a buffer is a sequence of records, each starting with a u8 kind
+    DEVICE      u32 device code, u16 length + UTF-8 device_id
+    OPCODE      u16 opcode, u16 length + UTF-8 command name
+    SHAPE       u8 shape, u8 argument count, one type tag byte per argument
+    COMMAND     u8 shape, u32 device code, u16 opcode, then the arguments as the shape's type tags say
+Type tags are struct format characters: "i" (int32), "q" (int64), "d" (float64) and "?" (bool) are fixed-width,
+"N" is None and takes no bytes, "s" (str) and "j" (anything else, as JSON) are a u32 length followed by UTF-8.
+NumPy scalars and arrays are written as the plain values they hold, other values JSON can't hold raise TypeError.
+DEVICE, OPCODE and SHAPE records define a code for the rest of the stream, an encoder writes each definition
+just before the first record that uses it, so a decoder needs nothing but the stream. A decoder always uses the
+latest definition of a code, so a stream may continue where another one left off. A COMMAND whose shape is
+only fixed-width types has a fixed size, and both ends pack or unpack it with a single precompiled Struct.
+'''
+
+KIND_DEVICE = 1
+KIND_OPCODE = 2
+KIND_SHAPE = 3
+KIND_COMMAND = 4
+_DEVICE = struct.Struct("<BIH")  # Kind, device code, device_id length
+_OPCODE = struct.Struct("<BHH")  # Kind, opcode, command name length
+_SHAPE = struct.Struct("<BBB")  # Kind, shape, argument count
+_HEADER = struct.Struct("<BBIH")  # Kind, shape, device code, opcode
+_LENGTH = struct.Struct("<I")  # Length of a "s" or "j" value
+_FIXED = frozenset("iqd?")  # Type tags of fixed-width values
+_TYPE_TAGS = {int: "i", float: "d", bool: "?", type(None): "N", str: "s"}  # Type tag by Python type, "j" otherwise
+_VARIABLE = (None, None)  # Shape entry that sends decode() to read()
+
+
+'''
+Purpose: Assign integer handles to device ids, so commands can name a device with a u32 instead of its id
+Contract:
+    - assign() returns the handle of a device id, giving it a new handle the first time
+    - handles aren't reused, a device that is removed and added again gets a new handle
+    - handle() and device_id() look a handle up in either direction without taking the lock
+'''
+
+
+class DeviceHandles:
+    # Initializes an instance of DeviceHandles
+    def __init__(self):
+        self.handles = {}  # Dictionary with device_id as key and its handle as value
+        self.device_ids = {}  # Dictionary with handle as key and its device_id as value
+        self.next_handle = 0
+        self.lock = threading.Lock()  # Lock so two devices never get the same handle
+
+    # Returns the handle of device_id, assigning one if it doesn't have one
+    def assign(self, device_id):
+        handle = self.handles.get(device_id)
+        if handle is None:
+            with self.lock:  # Lock before handing out a handle
+                handle = self.handles.get(device_id)
+                if handle is None:
+                    handle = self.next_handle
+                    self.next_handle += 1
+                    self.device_ids[handle] = device_id
+                    self.handles[device_id] = handle
+        return handle
+
+    # Forgets the handle of device_id
+    def release(self, device_id):
+        with self.lock:
+            handle = self.handles.pop(device_id, None)
+            if handle is not None:
+                del self.device_ids[handle]
+
+    # Returns the handle of device_id, or None if it has none
+    def handle(self, device_id):
+        return self.handles.get(device_id)
+
+    # Returns the device_id of handle, or None if no device has it
+    def device_id(self, handle):
+        return self.device_ids.get(handle)
+
+
+'''
+Purpose: Intern command names as u16 opcodes
+Contract:
+    - the table starts with the sorted command names every registered device class supports, so processes
+      running the same device classes give the built-in commands the same opcodes
+    - opcode() returns the opcode of a command name, interning names added by later plugin classes
+    - name() returns the command name of an opcode
+'''
+
+
+class OpcodeTable:
+    # Initializes an instance of OpcodeTable from the commands of every class registered with command_registry
+    def __init__(self, command_registry=registry):
+        names = set()
+        for cls in list(command_registry.commands):
+            names.update(command_registry.supported_commands(cls))
+        self.names = sorted(names)  # Command name of every opcode
+        self.opcodes = {name: opcode for opcode, name in enumerate(self.names)}  # Opcode of every command name
+        self.lock = threading.Lock()  # Lock so two names never get the same opcode
+
+    # Returns the opcode of a command name, interning it if it's new
+    def opcode(self, name):
+        opcode = self.opcodes.get(name)
+        if opcode is None:
+            with self.lock:  # Lock before interning the name
+                opcode = self.opcodes.get(name)
+                if opcode is None:
+                    if len(self.names) > 0xFFFF:
+                        raise ValueError("The opcode table is full")
+                    opcode = len(self.names)
+                    self.names.append(name)
+                    self.opcodes[name] = opcode
+        return opcode
+
+    # Returns the command name of opcode
+    def name(self, opcode):
+        return self.names[opcode]
+
+
+opcodes = OpcodeTable()  # Opcodes shared by every encoder, seeded from the device classes in Devices.py
+
+
+'''
+Purpose: Encode commands as COMMAND records, defining the devices, opcodes and shapes a stream uses on first use
+Contract:
+    - encode() returns the records of one command, preceded by the definitions it needs
+    - encode_many() encodes a batch of (device_id, command, args) commands into one bytes object
+    - device codes are the handles of handles when one is given, e.g. the hub's, otherwise numbers counted from 0
+    - a stream holds up to 256 shapes, the distinct argument type lists of its commands
+    - reset() starts a new stream, e.g. a new journal segment, whose definitions are written again
+    - a command that raises while it is encoded defines nothing, the stream goes on as if it wasn't sent
+    - an encoder isn't thread safe, the records of a stream must be written in the order they were encoded
+'''
+
+
+class CommandEncoder:
+    # Initializes an instance of CommandEncoder
+    def __init__(self, handles=None, opcode_table=None):
+        self.handles = handles  # DeviceHandles giving the device codes, None counts them per stream
+        self.opcode_table = opcode_table or opcodes  # OpcodeTable giving the opcodes
+        self.reset()
+
+    # Forgets every definition, the next records start a new stream
+    def reset(self):
+        self.devices = {}  # Dictionary with device_id as key and its code as value, for the devices defined
+        self.commands = {}  # Dictionary with command name as key and its opcode as value, for the opcodes defined
+        # Dictionary with the type of a single argument, a tuple of argument types or a type tag string as key
+        # and the (shape, Struct or None) defined for it as value, the Struct packs whole fixed-width records
+        self.shapes = {}
+
+    # Returns the records of a command on device_id
+    def encode(self, device_id, command, args=()):
+        code = self.devices.get(device_id)
+        opcode = self.commands.get(command)
+        if code is not None and opcode is not None:
+            try:
+                if len(args) == 1:  # Most commands are setters, packed without unpacking args
+                    shape = self.shapes.get(type(args[0]))
+                    if shape is not None and shape[1] is not None:
+                        return shape[1].pack(KIND_COMMAND, shape[0], code, opcode, args[0])
+                else:
+                    shape = self.shapes.get(tuple(map(type, args)))
+                    if shape is not None and shape[1] is not None:
+                        return shape[1].pack(KIND_COMMAND, shape[0], code, opcode, *args)
+            except struct.error:
+                pass  # An integer wider than 32 bits, the slow path picks a wider type
+        return self._encode_slowly(device_id, command, args)
+
+    # Returns the records of a batch of (device_id, command, args) commands, args may be left out
+    def encode_many(self, commands):
+        encode = self.encode
+        return b"".join([encode(entry[0], entry[1], entry[2] if len(entry) > 2 else ()) for entry in commands])
+
+    # Returns the records of a command that needs definitions or has arguments without a fixed size
+    # The new definitions are only kept once the whole command is encoded, so a command that fails to encode
+    # leaves the stream as it was
+    def _encode_slowly(self, device_id, command, args):
+        chunks = []
+        code = self.devices.get(device_id)
+        new_device = code is None
+        if new_device:
+            code = self.handles.assign(device_id) if self.handles is not None else len(self.devices)
+            encoded = device_id.encode("utf-8")
+            chunks.append(_DEVICE.pack(KIND_DEVICE, code, len(encoded)) + encoded)
+        opcode = self.commands.get(command)
+        new_opcode = opcode is None
+        if new_opcode:
+            opcode = self.opcode_table.opcode(command)
+            encoded = command.encode("utf-8")
+            chunks.append(_OPCODE.pack(KIND_OPCODE, opcode, len(encoded)) + encoded)
+        tags = "".join([_tag(value) for value in args])
+        types = tuple(map(type, args))
+        # Argument types with a default tag share the fast path key, the type of a single argument or the tuple
+        # of types, the others are keyed by their tags
+        if tags == "".join([_TYPE_TAGS.get(kind, "j") for kind in types]):
+            key = types[0] if len(types) == 1 else types
+        else:
+            key = tags
+        shape = self.shapes.get(key)
+        new_shape = shape is None
+        if new_shape:
+            if len(args) > 0xFF:
+                raise ValueError("A command can't have more than 255 arguments")
+            if len(self.shapes) > 0xFF:
+                raise ValueError("A stream can't have more than 256 argument shapes")
+            fixed = _FIXED.issuperset(tags)
+            shape = (len(self.shapes), struct.Struct(f"<BBIH{tags}") if fixed else None)
+            chunks.append(_SHAPE.pack(KIND_SHAPE, shape[0], len(tags)) + tags.encode("ascii"))
+        if shape[1] is not None:
+            chunks.append(shape[1].pack(KIND_COMMAND, shape[0], code, opcode, *args))
+        else:
+            chunks.append(_HEADER.pack(KIND_COMMAND, shape[0], code, opcode))
+            for tag, value in zip(tags, args):
+                chunks.append(_encode_value(tag, value))
+        # Every record is encoded, the definitions written with them become part of the stream
+        if new_device:
+            self.devices[device_id] = code
+        if new_opcode:
+            self.commands[command] = opcode
+        if new_shape:
+            self.shapes[key] = shape
+        return b"".join(chunks)
+
+
+'''
+Purpose: Decode the records written by a CommandEncoder, learning the definitions of the stream as it goes
+Contract:
+    - read() decodes the record at offset of a memoryview (or any buffer) in place, without copying it,
+      and returns (command, end): command is (device_id, command name, args) for COMMAND records and None
+      for definitions, end is the offset of the next record
+    - decode() returns the (device_id, command name, args) of every command in a buffer
+    - malformed records, and records using a code the stream never defined, raise ValueError
+    - a decoder follows one stream, reset() starts a new one
+'''
+
+
+class CommandDecoder:
+    # Initializes an instance of CommandDecoder
+    def __init__(self):
+        self.reset()
+
+    # Forgets every definition, the next records start a new stream
+    def reset(self):
+        self.devices = {}  # Dictionary with device code as key and device_id as value
+        self.commands = {}  # Dictionary with opcode as key and command name as value
+        # Dictionary with shape as key and its (Struct, None) for fixed-width shapes or (None, tags) as value
+        self.shapes = {}
+
+    # Decodes the record at offset, returns ((device_id, command, args) or None, end)
+    def read(self, view, offset=0):
+        try:
+            kind = view[offset]
+            if kind == KIND_COMMAND:
+                record, tags = self.shapes[view[offset + 1]]
+                if record is not None:
+                    values = record.unpack_from(view, offset)
+                    return (self.devices[values[2]], self.commands[values[3]], values[4:]), offset + record.size
+                _, _, code, opcode = _HEADER.unpack_from(view, offset)
+                args, end = _decode_values(tags, view, offset + _HEADER.size)
+                return (self.devices[code], self.commands[opcode], args), end
+            if kind == KIND_DEVICE:
+                _, code, length = _DEVICE.unpack_from(view, offset)
+                start = offset + _DEVICE.size
+                self.devices[code] = _text(view, start, length)
+                return None, start + length
+            if kind == KIND_OPCODE:
+                _, opcode, length = _OPCODE.unpack_from(view, offset)
+                start = offset + _OPCODE.size
+                self.commands[opcode] = _text(view, start, length)
+                return None, start + length
+            if kind == KIND_SHAPE:
+                _, shape, count = _SHAPE.unpack_from(view, offset)
+                start = offset + _SHAPE.size
+                tags = _text(view, start, count)
+                if not _FIXED.union("Nsj").issuperset(tags):
+                    raise ValueError(f"Unknown type tags '{tags}'")
+                self.shapes[shape] = (struct.Struct(f"<BBIH{tags}"), None) if _FIXED.issuperset(tags) else \
+                    (None, tags)
+                return None, start + count
+        except (struct.error, IndexError) as error:
+            raise ValueError(f"Malformed record at offset {offset}: {error}") from None
+        except KeyError as error:
+            raise ValueError(f"Record at offset {offset} uses undefined code {error}") from None
+        raise ValueError(f"Unknown record kind {kind} at offset {offset}")
+
+    # Returns the (device_id, command, args) of every command in data
+    def decode(self, data):
+        commands = []
+        append = commands.append
+        devices, names, shapes = self.devices, self.commands, self.shapes  # read() updates them in place
+        with memoryview(data) as view:
+            offset = 0
+            end = len(view)
+            while offset < end:
+                # Fast path for fixed-size commands using known codes, read() handles the rest and the errors
+                if view[offset] == KIND_COMMAND and offset + 1 < end:
+                    record = shapes.get(view[offset + 1], _VARIABLE)[0]
+                    if record is not None and offset + record.size <= end:
+                        values = record.unpack_from(view, offset)
+                        device_id = devices.get(values[2])
+                        command = names.get(values[3])
+                        if device_id is not None and command is not None:
+                            append((device_id, command, values[4:]))
+                            offset += record.size
+                            continue
+                command, offset = self.read(view, offset)
+                if command is not None:
+                    append(command)
+        return commands
+
+
+# Returns the self-contained records of one command, with its definitions, for decode_command()
+def encode_command(device_id, command, args=()):
+    return CommandEncoder().encode(device_id, command, args)
+
+
+# Returns the (device_id, command, args) of the records written by encode_command()
+def decode_command(data):
+    commands = CommandDecoder().decode(data)
+    if len(commands) != 1:
+        raise ValueError(f"Expected one command, found {len(commands)}")
+    return commands[0]
+
+
+# Returns a value as a type tag followed by the value, for messages that carry values outside of commands
+def encode_value(value):
+    tag = _tag(value)
+    return tag.encode("ascii") + _encode_value(tag, value)
+
+
+# Decodes a value written by encode_value() at offset of view, returns (value, end)
+def decode_value(view, offset=0):
+    try:
+        args, end = _decode_values(chr(view[offset]), view, offset + 1)
+    except (struct.error, IndexError) as error:
+        raise ValueError(f"Malformed value at offset {offset}: {error}") from None
+    return args[0], end
+
+
+# Returns the type tag of a value
+def _tag(value):
+    tag = _TYPE_TAGS.get(type(value), "j")
+    if tag == "i" and not -0x80000000 <= value < 0x80000000:
+        tag = "q" if -0x8000000000000000 <= value < 0x8000000000000000 else "j"  # JSON keeps every digit
+    return tag
+
+
+# Returns the bytes of a value with the given type tag, without the tag
+def _encode_value(tag, value):
+    if tag == "N":
+        return b""
+    if tag == "s":
+        encoded = value.encode("utf-8")
+    elif tag == "j":
+        encoded = json.dumps(value, separators=(",", ":"), default=_json_default).encode("utf-8")
+    else:
+        return struct.pack("<" + tag, value)
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+# Returns the plain value of a NumPy scalar or array for JSON, raises TypeError for any other unsupported value
+def _json_default(value):
+    if type(value).__module__ == "numpy" and hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Values of type {type(value).__name__} can't be encoded")
+
+
+# Decodes the values of the given type tags from offset of view, returns (tuple of values, end)
+def _decode_values(tags, view, offset):
+    values = []
+    for tag in tags:
+        if tag == "N":
+            values.append(None)
+        elif tag == "s" or tag == "j":
+            length, = _LENGTH.unpack_from(view, offset)
+            text = _text(view, offset + _LENGTH.size, length)
+            values.append(text if tag == "s" else json.loads(text))
+            offset += _LENGTH.size + length
+        elif tag in _FIXED:
+            values.append(struct.unpack_from("<" + tag, view, offset)[0])
+            offset += struct.calcsize(tag)
+        else:
+            raise ValueError(f"Unknown type tag '{tag}'")
+    return tuple(values), offset
+
+
+# Decodes length bytes of UTF-8 text at offset of view
+def _text(view, offset, length):
+    if offset + length > len(view):
+        raise ValueError("Text runs past the end of the buffer")
+    return str(view[offset:offset + length], "utf-8")
@@ -0,0 +1,121 @@
+import threading
+
+'''
+Purpose: Describe a command that a device class supports
+Contract:
+    - name is the command name used by SmartHomeHub.send_command()
+    - attribute is the name of the device method that runs the command
+    - function is the method resolved for a concrete class, None until resolved
+    - blocking is True if the handler may block, so async hubs run it on an executor
+    - query is True if the handler only reads state, so it isn't recorded in the command journal
+    - coalesce is True if only the latest call matters, so a coalescing hub may replace a pending call with a newer one
+'''
+
+
+class CommandSpec:
+    __slots__ = ("name", "attribute", "function", "blocking", "query", "coalesce")
+
+    # Initializes an instance of CommandSpec
+    def __init__(self, name, attribute, function=None, blocking=False, query=False, coalesce=False):
+        self.name = name  # Command name, e.g. 'lock'
+        self.attribute = attribute  # Method name on the device, e.g. 'locked'
+        self.function = function  # Unbound method of the concrete class
+        self.blocking = blocking  # Whether the handler may block the calling thread
+        self.query = query  # Whether the handler only reads state
+        self.coalesce = coalesce  # Whether a pending call may be replaced by a newer one
+
+    # Returns a copy of the spec bound to the implementation of the command on cls
+    def resolve(self, cls):
+        return CommandSpec(self.name, self.attribute, getattr(cls, self.attribute), self.blocking, self.query,
+                           self.coalesce)
+
+
+'''
+Purpose: Map (device class, command name) pairs to the device method that handles the command
+Contract:
+    - register() registers a method of a class as the handler of a command
+    - register_class() registers every method of a class marked with the command() decorator
+    - resolve() returns the CommandSpec of a command for a device class, or None if unsupported
+    - supported_commands() returns the names of the commands a device class supports
+'''
+
+
+class CommandRegistry:
+    # Initializes an instance of CommandRegistry
+    def __init__(self):
+        self.commands = {}  # Dictionary with a class as key and a {command name: CommandSpec} dictionary as value
+        self.cache = {}  # Dictionary with (class, command name) as key and the resolved CommandSpec as value
+        self.lock = threading.Lock()  # Lock to keep registrations safe
+
+    # Registers the method named attribute of cls as the handler of the command name
+    def register(self, cls, name, attribute, blocking=False, query=False, coalesce=False):
+        with self.lock:  # Lock before changing the registry
+            self.commands.setdefault(cls, {})[name] = CommandSpec(name, attribute, blocking=blocking, query=query,
+                                                                  coalesce=coalesce)
+            self.cache = {}  # Subclasses may resolve differently now, so every cached resolution is dropped
+
+    # Registers every method of cls marked with the command() decorator, returns cls so it works as a decorator
+    def register_class(self, cls):
+        for attribute, value in list(vars(cls).items()):
+            for name, options in getattr(value, "command_options", ()):
+                self.register(cls, name, attribute, **options)
+        return cls
+
+    # Returns the CommandSpec of the command for cls, or None if cls doesn't support it
+    def resolve(self, cls, name):
+        key = (cls, name)
+        spec = self.cache.get(key, _MISSING)  # Lock free fast path, a single dictionary lookup
+        if spec is _MISSING:
+            spec = None
+            # Walks the MRO so subclasses inherit the commands of their base classes
+            for klass in cls.__mro__:
+                registered = self.commands.get(klass)
+                if registered is not None and name in registered:
+                    spec = registered[name].resolve(cls)  # Binds to the most derived override of the method
+                    break
+            self.cache[key] = spec  # Caches the result, including misses, per concrete class
+        return spec
+
+    # Returns the sorted names of every command cls supports
+    def supported_commands(self, cls):
+        names = set()
+        for klass in cls.__mro__:
+            names.update(self.commands.get(klass, ()))
+        return sorted(names)
+
+
+'''
+Purpose: Report that a command was sent to a device that isn't registered with the hub
+'''
+
+
+class DeviceNotFoundError(KeyError):
+    pass
+
+
+'''
+Purpose: Report that a command isn't supported by the device it was sent to
+'''
+
+
+class UnsupportedCommandError(ValueError):
+    pass
+
+
+_MISSING = object()  # Marker for cache misses, since None is a valid cached resolution
+
+registry = CommandRegistry()  # Registry shared by the devices in Devices.py and any plugin device classes
+
+
+# Decorator that marks a device method as the handler of a command, named after the method by default
+# blocking marks handlers that may block, so async hubs run them on an executor instead of the event loop
+# query marks handlers that only read state, which the command journal doesn't record
+# coalesce marks setters where only the latest value matters, e.g. a brightness slider
+def command(name=None, blocking=False, query=False, coalesce=False):
+    def decorator(function):
+        options = getattr(function, "command_options", ())  # A method may handle several commands
+        flags = {"blocking": blocking, "query": query, "coalesce": coalesce}
+        function.command_options = options + ((name or function.__name__, flags),)
+        return function
+
+    return decorator
@@ -0,0 +1,167 @@
+from bisect import bisect_left, bisect_right
+import threading
+
+'''
+Purpose: Secondary indexes over a set of devices, keyed by device_type and by the values of selected fields
+Contract:
+    - add() indexes a device under its device_type and the current values of the indexed fields it has,
+      add_many() indexes many devices of one device_type from columns of their values, without the devices
+    - remove() drops a device from every index
+    - refresh() re-reads one field of a device and moves it to the bucket of its current value
+    - assign() moves many devices to the buckets of their new values of one field at once, with one set
+      operation per bucket instead of one refresh per device
+    - query() returns the ids of the devices matching device_type and every field condition, a condition is
+      field=value, or field=(low, high) for an inclusive range, in time proportional to the smallest matching
+      bucket rather than to the number of devices, range conditions walk the sorted values of the field
+'''
+
+
+class DeviceIndex:
+    # Initializes an instance of DeviceIndex for the given field names
+    def __init__(self, fields=("status", "is_locked", "is_open", "door_open")):
+        self.fields = frozenset(fields)  # Names of the indexed fields
+        self.ids = set()  # Ids of the indexed devices
+        self.by_type = {}  # Dictionary with device_type as key and the set of device ids as value
+        self.by_field = {field: {} for field in self.fields}  # field -> {value: set of device ids}
+        self.values = {field: {} for field in self.fields}  # field -> {device_id: indexed value}
+        self.keys = {field: None for field in self.fields}  # field -> sorted values of its buckets, None if stale
+        self.lock = threading.Lock()  # Lock to keep the buckets consistent with each other
+
+    # Indexes a device under its type and the current values of its indexed fields
+    def add(self, device):
+        device_id = device.device_id
+        with self.lock:  # Lock before changing the buckets
+            self.ids.add(device_id)
+            self.by_type.setdefault(getattr(device, "device_type", None), set()).add(device_id)
+            for field in self.fields:
+                if hasattr(device, field):
+                    value = getattr(device, field)
+                    old = self.values[field].get(device_id, value)
+                    if old != value:
+                        self._discard(field, old, device_id)  # Indexed before, e.g. from a snapshot row
+                    self.values[field][device_id] = value
+                    self._bucket(field, value).add(device_id)
+
+    # Indexes the devices of device_ids under device_type, columns maps field names to values in device_ids order
+    def add_many(self, device_type, device_ids, columns):
+        with self.lock:  # Lock before changing the buckets
+            self.ids.update(device_ids)
+            self.by_type.setdefault(device_type, set()).update(device_ids)
+            for field, column in columns.items():
+                if field not in self.fields:
+                    continue
+                self.values[field].update(zip(device_ids, column))
+                groups = {}  # Dictionary with value as key and the list of device ids as value
+                for device_id, value in zip(device_ids, column):
+                    groups.setdefault(value, []).append(device_id)
+                for value, ids in groups.items():
+                    self._bucket(field, value).update(ids)
+
+    # Drops a device from every index
+    def remove(self, device):
+        device_id = device.device_id
+        with self.lock:  # Lock before changing the buckets
+            if device_id not in self.ids:
+                return  # The device wasn't indexed
+            self.ids.discard(device_id)
+            _discard(self.by_type, getattr(device, "device_type", None), device_id)
+            for field, values in self.values.items():
+                if device_id in values:
+                    self._discard(field, values.pop(device_id), device_id)
+
+    # Moves a device to the bucket of the current value of field
+    # The value is read at refresh time, so the last refresh wins even if events arrive out of order
+    def refresh(self, device, field):
+        if field not in self.fields:
+            return  # Not an indexed field
+        device_id = device.device_id
+        with self.lock:  # Lock before changing the buckets
+            if device_id not in self.ids:
+                return  # The device isn't indexed
+            value = getattr(device, field)
+            values = self.values[field]
+            if device_id in values:
+                if values[device_id] == value:
+                    return  # Already in the right bucket
+                self._discard(field, values[device_id], device_id)
+            values[device_id] = value
+            self._bucket(field, value).add(device_id)
+
+    # Moves devices to new buckets of field, groups is a dictionary with the new value as key and ids as value
+    def assign(self, field, groups):
+        if field not in self.fields:
+            return  # Not an indexed field
+        with self.lock:  # Lock before changing the buckets
+            buckets, values = self.by_field[field], self.values[field]
+            for value, device_ids in groups.items():
+                moved = self.ids.intersection(device_ids)  # Only indexed devices are moved
+                for old in [old for old in buckets if old != value]:
+                    bucket = buckets[old]
+                    left = bucket & moved  # Costs the smaller of the two sets, not one discard per device
+                    if not left:
+                        continue
+                    bucket -= left
+                    if not bucket:
+                        del buckets[old]
+                        self.keys[field] = None
+                self._bucket(field, value).update(moved)
+                values.update(dict.fromkeys(moved, value))
+
+    # Returns the bucket of value in field, creating it if needed, the caller holds the lock
+    def _bucket(self, field, value):
+        buckets = self.by_field[field]
+        bucket = buckets.get(value)
+        if bucket is None:
+            bucket = buckets[value] = set()
+            self.keys[field] = None  # The sorted values are rebuilt by the next range query
+        return bucket
+
+    # Removes device_id from the bucket of value in field, the caller holds the lock
+    def _discard(self, field, value, device_id):
+        if _discard(self.by_field[field], value, device_id):
+            self.keys[field] = None
+
+    # Returns the set of ids of the devices matching device_type (if given) and every field condition
+    def query(self, device_type=None, **conditions):
+        for field in conditions:
+            if field not in self.fields:
+                raise ValueError(f"Field '{field}' is not indexed")  # Unindexed fields would need a full scan
+        with self.lock:  # Lock so the buckets don't change while they are intersected
+            buckets = []
+            if device_type is not None:
+                buckets.append(self.by_type.get(device_type, _EMPTY))
+            for field, condition in conditions.items():
+                if isinstance(condition, tuple):
+                    buckets.append(self._range(field, *condition))
+                else:
+                    buckets.append(self.by_field[field].get(condition, _EMPTY))
+            if not buckets:
+                return set(self.ids)  # No conditions, every indexed device matches
+            buckets.sort(key=len)  # Starts from the smallest bucket so the work is bounded by the result size
+            smallest, others = buckets[0], buckets[1:]
+            return {device_id for device_id in smallest if all(device_id in bucket for bucket in others)}
+
+    # Returns the ids of the devices whose value of field is in [low, high], the caller holds the lock
+    def _range(self, field, low, high):
+        keys = self.keys[field]
+        if keys is None:
+            try:
+                keys = self.keys[field] = sorted(self.by_field[field])
+            except TypeError:
+                raise ValueError(f"Field '{field}' has values that can't be ordered") from None
+        buckets = self.by_field[field]
+        return set().union(*(buckets[key] for key in keys[bisect_left(keys, low):bisect_right(keys, high)]))
+
+
+_EMPTY = frozenset()  # Bucket returned for values that no device has
+
+
+# Removes device_id from the bucket for key, dropping the bucket once it is empty, returns True if it was dropped
+def _discard(buckets, key, device_id):
+    bucket = buckets.get(key)
+    if bucket is not None:
+        bucket.discard(device_id)
+        if not bucket:
+            del buckets[key]
+            return True
+    return False
@@ -0,0 +1,274 @@
+from Devices import *
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is only needed by the columnar table, the rest of the system works without it
+    np = None
+
+'''
+Purpose: Hold the state columns of every attached device of one device class
+Contract:
+    - attach() gives a device a row and moves its state from its slots into the columns
+    - detach() moves the state of a device back into its slots and frees its row
+    - read() and write() access one field of one row, they back the StateField descriptors of attached devices
+    - rows beyond size, and rows of detached devices, are inactive and ignored by selections and updates
+'''
+
+
+class _Segment:
+    # Initializes an instance of _Segment for device class cls
+    def __init__(self, table, cls, capacity):
+        self.table = table  # Table the segment belongs to, which owns the status codes
+        self.cls = cls  # Device class whose devices live in the segment
+        self.fields = cls.state_fields()  # Dictionary of field name to dtype name
+        self.columns = {name: np.zeros(capacity, dtype=_numpy_dtype(dtype)) for name, dtype in self.fields.items()}
+        self.active = np.zeros(capacity, dtype=bool)  # Whether each row holds an attached device
+        self.devices = [None] * capacity  # Device attached to each row
+        self.rows = {}  # Dictionary with device_id as key and row as value
+        self.free = []  # Rows freed by detached devices, reused before the segment grows
+        self.size = 0  # Number of rows ever handed out
+        self.lock = threading.Lock()  # Lock to keep writes, growth and bulk updates from racing each other
+
+    # Gives device a row and moves its state into the columns
+    def attach(self, device):
+        values = {name: getattr(device, name) for name in self.fields}  # State read from the slots
+        with self.lock:  # Lock before changing the rows
+            if self.free:
+                row = self.free.pop()  # Reuses the row of a detached device
+            else:
+                if self.size == len(self.active):
+                    self._grow()
+                row = self.size
+                self.size += 1
+            for name, value in values.items():
+                self.columns[name][row] = self._encode(name, value)
+            self.active[row] = True
+            self.devices[row] = device
+            self.rows[device.device_id] = row
+        device._row = row
+        device._segment = self  # From here on the StateFields of the device read and write the row
+
+    # Gives a group of devices consecutive new rows and moves their state into the columns in bulk
+    def attach_many(self, devices):
+        values = {name: [self._encode(name, getattr(device, name)) for device in devices] for name in self.fields}
+        with self.lock:  # Lock before changing the rows
+            start = self.size
+            while len(self.active) < start + len(devices):
+                self._grow()
+            end = start + len(devices)
+            for name, column in values.items():
+                self.columns[name][start:end] = column
+            self.active[start:end] = True
+            self.devices[start:end] = devices
+            for row, device in enumerate(devices, start):
+                self.rows[device.device_id] = row
+            self.size = end
+        for row, device in enumerate(devices, start):
+            device._row = row
+            device._segment = self
+
+    # Moves the state of device back into its slots and frees its row
+    def detach(self, device):
+        values = {name: getattr(device, name) for name in self.fields}  # State read from the row
+        device._segment = None  # From here on the StateFields of the device use its slots again
+        for name, value in values.items():
+            setattr(device, name, value)
+        with self.lock:  # Lock before changing the rows
+            row = self.rows.pop(device.device_id)
+            self.active[row] = False
+            self.devices[row] = None
+            self.free.append(row)
+        device._row = -1
+
+    # Doubles the capacity of every column, the caller holds the segment lock
+    def _grow(self):
+        capacity = max(16, 2 * len(self.active))
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            self.columns[name] = grown
+        active = np.zeros(capacity, dtype=bool)
+        active[:len(self.active)] = self.active
+        self.active = active
+        self.devices.extend([None] * (capacity - len(self.devices)))
+
+    # Returns the value of field at row as a plain Python value
+    def read(self, row, name):
+        value = self.columns[name][row].item()
+        if name == "status":
+            return self.table.status_names[value]  # Decodes the status code
+        return value
+
+    # Stores value in field at row
+    def write(self, row, name, value):
+        code = self._encode(name, value)
+        with self.lock:  # Lock so the write can't land in a column that is being replaced by _grow()
+            self.columns[name][row] = code
+
+    # Encodes a status string as its code, other values are stored as they are
+    def _encode(self, name, value):
+        return self.table.status_code(value) if name == "status" else value
+
+
+'''
+Purpose: Columnar store of device state, one set of NumPy arrays per device class, for fleet wide vectorized operations
+Contract:
+    - attach() moves a device's state into the table, after which the device object is a thin view over its row
+    - detach() moves the state back into the device object
+    - select() returns a boolean row mask for the devices of a class that match the given conditions
+    - reads take the segment lock like update(), so a mask always matches the columns it is applied to, a mask
+      selected before the segment grew doesn't select the rows added since
+    - update() assigns fields on every selected row at once, returns the number of rows updated
+    - aggregate() computes count/sum/mean/min/max of a field over the selected rows
+    - values() and device_ids() return the field values and ids of the selected rows, groups() their ids by value
+    - bulk updates write the columns directly, they don't take device locks or emit device events
+'''
+
+
+class DeviceTable:
+    # Initializes an instance of DeviceTable
+    def __init__(self, capacity=1024):
+        if np is None:
+            raise ImportError("DeviceTable requires NumPy")  # The columns are NumPy arrays
+        self.capacity = capacity  # Initial number of rows per device class
+        self.segments = {}  # Dictionary with device class as key and segment as value
+        self.types = {}  # Dictionary with device_type string as key and device class as value
+        self.status_names = [STATUS_OFF, STATUS_ON, STATUS_ACTIVE, STATUS_OPEN, STATUS_CLOSED]  # Code to status
+        self.status_codes = {name: code for code, name in enumerate(self.status_names)}  # Status to code
+        self.lock = threading.Lock()  # Lock to keep segment creation and attaching safe
+
+    # Returns the code of a status string, assigning a new code to statuses that weren't seen before
+    def status_code(self, status):
+        code = self.status_codes.get(status)
+        if code is None:
+            with self.lock:  # Lock before adding a status
+                code = self.status_codes.get(status)
+                if code is None:
+                    code = len(self.status_names)
+                    self.status_names.append(sys.intern(status))
+                    self.status_codes[status] = code
+        return code
+
+    # Moves the state of device into the table
+    def attach(self, device):
+        with self.lock:  # Lock before looking up or creating the segment
+            segment = self.segments.get(type(device))
+            if segment is None:
+                segment = _Segment(self, type(device), self.capacity)
+                self.segments[type(device)] = segment
+                self.types.setdefault(device.device_type, type(device))
+        segment.attach(device)
+
+    # Moves the state of many devices into the table, filling each column with one vectorized assignment
+    def attach_many(self, devices):
+        by_class = {}
+        for device in devices:
+            by_class.setdefault(type(device), []).append(device)
+        for cls, group in by_class.items():
+            with self.lock:  # Lock before looking up or creating the segment
+                segment = self.segments.get(cls)
+                if segment is None:
+                    segment = _Segment(self, cls, self.capacity)
+                    self.segments[cls] = segment
+                    self.types.setdefault(group[0].device_type, cls)
+            segment.attach_many(group)
+
+    # Moves the state of device back into the device object
+    def detach(self, device):
+        segment = device._segment
+        if segment is not None and segment.table is self:
+            segment.detach(device)
+
+    # Returns the segment for a device class or device_type string
+    def segment(self, device_class):
+        if isinstance(device_class, str):
+            device_class = self.types[device_class]  # Device type strings map to the class first attached
+        return self.segments[device_class]
+
+    # Returns a boolean mask of the active rows of device_class that match every condition
+    # A condition is field=value, or field=(low, high) for an inclusive range, ids limits the rows to those devices
+    def select(self, device_class, ids=None, **conditions):
+        segment = self.segment(device_class)
+        with segment.lock:  # Lock so the mask and the columns have the same length while they are combined
+            mask = segment.active.copy()
+            mask[segment.size:] = False
+            if ids is not None:
+                rows = [segment.rows[device_id] for device_id in ids if device_id in segment.rows]
+                chosen = np.zeros_like(mask)
+                chosen[rows] = True
+                mask &= chosen
+            for name, condition in conditions.items():
+                column = segment.columns[name]
+                if isinstance(condition, tuple):
+                    low, high = (segment._encode(name, bound) for bound in condition)
+                    mask &= (column >= low) & (column <= high)
+                else:
+                    mask &= column == segment._encode(name, condition)
+        return mask
+
+    # Assigns the given field values on the rows selected by where (every active row when None)
+    def update(self, device_class, where=None, **values):
+        segment = self.segment(device_class)
+        with segment.lock:  # Lock so the update doesn't race a column being replaced
+            mask = self._rows(segment, where)
+            for name, value in values.items():
+                segment.columns[name][mask] = segment._encode(name, value)
+        return int(np.count_nonzero(mask))
+
+    # Computes count, sum, mean, min or max of a field over the rows selected by where
+    def aggregate(self, device_class, field, how="mean", where=None):
+        selected = self.values(device_class, field, where)
+        if how == "count":
+            return int(selected.size)
+        if selected.size == 0:
+            return None  # Nothing to aggregate
+        return getattr(selected, how)().item()
+
+    # Returns the values of a field for the rows selected by where, in row order
+    def values(self, device_class, field, where=None):
+        segment = self.segment(device_class)
+        with segment.lock:  # Lock so the mask and the column have the same length
+            return segment.columns[field][self._rows(segment, where)]
+
+    # Returns the device ids of the rows selected by where, in row order
+    def device_ids(self, device_class, where=None):
+        segment = self.segment(device_class)
+        with segment.lock:  # Lock so rows aren't reused by other devices while they are read
+            return [segment.devices[row].device_id for row in np.flatnonzero(self._rows(segment, where))]
+
+    # Groups the rows selected by where by their value of field
+    # Returns a dictionary with the plain value as key and the list of device ids holding it as value
+    def groups(self, device_class, field, where=None):
+        segment = self.segment(device_class)
+        with segment.lock:  # Lock so the rows, the column and the devices stay consistent with each other
+            rows = np.flatnonzero(self._rows(segment, where))
+            column = segment.columns[field][rows]
+            ids = np.array([segment.devices[row].device_id for row in rows], dtype=object)
+        values, inverse = np.unique(column, return_inverse=True)
+        groups = {}
+        for code, value in enumerate(values.tolist()):
+            if field == "status":
+                value = self.status_names[value]  # Decodes the status code
+            groups[value] = ids[inverse == code].tolist()
+        return groups
+
+    # Returns the mask of selected rows, limited to rows that hold attached devices, the caller holds the segment lock
+    # A where mask selected before the segment grew leaves the rows added since unselected
+    @staticmethod
+    def _rows(segment, where):
+        if where is None:
+            mask = segment.active.copy()
+        else:
+            mask = np.zeros_like(segment.active)
+            count = min(len(where), len(mask))
+            mask[:count] = where[:count]
+            mask &= segment.active
+        mask[segment.size:] = False
+        return mask
+
+
+# Returns the NumPy dtype for a StateField dtype name
+def _numpy_dtype(dtype):
+    return np.int16 if dtype == "status" else np.dtype(dtype)
@@ -1,5 +1,141 @@
 import threading
 import random
+import sys
+import time
+from Commands import command, registry
+from Events import get_event_sink, make_event
+
+'''
+Purpose: Hand out locks for devices, either one lock per device or a lock shared from a fixed set of stripes
+Contract:
+    - lock_for() returns the lock a new device should use
+    - with stripes set, devices whose ids hash to the same stripe share a lock, which saves memory for large fleets
+'''
+
+
+class LockStripes:
+    __slots__ = ("locks",)
+
+    # Initializes an instance of LockStripes with the given number of shared locks
+    def __init__(self, stripes):
+        if stripes < 1:
+            raise ValueError("stripes must be at least 1")  # Needs at least one lock to hand out
+        self.locks = tuple(threading.Lock() for _ in range(stripes))  # The shared locks
+
+    # Returns the shared lock for a device id
+    def lock_for(self, device_id):
+        return self.locks[hash(device_id) % len(self.locks)]
+
+
+_lock_stripes = None  # Shared locks used by new devices, None gives every device its own lock
+
+
+# Makes devices created from now on share locks from the given number of stripes, None restores one lock per device
+# Device methods never hold two device locks at once, so sharing a lock can't deadlock
+def use_lock_stripes(stripes):
+    global _lock_stripes
+    _lock_stripes = None if stripes is None else LockStripes(stripes)
+
+
+# Returns the lock a new device should use
+def _new_device_lock(device_id):
+    return threading.Lock() if _lock_stripes is None else _lock_stripes.lock_for(device_id)
+
+
+# Slots that aren't state
+_RUNTIME_SLOTS = {"device_id", "device_type", "lock", "event_sink", "_segment", "_row", "_version"}
+
+# Interned status strings, every device with the same status points at the same string object
+STATUS_ON = sys.intern("on")
+STATUS_OFF = sys.intern("off")
+STATUS_ACTIVE = sys.intern("active")
+STATUS_OPEN = sys.intern("open")
+STATUS_CLOSED = sys.intern("closed")
+
+'''
+Purpose: Descriptor for a piece of numeric device state that can live in a columnar DeviceTable
+Contract:
+    - the value is kept in the slot named after the field with a leading underscore while the device is standalone
+    - once a DeviceTable attaches the device, reads and writes go to the device's row in the table instead
+    - dtype names the column type used by DeviceTable ("bool", "int8", "int16", "float64" or "status")
+'''
+
+
+class StateField:
+    __slots__ = ("name", "dtype", "storage")
+
+    # Initializes an instance of StateField
+    def __init__(self, dtype):
+        self.dtype = dtype  # Column type of the field
+        self.name = None  # Field name, set once the owning class is created
+        self.storage = None  # Slot descriptor that holds the value of standalone devices
+
+    # Binds the field to the slot of the owning class
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.storage = owner.__dict__["_" + name]  # The class must declare the slot "_<name>"
+
+    # Returns the value from the slot, or from the table row of an attached device
+    def __get__(self, device, owner=None):
+        if device is None:
+            return self  # Accessed on the class
+        segment = device._segment
+        if segment is None:
+            return self.storage.__get__(device, owner)
+        return segment.read(device._row, self.name)
+
+    # Stores the value in the slot, or in the table row of an attached device
+    def __set__(self, device, value):
+        segment = device._segment
+        if segment is None:
+            self.storage.__set__(device, value)
+        else:
+            segment.write(device._row, self.name, value)
+
+
+'''
+Purpose: Apply a compound change of a device's state as one atomic transition
+Contract:
+    - entering takes the device lock and makes the device version odd, leaving makes it even again, so readers
+      using the version never see a transition half applied
+    - emit() and notice() queue the events of the transition, they are emitted once the new state is published,
+      still under the lock, so a device's events come out in the order its transitions happened
+'''
+
+
+class Transition:
+    __slots__ = ("device", "events")
+
+    # Initializes an instance of Transition for device
+    def __init__(self, device):
+        self.device = device  # Device whose state changes
+        self.events = []  # (field, old, new, message, kind) of the events to emit
+
+    # Takes the lock and marks the state as changing
+    def __enter__(self):
+        device = self.device
+        device.lock.acquire()
+        device._version += 1  # Odd, optimistic readers wait and retry
+        return self
+
+    # Publishes the new state, emits the queued events and releases the lock
+    def __exit__(self, *exc_info):
+        device = self.device
+        device._version += 1  # Even again, also when a handler failed midway
+        try:
+            for field, old, new, message, kind in self.events:
+                device._emit(field, old, new, message, kind)
+        finally:
+            device.lock.release()
+
+    # Queues the change of field from old to new
+    def emit(self, field, old, new, message=None):
+        self.events.append((field, old, new, message, "change"))
+
+    # Queues a message that doesn't change any state
+    def notice(self, message):
+        self.events.append((None, None, None, message, "notice"))
+
 
 '''
 Purpose: Represents a device in a smart home system
@@ -7,31 +143,140 @@ Contract:
     - turn_on() turns on the device
     - turn_off() turns off the device
     - get_status() returns the status of the device
+    - every state change runs as one Transition, which bumps the device version, so get_status(), read_fields()
+      and read_state() read consistent state without the lock, retrying if a transition ran meanwhile
+    - subclasses extend _turn_on() and _turn_off(), so their whole turn_on() and turn_off() is one transition
 '''
 
 
 class SmartDevice:
+    # Slotted attributes keep devices free of a per-instance __dict__, which matters for large fleets
+    __slots__ = ("device_id", "device_type", "_status", "lock", "event_sink", "_segment", "_row", "_version")
+
+    status = StateField("status")  # Status of the device, e.g. 'on' or 'off'
+
     # Initializes an instance of SmartDevice
     def __init__(self, device_id, device_type):
+        self._version = 0  # Twice the number of transitions applied, odd while a transition is in progress
+        self._segment = None  # Table segment holding the state of the device, None while standalone
+        self._row = -1  # Row of the device in its table segment
         self.device_id = device_id  # Initializes device_id for each device
         self.device_type = device_type  # Initializes the device type
-        self.status = "off"  # Initial status of device is set to 'off'
-        self.lock = threading.Lock()  # Thread lock for safe modifications to device state
+        self.status = STATUS_OFF  # Initial status of device is set to 'off'
+        self.lock = _new_device_lock(device_id)  # Thread lock for safe modifications to device state
+        self.event_sink = None  # Sink for the events of this device, None uses the default sink from Events.py
+
+    # Registers the commands of every device subclass with the command registry
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry.register_class(cls)
+
+    # Builds a device of this class from saved state without running the subclass constructor
+    @classmethod
+    def restore(cls, device_id, device_type, state):
+        device = cls.__new__(cls)
+        SmartDevice.__init__(device, device_id, device_type)  # Sets up the id, type, lock and event sink
+        for name, value in state.items():
+            setattr(device, name, value)  # Restores the saved state
+        return device
+
+    # Returns the StateFields of the class as a {name: dtype} dictionary, base class fields first
+    @classmethod
+    def state_fields(cls):
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, StateField):
+                    fields[name] = value.dtype
+        return fields
+
+    # Pickles the device as its class, id, type and state, since its lock and event sink can't be pickled
+    # The copy is a standalone device with its own lock, even if the original is attached to a DeviceTable
+    def __reduce__(self):
+        names = self._state_names()
+        state = dict(zip(names, self.read_fields(*names)))  # Consistent copy, even while commands run
+        return type(self).restore, (self.device_id, self.device_type, state)
+
+    # Returns the names of the StateFields of the device followed by its plain state slots
+    def _state_names(self):
+        cls = type(self)
+        names = list(cls.state_fields())
+        backing = {"_" + name for name in names}  # Slots that hold the StateField values
+        for klass in cls.__mro__:
+            for slot in getattr(klass, "__slots__", ()):
+                if slot not in _RUNTIME_SLOTS and slot not in backing and not slot.startswith("__") and \
+                        hasattr(self, slot):
+                    names.append(slot)  # Plain slots, like Television.input_source
+        return names
 
     # Turns on the device
+    @command()
     def turn_on(self):
-        with self.lock:  # Lock before changing status
-            self.status = "on"  # Set device status to 'on'
+        with self.transition() as change:  # Lock before changing status
+            self._turn_on(change)
 
     # Turns off the device
+    @command()
     def turn_off(self):
-        with self.lock:  # Lock before changing status
-            self.status = "off"  # Set device status to 'off'
-
-    # Gets and returns the status of the device
+        with self.transition() as change:  # Lock before changing status
+            self._turn_off(change)
+
+    # Applies turning on to a transition, subclasses extend it to change the rest of their state with it
+    def _turn_on(self, change):
+        old = self.status
+        self.status = STATUS_ON  # Set device status to 'on'
+        change.emit("status", old, self.status)
+
+    # Applies turning off to a transition, subclasses extend it to change the rest of their state with it
+    def _turn_off(self, change):
+        old = self.status
+        self.status = STATUS_OFF  # Set device status to 'off'
+        change.emit("status", old, self.status)
+
+    # Gets and returns the status of the device without taking the lock
     def get_status(self):
-        with self.lock:  # Lock before reading status
-            return self.status  # Returns the status of the event
+        while True:
+            version = self._version
+            status = self.status
+            if version == self._version and not version & 1:
+                return status  # No transition ran while status was read
+            time.sleep(0)  # A transition is in progress, lets the writer finish it
+
+    # Returns the number of transitions applied to the device
+    @property
+    def version(self):
+        return self._version >> 1
+
+    # Starts an atomic transition of the device state, used as "with device.transition() as change:"
+    def transition(self):
+        return Transition(self)
+
+    # Returns the values of fields as a list, read without the lock but as consistent as if it had been held
+    def read_fields(self, *fields):
+        while True:
+            version = self._version
+            if not version & 1:
+                values = [getattr(self, field) for field in fields]
+                if self._version == version:
+                    return values  # No transition ran while the fields were read
+            time.sleep(0)  # A transition is in progress, lets the writer finish it
+
+    # Returns the version and the whole state of the device as one consistent dictionary
+    def read_state(self):
+        names = ["version", *self._state_names()]
+        return dict(zip(names, self.read_fields(*names)))
+
+    # Emits a change of field from old to new to the event sink, the sink does the I/O off this thread
+    def _emit(self, field, old, new, message=None, kind="change"):
+        sink = self.event_sink or get_event_sink()  # Falls back to the default sink
+        sink.emit(make_event(self.device_id, self.device_type, kind, field, old, new, message))
+
+    # Emits a message that doesn't change any state to the event sink
+    def _notice(self, message):
+        self._emit(None, None, None, message, kind="notice")
+
+
+registry.register_class(SmartDevice)  # Registers the commands every device supports
 
 
 '''
@@ -44,34 +289,45 @@ Contract:
 
 
 class Lightbulb(SmartDevice):
+    __slots__ = ("_brightness",)
+
+    brightness = StateField("int16")
+
     # Initializes an instance of Lightbulb
     def __init__(self, device_id):
         super().__init__(device_id, "Smart Lightbulb")  # Initializes device type as "Smart Lightbulb"
         self.brightness = 0  # Initializes brightness to 0 as it's off
 
-    # Turns on the lightbulb and prints the status
-    def turn_on(self):
-        super().turn_on()  # Turns device on through SmartDevice method
+    # Turns on the lightbulb and reports the status, readers never see it on with brightness 0
+    def _turn_on(self, change):
+        super()._turn_on(change)  # Turns device on through SmartDevice method
+        old = self.brightness
         self.brightness = 100  # Sets the brightness to 100
-        # Prints status after turning on lightbulb
-        print(f"{self.device_type} {self.device_id} turned on with brightness {self.brightness}%")
-
-    # Turns off the lightbulb and prints the status
-    def turn_off(self):
-        super().turn_off()  # Turns device off through SmartDevice method
+        # Reports status after turning on lightbulb
+        change.emit("brightness", old, self.brightness,
+                    f"{self.device_type} {self.device_id} turned on with brightness {self.brightness}%")
+
+    # Turns off the lightbulb and reports the status
+    def _turn_off(self, change):
+        super()._turn_off(change)  # Turns device off through SmartDevice method
+        old = self.brightness
         self.brightness = 0  # Sets the brightness to 0
-        print(f"{self.device_type} {self.device_id} turned off")  # Prints status after turning off the lightbulb
+        # Reports status after turning off the lightbulb
+        change.emit("brightness", old, self.brightness, f"{self.device_type} {self.device_id} turned off")
 
-    # Changes the brightness of the lightbulb if it's on and prints the update
+    # Changes the brightness of the lightbulb if it's on and reports the update
+    @command(coalesce=True)
     def change_brightness(self, level):
-        with self.lock:  # Lock before changing brightness
-            if self.status == "on":  # Checks if the lightbulb is on, only changes brightness if on
+        with self.transition() as change:  # Lock before changing brightness
+            if self.status == STATUS_ON:  # Checks if the lightbulb is on, only changes brightness if on
+                old = self.brightness
                 self.brightness = max(0, min(level, 100))  # Ensures brightness stays between 0 and 100
-                # Prints the updated brightness of the bulb
-                print(f"{self.device_type} {self.device_id} brightness adjusted to {self.brightness}%")
+                # Reports the updated brightness of the bulb
+                change.emit("brightness", old, self.brightness,
+                            f"{self.device_type} {self.device_id} brightness adjusted to {self.brightness}%")
             else:
-                # Prints message stating to turn on light to adjust the brightness
-                print(f"{self.device_type} {self.device_id} is off. Please turn it on to change the brightness.")
+                # Reports message stating to turn on light to adjust the brightness
+                change.notice(f"{self.device_type} {self.device_id} is off. Please turn it on to change the brightness.")
 
 
 '''
@@ -84,29 +340,36 @@ Contract:
 
 
 class Thermostat(SmartDevice):
+    __slots__ = ("_temperature",)
+
+    temperature = StateField("float64")
+
     # Initializes an instance of thermostat
     def __init__(self, device_id):
         super().__init__(device_id, "Thermostat")  # Initializes device type as 'Thermostat'
         self.temperature = 65  # Sets default temperature to 65 degrees
 
-    # Turns on the thermostat and prints the status
-    def turn_on(self):
-        super().turn_on()  # Turns thermostat on through SmartDevice method
-        # Prints status after turning thermostat on
-        print(f"{self.device_type} {self.device_id} turned on, temperature set to {self.temperature}°F")
+    # Turns on the thermostat and reports the status
+    def _turn_on(self, change):
+        super()._turn_on(change)  # Turns thermostat on through SmartDevice method
+        # Reports status after turning thermostat on
+        change.notice(f"{self.device_type} {self.device_id} turned on, temperature set to {self.temperature}°F")
 
-    # Turns off the thermostat and prints the status
-    def turn_off(self):
-        super().turn_off()  # Turns thermostat off through SmartDevice method
-        # Prints status after turning thermostat on
-        print(f"{self.device_type} {self.device_id} turned off")
+    # Turns off the thermostat and reports the status
+    def _turn_off(self, change):
+        super()._turn_off(change)  # Turns thermostat off through SmartDevice method
+        # Reports status after turning thermostat on
+        change.notice(f"{self.device_type} {self.device_id} turned off")
 
-    # Sets the thermostat temperature and prints the update
+    # Sets the thermostat temperature and reports the update
+    @command(coalesce=True)
     def set_temperature(self, temp):
-        with self.lock:  # Lock before changing temperature
+        with self.transition() as change:  # Lock before changing temperature
+            old = self.temperature
             self.temperature = temp  # Sets the new temperature
-            # Prints the updated temperature of the thermostat
-            print(f"{self.device_type} {self.device_id} temperature set to {self.temperature}°F")
+            # Reports the updated temperature of the thermostat
+            change.emit("temperature", old, self.temperature,
+                        f"{self.device_type} {self.device_id} temperature set to {self.temperature}°F")
 
 
 '''
@@ -119,35 +382,41 @@ Contract:
 
 
 class SecurityCamera(SmartDevice):
+    __slots__ = ("_motion_detected",)
+
+    motion_detected = StateField("bool")
+
     # Initializes an instance of SecurityCamera
     def __init__(self, device_id):
         super().__init__(device_id, "Security Camera")  # Initializes device type as 'Security Camera'
         self.motion_detected = False  # Initializes boolean to detect motion, false at first
 
-    # Turns on the security camera and prints the status
-    def turn_on(self):
-        with self.lock:  # Lock before changing status
-            self.status = "active"  # Sets camera status to 'active'
-            print(
-                f"{self.device_type} {self.device_id} activated")  # Prints the status after turning on the security camera
+    # Turns on the security camera and reports the status
+    def _turn_on(self, change):
+        old = self.status
+        self.status = STATUS_ACTIVE  # Sets camera status to 'active'
+        # Reports the status after turning on the security camera
+        change.emit("status", old, self.status, f"{self.device_type} {self.device_id} activated")
 
-    # Turns off the security camera and prints the status
-    def turn_off(self):
-        super().turn_off()  # Turns Security Camera off through SmartDevice method
-        print(
-            f"{self.device_type} {self.device_id} deactivated")  # Prints the status after turning off the security camera
+    # Turns off the security camera and reports the status
+    def _turn_off(self, change):
+        super()._turn_off(change)  # Turns Security Camera off through SmartDevice method
+        change.notice(f"{self.device_type} {self.device_id} deactivated")  # Reports the status after turning it off
 
-    # Detects motion and prints the result
+    # Detects motion and reports the result
+    @command()
     def detect_motion(self):
-        with self.lock:  # Lock before detecting motion
+        with self.transition() as change:  # Lock before detecting motion
+            old = self.motion_detected
             self.motion_detected = bool(
                 random.randint(0, 1))  # Randomly sets motion to True or False for accurate results
             # If motion is detected...
             if self.motion_detected:
-                print(f"{self.device_type} {self.device_id} detected motion")  # Print message that motion was detected
+                message = f"{self.device_type} {self.device_id} detected motion"  # Message that motion was detected
             else:
-                # If motion isn't detected, print message that motion was not detected
-                print(f"{self.device_type} {self.device_id} no motion detected")
+                # If motion isn't detected, message that motion was not detected
+                message = f"{self.device_type} {self.device_id} no motion detected"
+            change.emit("motion_detected", old, self.motion_detected, message)  # Reports the result
             return self.motion_detected  # Returns the result if motion was detected or not
 
 
@@ -162,36 +431,45 @@ Contract:
 
 
 class Television(SmartDevice):
+    __slots__ = ("_volume", "input_source")
+
+    volume = StateField("int16")
+
     # Initializes an instance of Television
     def __init__(self, device_id):
         super().__init__(device_id, "Television")  # Initializes device type as 'Television'
         self.volume = 30  # Initializes volume to 30
         self.input_source = "Cable"  # Initializes input source as 'Cable'
 
-    # Turns the TV on and prints the status
-    def turn_on(self):
-        super().turn_on()  # Turns TV on through SmartDevice method
-        # Prints the status of the TV after turning it on
-        print(f"{self.device_type} {self.device_id} turned on. Volume: {self.volume}, Source: {self.input_source}")
+    # Turns the TV on and reports the status
+    def _turn_on(self, change):
+        super()._turn_on(change)  # Turns TV on through SmartDevice method
+        # Reports the status of the TV after turning it on
+        change.notice(f"{self.device_type} {self.device_id} turned on. Volume: {self.volume}, Source: {self.input_source}")
 
-    # Turns off the TV and prints the status
-    def turn_off(self):
-        super().turn_off()  # Turns TV off through SmartDevice method
-        print(f"{self.device_type} {self.device_id} turned off")  # Prints the status of the TV after turning it off
+    # Turns off the TV and reports the status
+    def _turn_off(self, change):
+        super()._turn_off(change)  # Turns TV off through SmartDevice method
+        change.notice(f"{self.device_type} {self.device_id} turned off")  # Reports the status of the TV after turning it off
 
-    # Sets the volume of the TV and prints the updated volume
+    # Sets the volume of the TV and reports the updated volume
+    @command(coalesce=True)
     def set_volume(self, volume):
-        with self.lock:  # Lock before changing volume
+        with self.transition() as change:  # Lock before changing volume
+            old = self.volume
             self.volume = max(0, min(volume, 100))  # Ensures volume stays between 0 and 100
-            # Prints the volume status to the new value
-            print(f"{self.device_type} {self.device_id} volume set to {self.volume}")
+            # Reports the volume status to the new value
+            change.emit("volume", old, self.volume, f"{self.device_type} {self.device_id} volume set to {self.volume}")
 
-    # Changes the TV input source and prints the updated source
+    # Changes the TV input source and reports the updated source
+    @command()
     def change_source(self, source):
-        with self.lock:  # Lock before changing source
+        with self.transition() as change:  # Lock before changing source
+            old = self.input_source
             self.input_source = source  # Sets the new input source
-            # Prints the updated input source for the TV
-            print(f"{self.device_type} {self.device_id} input source changed to {self.input_source}")
+            # Reports the updated input source for the TV
+            change.emit("input_source", old, self.input_source,
+                        f"{self.device_type} {self.device_id} input source changed to {self.input_source}")
 
 
 '''
@@ -206,6 +484,12 @@ Contract:
 
 
 class Refrigerator(SmartDevice):
+    __slots__ = ("_refrigerator_temp", "_freezer_temp", "_door_open")
+
+    refrigerator_temp = StateField("float64")
+    freezer_temp = StateField("float64")
+    door_open = StateField("bool")
+
     # Initializes instance of Refrigerator
     def __init__(self, device_id):
         super().__init__(device_id, "Refrigerator")  # Initializes device type as 'Refrigerator'
@@ -213,40 +497,48 @@ class Refrigerator(SmartDevice):
         self.freezer_temp = 26  # Sets the freezer temperature to 26 degrees
         self.door_open = False  # Sets the door status to False indicating closed door
 
-    # Turns on the refrigerator and prints the status of it
-    def turn_on(self):
-        super().turn_on()  # Turns on refrigerator through SmartDevice method
-        # Prints the status of the refrigerator
-        print(
+    # Turns on the refrigerator and reports the status of it
+    def _turn_on(self, change):
+        super()._turn_on(change)  # Turns on refrigerator through SmartDevice method
+        # Reports the status of the refrigerator
+        change.notice(
             f"{self.device_type} {self.device_id} turned on. Refrigerator temp: {self.refrigerator_temp}°F, Freezer temp: {self.freezer_temp}°F")
 
-    # Turns off the refrigerator and prints the status of it
-    def turn_off(self):
-        super().turn_off()  # Turns off refrigerator through SmartDevice method
-        # Prints the status of turning it off
-        print(f"{self.device_type} {self.device_id} turned off")
+    # Turns off the refrigerator and reports the status of it
+    def _turn_off(self, change):
+        super()._turn_off(change)  # Turns off refrigerator through SmartDevice method
+        # Reports the status of turning it off
+        change.notice(f"{self.device_type} {self.device_id} turned off")
 
-    # Sets the temperature of the refrigerator and prints the updated temperature
+    # Sets the temperature of the refrigerator and reports the updated temperature
+    @command()
     def set_refrigerator_temp(self, temp):
-        with self.lock:  # Lock before changing temp
+        with self.transition() as change:  # Lock before changing temp
+            old = self.refrigerator_temp
             self.refrigerator_temp = temp  # Updates refrigerator temperature
-            # Prints the updated temperature that refrigerator was set to
-            print(f"{self.device_type} {self.device_id} refrigerator temperature set to {self.refrigerator_temp}°F")
+            # Reports the updated temperature that refrigerator was set to
+            change.emit("refrigerator_temp", old, self.refrigerator_temp,
+                        f"{self.device_type} {self.device_id} refrigerator temperature set to {self.refrigerator_temp}°F")
 
-    # Sets the temperature of the freezer and prints the updated temperature
+    # Sets the temperature of the freezer and reports the updated temperature
+    @command()
     def set_freezer_temp(self, temp):
-        with self.lock:  # Lock before changing temp
+        with self.transition() as change:  # Lock before changing temp
+            old = self.freezer_temp
             self.freezer_temp = temp  # Updates freezer temp
-            # Prints the updated temperature that the freezer was set to
-            print(f"{self.device_type} {self.device_id} freezer temperature set to {self.freezer_temp}°F")
+            # Reports the updated temperature that the freezer was set to
+            change.emit("freezer_temp", old, self.freezer_temp,
+                        f"{self.device_type} {self.device_id} freezer temperature set to {self.freezer_temp}°F")
 
-    # Change the status of the door and prints the status
+    # Change the status of the door and reports the status
+    @command()
     def door_status(self, is_open):
-        with self.lock:  # Lock before changing status
+        with self.transition() as change:  # Lock before changing status
+            old = self.door_open
             self.door_open = is_open  # Updates the door status
             status = "open" if self.door_open else "closed"  # Checks if the door is open or not
-            # Prints the status of the door
-            print(f"{self.device_type} {self.device_id} door is {status}")
+            # Reports the status of the door
+            change.emit("door_open", old, self.door_open, f"{self.device_type} {self.device_id} door is {status}")
 
 
 '''
@@ -259,29 +551,38 @@ Contract:
 
 
 class Lock(SmartDevice):
+    __slots__ = ("_is_locked",)
+
+    is_locked = StateField("bool")
+
     # Initializes instance of Lock
     def __init__(self, device_id):
         super().__init__(device_id, "Lock")  # Initializes device type as 'Lock'
         self.is_locked = True  # Default lock status is closed
 
-    # Locks the lock and prints the status
+    # Locks the lock and reports the status
+    @command("lock")
     def locked(self):
-        with self.lock:  # Lock before changing is_locked
+        with self.transition() as change:  # Lock before changing is_locked
+            old = self.is_locked
             self.is_locked = True  # Sets the lock to be 'Locked'
-            # Prints the status of the lock
-            print(f"{self.device_type} {self.device_id} is now locked.")
+            # Reports the status of the lock
+            change.emit("is_locked", old, self.is_locked, f"{self.device_type} {self.device_id} is now locked.")
 
-    # Unlocks the lock and prints the status
+    # Unlocks the lock and reports the status
+    @command("unlock")
     def unlocked(self):
-        with self.lock:  # Lock before changing is_locked
+        with self.transition() as change:  # Lock before changing is_locked
+            old = self.is_locked
             self.is_locked = False  # Sets the lock to be 'Unlocked'
-            # Prints the status of the lock
-            print(f"{self.device_type} {self.device_id} is now unlocked.")
+            # Reports the status of the lock
+            change.emit("is_locked", old, self.is_locked, f"{self.device_type} {self.device_id} is now unlocked.")
 
     # Returns the current lock status
+    @command(query=True)
     def get_lock_status(self):
-        with self.lock:  # Lock before operation
-            return "locked" if self.is_locked else "unlocked"  # Returns the lock status
+        is_locked, = self.read_fields("is_locked")  # Optimistic read, doesn't take the lock
+        return "locked" if is_locked else "unlocked"  # Returns the lock status
 
 
 '''
@@ -296,56 +597,74 @@ Contract:
 
 
 class AirPurifier(SmartDevice):
+    __slots__ = ("_purification_level", "_fan_speed")
+
+    purification_level = StateField("int8")
+    fan_speed = StateField("int8")
+
     # Initializes an instance of AirPurifier
     def __init__(self, device_id):
         super().__init__(device_id, "Air Purifier")  # Initializes device type as 'Air Purifier'
         self.purification_level = 0  # Initializes purification_level to 0
         self.fan_speed = 0  # Initializes fan_speed to 0
 
-    # Turns on the AirPurifier and prints the status of it
-    def turn_on(self):
+    # Turns on the AirPurifier and reports the status of it, level, fan speed and status change together
+    def _turn_on(self, change):
+        old_level, old_speed = self.purification_level, self.fan_speed
         self.purification_level = 1  # Sets purification_level to 1 after turning on
         self.fan_speed = 1  # Sets fan_speed to 1 after turning on
-        super().turn_on()  # Turns on the Air Purifier through SmartDevice method
-        # Prints the status of the air purifier
-        print(f"{self.device_id} turned on at purification level {self.purification_level} with fan speed {self.fan_speed}")
-
-    # Turns off the AirPurifier and prints the status of it
-    def turn_off(self):
+        change.emit("purification_level", old_level, self.purification_level)
+        change.emit("fan_speed", old_speed, self.fan_speed)
+        super()._turn_on(change)  # Turns on the Air Purifier through SmartDevice method
+        # Reports the status of the air purifier
+        change.notice(f"{self.device_id} turned on at purification level {self.purification_level} with fan speed {self.fan_speed}")
+
+    # Turns off the AirPurifier and reports the status of it
+    def _turn_off(self, change):
+        old_level, old_speed = self.purification_level, self.fan_speed
         self.purification_level = 0  # Sets purification_level to 0
         self.fan_speed = 0  # Sets the fan_speed to 0
-        super().turn_off()  # Turns off the Air Purifier through SmartDevice method
+        change.emit("purification_level", old_level, self.purification_level)
+        change.emit("fan_speed", old_speed, self.fan_speed)
+        super()._turn_off(change)  # Turns off the Air Purifier through SmartDevice method
 
-        # Prints the status of the air purifier
-        print(f"{self.device_id} turned off")
+        # Reports the status of the air purifier
+        change.notice(f"{self.device_id} turned off")
 
-    # Sets the purification level and prints the result of it
+    # Sets the purification level and reports the result of it
+    @command()
     def set_purification_level(self, level):
-        with self.lock:  # Lock before changing air_purification_level
+        with self.transition() as change:  # Lock before changing air_purification_level
+            old = self.purification_level
             self.purification_level = max(0, min(level, 3))  # Limited to 3 options for the air purifier
             # If the purification_level is greater than 0...
             if self.purification_level > 0:
-                self.status = "on"  # The status of it is on
+                old_status = self.status
+                self.status = STATUS_ON  # The status of it is on
+                change.emit("status", old_status, self.status)
 
-            # Prints the status of the updated purification level
-            print(f"{self.device_type} purification level set to {self.purification_level}")
+            # Reports the status of the updated purification level
+            change.emit("purification_level", old, self.purification_level,
+                        f"{self.device_type} purification level set to {self.purification_level}")
 
-    # Sets the fan speed and prints the result of it
+    # Sets the fan speed and reports the result of it
+    @command(coalesce=True)
     def set_fan_speed(self, speed):
-        with self.lock:  # Lock before changing fan speed
+        with self.transition() as change:  # Lock before changing fan speed
+            old = self.fan_speed
             self.fan_speed = max(0, min(speed, 3))  # Limited to 3 options for the fan speed
-            # Prints the status of the updated fan speed
-            print(f"{self.device_id} fan speed set to {self.fan_speed}")
+            # Reports the status of the updated fan speed
+            change.emit("fan_speed", old, self.fan_speed, f"{self.device_id} fan speed set to {self.fan_speed}")
 
     # Returns the purification status
+    @command(query=True)
     def get_purification_status(self):
-        with self.lock:  # Lock before operation
-            return self.purification_level  # Returns current purification level
+        return self.read_fields("purification_level")[0]  # Returns current purification level, without the lock
 
     # Returns the fan_speed status
+    @command(query=True)
     def get_fan_speed(self):
-        with self.lock:  # Lock before operation
-            return self.fan_speed  # Returns fan speed status
+        return self.read_fields("fan_speed")[0]  # Returns fan speed status, without the lock
 
 
 '''
@@ -357,21 +676,33 @@ Contract:
 
 
 class GarageDoor(SmartDevice):
+    __slots__ = ("_is_open",)
+
+    is_open = StateField("bool")
+
     # Initializes instance of GarageDoor
     def __init__(self, device_id):
         super().__init__(device_id, "Garage Door")  # Initializes device type as 'Garage Door'
         self.is_open = False  # Initializes garage door status as closed/false
 
-    # Opens the garage door and prints the status of it
+    # Opens the garage door and reports the status of it
+    @command()
     def open_door(self):
-        with self.lock:  # Lock before changing garage door status
+        with self.transition() as change:  # Lock before changing garage door status
+            old_open, old_status = self.is_open, self.status
             self.is_open = True  # Sets garage door status to true
-            self.status = "open"  # Sets the garage door status to 'open'
-            print(f"{self.device_type} {self.device_id} is now open.")  # Prints the status of the garage door
+            self.status = STATUS_OPEN  # Sets the garage door status to 'open'
+            change.emit("is_open", old_open, self.is_open)
+            # Reports the status of the garage door
+            change.emit("status", old_status, self.status, f"{self.device_type} {self.device_id} is now open.")
 
-    # Closes the garage door and prints the status of it
+    # Closes the garage door and reports the status of it
+    @command()
     def close_door(self):
-        with self.lock:  # Lock before changing garage door status
+        with self.transition() as change:  # Lock before changing garage door status
+            old_open, old_status = self.is_open, self.status
             self.is_open = False  # Sets the garage door status to false
-            self.status = "closed"  # Sets the garage door status to 'closed'
-            print(f"{self.device_type} {self.device_id} is now closed.")  # Prints the status of the garage door
+            self.status = STATUS_CLOSED  # Sets the garage door status to 'closed'
+            change.emit("is_open", old_open, self.is_open)
+            # Reports the status of the garage door
+            change.emit("status", old_status, self.status, f"{self.device_type} {self.device_id} is now closed.")
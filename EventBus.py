@@ -0,0 +1,226 @@
+from collections import deque
+import queue
+import sys
+import threading
+
+'''
+Purpose: Hold the events delivered to one subscriber of an EventBus, in a bounded buffer
+Contract:
+    - device_id, device_type and field filter the events (None matches anything), kinds lists the event kinds wanted
+    - policy decides what happens when the buffer is full:
+        "drop_oldest" drops the oldest buffered event, "drop_newest" drops the incoming event,
+        "coalesce" keeps only the latest event per (device_id, field), so a slow reader still sees current state
+    - dropped counts the events discarded by the policy
+    - get() waits for the next event, drain() returns every buffered event, close() unsubscribes
+'''
+
+
+class Subscription:
+    POLICIES = ("drop_oldest", "drop_newest", "coalesce")
+
+    # Initializes an instance of Subscription
+    def __init__(self, bus, device_id=None, device_type=None, field=None, kinds=("change",), maxsize=1024,
+                 policy="drop_oldest"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy '{policy}'")  # Message if the policy isn't supported
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.bus = bus  # Bus the subscription receives events from
+        self.device_id = device_id  # Only events of this device, None for every device
+        self.device_type = device_type  # Only events of devices of this type, None for every type
+        self.field = field  # Only changes of this field, None for every field
+        self.kinds = frozenset(kinds)  # Event kinds delivered, "change" and/or "notice"
+        self.maxsize = maxsize  # Maximum number of buffered events
+        self.policy = policy  # What to do when the buffer is full
+        # Coalesced events are keyed by (device_id, field), the other policies use a deque bounded to maxsize
+        self.buffer = {} if policy == "coalesce" else deque(maxlen=maxsize)
+        self.dropped = 0  # Events discarded because the buffer was full
+        self.closed = False
+        self.ready = threading.Condition(threading.Lock())  # Signals buffered events to get()
+
+    # Returns True if the event passes every filter
+    def matches(self, event):
+        return (event.kind in self.kinds
+                and (self.device_id is None or event.device_id == self.device_id)
+                and (self.device_type is None or event.device_type == self.device_type)
+                and (self.field is None or event.field == self.field))
+
+    # Buffers a batch of events according to the policy, called by the bus dispatcher
+    def offer(self, events):
+        with self.ready:
+            buffer = self.buffer
+            if self.policy == "coalesce":
+                for event in events:
+                    key = (event.device_id, event.field)
+                    if key in buffer:
+                        del buffer[key]  # Replaces the older event and moves the key to the back
+                        self.dropped += 1
+                    elif len(buffer) >= self.maxsize:
+                        del buffer[next(iter(buffer))]  # Full of distinct keys, the oldest one goes
+                        self.dropped += 1
+                    buffer[key] = event
+            else:
+                room = self.maxsize - len(buffer)
+                if len(events) > room:
+                    self.dropped += len(events) - room
+                    if self.policy == "drop_newest":
+                        events = events[:room]  # The events that don't fit are dropped
+                buffer.extend(events)  # The deque's maxlen drops the oldest events for "drop_oldest"
+            self.ready.notify_all()
+
+    # Waits for the next event and returns it, or returns None on timeout or once the subscription is closed
+    def get(self, timeout=None):
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.buffer or self.closed, timeout) or not self.buffer:
+                return None
+            if self.policy == "coalesce":
+                return self.buffer.pop(next(iter(self.buffer)))
+            return self.buffer.popleft()
+
+    # Returns every buffered event, oldest first, without waiting
+    def drain(self):
+        with self.ready:
+            events = list(self.buffer.values()) if self.policy == "coalesce" else list(self.buffer)
+            self.buffer.clear()
+            return events
+
+    # Unsubscribes and wakes any get() waiting on the subscription
+    def close(self):
+        self.bus.unsubscribe(self)
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+    # Closes the subscription at the end of a with block
+    def __enter__(self):
+        return self
+
+    # Closes the subscription at the end of a with block
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+'''
+Purpose: Publish device events to any number of filtered subscribers without slowing down the publishers
+Contract:
+    - publish() queues an event without taking a lock and returns immediately, or does nothing without subscribers
+    - a background dispatcher fans the events out to the matching subscriptions, so a command's cost doesn't
+      depend on the number of subscribers
+    - subscriptions are indexed by device_id, then field, then device_type, so the dispatcher only checks the
+      subscriptions that could match an event
+    - emit(), write() and flush() let the bus be used as an event sink
+'''
+
+
+class EventBus:
+    # Initializes an instance of EventBus, the dispatcher delivers up to max_batch events per pass
+    def __init__(self, max_batch=512):
+        self.max_batch = max_batch  # Maximum number of events the dispatcher takes from the queue at once
+        self.by_device = {}  # Dictionary with device_id as key and the list of subscriptions as value
+        self.by_field = {}  # Dictionary with field as key and the list of subscriptions as value
+        self.by_type = {}  # Dictionary with device_type as key and the list of subscriptions as value
+        self.everything = []  # Subscriptions without a device_id, field or device_type filter
+        self.count = 0  # Number of subscriptions, read without the lock by publish()
+        self.queue = queue.SimpleQueue()  # Events waiting for the dispatcher
+        self.dispatcher = None  # Dispatcher thread, started with the first subscription
+        self.lock = threading.Lock()  # Lock to keep subscribing and unsubscribing safe
+
+    # Subscribes to the events matching the filters, returns the Subscription to read them from
+    def subscribe(self, device_id=None, device_type=None, field=None, kinds=("change",), maxsize=1024,
+                  policy="drop_oldest"):
+        subscription = Subscription(self, device_id, device_type, field, kinds, maxsize, policy)
+        with self.lock:  # Lock before changing the subscriptions
+            index, key = self._bucket(subscription)
+            # Buckets are copied on write, so the dispatcher can iterate them without the lock
+            if key is None:
+                self.everything = self.everything + [subscription]
+            else:
+                index[key] = index.get(key, []) + [subscription]
+            self.count += 1
+            if self.dispatcher is None:
+                self.dispatcher = threading.Thread(target=self._run, name="SmartHome-event-bus", daemon=True)
+                self.dispatcher.start()
+        return subscription
+
+    # Removes a subscription from the bus
+    def unsubscribe(self, subscription):
+        with self.lock:  # Lock before changing the subscriptions
+            index, key = self._bucket(subscription)
+            if key is None:
+                if subscription in self.everything:
+                    self.everything = [s for s in self.everything if s is not subscription]
+                    self.count -= 1
+            elif subscription in index.get(key, ()):
+                remaining = [s for s in index[key] if s is not subscription]
+                if remaining:
+                    index[key] = remaining
+                else:
+                    del index[key]
+                self.count -= 1
+
+    # Returns the (index, key) a subscription is filed under, key is None for unfiltered subscriptions
+    def _bucket(self, subscription):
+        if subscription.device_id is not None:
+            return self.by_device, subscription.device_id  # The most selective filter
+        if subscription.field is not None:
+            return self.by_field, subscription.field
+        if subscription.device_type is not None:
+            return self.by_type, subscription.device_type
+        return None, None
+
+    # Queues an event for the dispatcher, does nothing if nobody is subscribed
+    def publish(self, event):
+        if self.count:
+            self.queue.put(event)
+
+    # Publishes an event, so the bus can be used as an event sink
+    def emit(self, event):
+        self.publish(event)
+
+    # Publishes a batch of events
+    def write(self, events):
+        for event in events:
+            self.publish(event)
+
+    # Waits until the events published so far have been delivered, returns True if that happened before the timeout
+    def flush(self, timeout=None):
+        if self.dispatcher is None:
+            return True  # Nothing was ever delivered in the background
+        marker = threading.Event()
+        self.queue.put(marker)  # Queued behind every event published so far
+        return marker.wait(timeout)
+
+    # Dispatcher loop, takes every queued event at once and hands each subscription its matching events
+    # in one offer() call, so a burst of events costs one lock acquisition per subscription
+    def _run(self):
+        while True:
+            events = [self.queue.get()]  # Waits for the first event of the batch
+            try:
+                while len(events) < self.max_batch:
+                    events.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            deliveries = {}  # Dictionary with subscription as key and its matching events as value
+            markers = []
+            for event in events:
+                if isinstance(event, threading.Event):
+                    markers.append(event)
+                    continue
+                # Each index lookup returns a bucket that is never modified in place, so no lock is needed
+                for candidates in (self.by_device.get(event.device_id, ()), self.by_field.get(event.field, ()),
+                                   self.by_type.get(event.device_type, ()), self.everything):
+                    for subscription in candidates:
+                        if subscription.matches(event):
+                            matched = deliveries.get(subscription)
+                            if matched is None:
+                                deliveries[subscription] = [event]
+                            else:
+                                matched.append(event)
+            for subscription, matched in deliveries.items():
+                try:
+                    subscription.offer(matched)
+                except Exception as error:
+                    # Keeps the dispatcher alive if a subscription fails
+                    print(f"Event bus delivery failed: {error!r}", file=sys.stderr)
+            for marker in markers:
+                marker.set()  # Flush marker, everything before it has been delivered
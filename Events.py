@@ -0,0 +1,221 @@
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+from collections import namedtuple
+
+'''
+Purpose: Describe a change made to a device, or a notice about it
+Contract:
+    - device_id and device_type identify the device
+    - kind is "change" when field went from old to new, or "notice" for messages without a state change
+    - timestamp is the wall clock time of the event, message is the human readable text or None
+'''
+
+DeviceEvent = namedtuple("DeviceEvent",
+                         ("device_id", "device_type", "kind", "field", "old", "new", "timestamp", "message"))
+
+
+'''
+Purpose: Sink that discards every event
+Contract:
+    - emit() and write() do nothing
+'''
+
+
+class NullSink:
+    # Discards the event
+    def emit(self, event):
+        pass
+
+    # Discards the events
+    def write(self, events):
+        pass
+
+    # Nothing is buffered, so there's nothing to flush
+    def flush(self, timeout=None):
+        return True
+
+
+'''
+Purpose: Sink that prints the message of each event to a stream
+Contract:
+    - emit() writes the message of one event, events without a message are skipped
+    - write() writes the messages of a batch of events with a single write call
+'''
+
+
+class StdoutSink:
+    # Initializes an instance of StdoutSink, writing to sys.stdout unless a stream is given
+    def __init__(self, stream=None):
+        self.stream = stream  # Stream the messages go to, None looks up sys.stdout on every write
+
+    # Writes the message of one event
+    def emit(self, event):
+        self.write((event,))
+
+    # Writes the messages of a batch of events
+    def write(self, events):
+        lines = [event.message for event in events if event.message is not None]
+        if lines:
+            stream = self.stream or sys.stdout  # Looked up late so redirected stdout is honoured
+            stream.write("\n".join(lines) + "\n")
+
+    # Flushes the stream
+    def flush(self, timeout=None):
+        (self.stream or sys.stdout).flush()
+        return True
+
+
+'''
+Purpose: Sink that appends every event to a file as one JSON object per line
+Contract:
+    - emit() appends one event, write() appends a batch of events
+    - close() closes the file
+'''
+
+
+class FileSink:
+    # Initializes an instance of FileSink, appending to the file at path
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")  # File the events are appended to
+        self.lock = threading.Lock()  # Lock to keep writes from different threads whole
+
+    # Appends one event
+    def emit(self, event):
+        self.write((event,))
+
+    # Appends a batch of events with a single write call
+    def write(self, events):
+        data = "".join(json.dumps(event._asdict(), default=str) + "\n" for event in events)
+        with self.lock:  # Lock before writing
+            self.file.write(data)
+
+    # Flushes the file
+    def flush(self, timeout=None):
+        with self.lock:  # Lock before flushing
+            self.file.flush()
+        return True
+
+    # Closes the file
+    def close(self):
+        with self.lock:  # Lock before closing
+            self.file.close()
+
+
+'''
+Purpose: Sink that queues events and writes them to another sink in batches on a background thread
+Contract:
+    - emit() queues an event without blocking and without taking a lock
+    - flush() waits until every queued event has been written to the target sink
+    - close() writes the remaining events and stops the background writer
+'''
+
+
+class BatchingSink:
+    # Initializes an instance of BatchingSink that writes to target in batches of up to max_batch events
+    def __init__(self, target, max_batch=512):
+        self.target = target  # Sink the batches are written to
+        self.max_batch = max_batch  # Maximum number of events per write
+        self.queue = queue.SimpleQueue()  # Unbounded queue whose put() doesn't take a Python level lock
+        self.writer = None  # Background writer thread, started with the first event
+        self.start_lock = threading.Lock()  # Lock to keep the writer from being started twice
+
+    # Queues an event for the background writer
+    def emit(self, event):
+        if self.writer is None:
+            self._start()
+        self.queue.put(event)
+
+    # Queues a batch of events for the background writer
+    def write(self, events):
+        for event in events:
+            self.emit(event)
+
+    # Starts the background writer if it isn't running yet
+    def _start(self):
+        with self.start_lock:  # Lock before starting the writer
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run, name="SmartHome-event-writer", daemon=True)
+                self.writer.start()
+
+    # Writer loop, blocks for the first event of a batch and then takes whatever else is already queued
+    # Flush markers (threading.Event) are set once everything queued before them has been written
+    def _run(self):
+        while True:
+            batch = []
+            markers = []
+            stop = False
+            item = self.queue.get()  # Waits for the first item of the batch
+            try:
+                while True:
+                    if item is None:
+                        stop = True  # Stop sentinel, writes what was taken so far and exits
+                        break
+                    elif isinstance(item, threading.Event):
+                        markers.append(item)
+                    else:
+                        batch.append(item)
+                        if len(batch) >= self.max_batch:
+                            break
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self.target.write(batch)
+                except Exception as error:
+                    # Keeps the writer alive if the target fails
+                    print(f"Event sink failed: {error!r}", file=sys.stderr)
+            for marker in markers:
+                marker.set()  # Everything queued before the marker has been written
+            if stop:
+                return
+
+    # Waits until the queued events have been written, returns True if that happened before the timeout
+    def flush(self, timeout=None):
+        if self.writer is None or not self.writer.is_alive():
+            return True  # Nothing is being written in the background
+        marker = threading.Event()
+        self.queue.put(marker)  # Queued behind every event emitted so far
+        done = marker.wait(timeout)
+        self.target.flush()
+        return done
+
+    # Writes the remaining events and stops the background writer
+    def close(self, timeout=None):
+        if self.writer is not None:
+            self.queue.put(None)  # Stop sentinel, queued behind the remaining events
+            self.writer.join(timeout)
+        self.target.flush()
+
+
+_default_sink = None  # Sink used by devices that don't have their own, created on first use
+_default_lock = threading.Lock()  # Lock to keep the default sink from being created twice
+
+
+# Returns the sink devices emit to by default, a batched stdout writer unless set_event_sink() changed it
+def get_event_sink():
+    global _default_sink
+    if _default_sink is None:
+        with _default_lock:  # Lock before creating the default sink
+            if _default_sink is None:
+                sink = BatchingSink(StdoutSink())
+                atexit.register(sink.flush, 5)  # Makes sure buffered messages still reach stdout at exit
+                _default_sink = sink
+    return _default_sink
+
+
+# Replaces the sink devices emit to by default and returns the previous one
+def set_event_sink(sink):
+    global _default_sink
+    with _default_lock:  # Lock before replacing the default sink
+        previous, _default_sink = _default_sink, sink
+    return previous
+
+
+# Builds a DeviceEvent stamped with the current time
+def make_event(device_id, device_type, kind, field, old, new, message):
+    return DeviceEvent(device_id, device_type, kind, field, old, new, time.time(), message)
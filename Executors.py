@@ -0,0 +1,367 @@
+import threading
+import queue
+import sys
+import time
+from collections import deque
+
+'''
+Purpose: Run device commands for the SmartHomeHub using one new thread per command
+Contract:
+    - submit() starts a new thread that runs the given function
+    - submit_many() starts a new thread for each (key, fn) pair
+    - submit_coalescing() is the same as submit(), each command already runs as soon as it is sent
+    - shutdown() waits for the started threads to finish
+    - pending() returns the number of threads that are still running
+'''
+
+
+class ThreadPerCommandExecutor:
+    # Initializes an instance of ThreadPerCommandExecutor
+    def __init__(self):
+        self.threads = []  # List to keep track of the threads that may still be running
+        self.lock = threading.Lock()  # Lock to keep modifications to the thread list safe
+        self.reap_threshold = 64  # Size the thread list may grow to before finished threads are pruned
+        self.accepting = True  # Flag that is cleared once the executor is shut down
+
+    # Starts a new thread running fn(*args), key is accepted for interface compatibility and ignored
+    def submit(self, key, fn, *args):
+        thread = threading.Thread(target=fn, args=args)  # Creates a new thread to run the function
+        with self.lock:  # Lock before changing the thread list
+            if not self.accepting:
+                raise RuntimeError("Executor has been shut down")  # No new work after shutdown
+            # Once the list reaches the threshold, prune the finished threads so it can't grow forever
+            if len(self.threads) >= self.reap_threshold:
+                self.threads[:] = [t for t in self.threads if t.is_alive()]
+                self.reap_threshold = max(64, 2 * len(self.threads))  # Amortizes the cost of pruning
+            self.threads.append(thread)  # Add the thread to the list of threads
+            thread.start()  # Started under the lock, so shutdown() never joins a thread that hasn't started
+
+    # Starts a new thread for each (key, fn) pair
+    def submit_many(self, items):
+        for key, fn in items:
+            self.submit(key, fn)
+
+    # Commands never wait in a queue here, so there's nothing to coalesce with
+    def submit_coalescing(self, key, tag, fn):
+        self.submit(key, fn)
+
+    # Lanes aren't used by this executor, so there's nothing to open
+    def open_lane(self, key):
+        pass
+
+    # Lanes aren't used by this executor, so there's nothing to close
+    def close_lane(self, key):
+        pass
+
+    # Returns the number of started threads that haven't finished yet
+    def pending(self):
+        with self.lock:  # Lock before reading the thread list
+            return sum(1 for t in self.threads if t.is_alive())
+
+    # Stops accepting work and joins the running threads, returns True if they all finished
+    def shutdown(self, drain=True, timeout=None):
+        with self.lock:  # Lock before changing the thread list
+            self.accepting = False  # Rejects any further submissions
+            threads = list(self.threads)  # Copy so the joins happen outside of the lock
+        # Threads can't be cancelled once started, so drain=False only skips waiting on them
+        if not drain:
+            return not any(t.is_alive() for t in threads)
+        deadline = None if timeout is None else time.monotonic() + timeout  # Shared deadline for all joins
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        with self.lock:  # Lock before pruning the thread list
+            self.threads[:] = [t for t in self.threads if t.is_alive()]
+            return not self.threads  # True if every thread has finished
+
+
+'''
+Purpose: Run device commands for the SmartHomeHub on a fixed-size pool of worker threads
+Contract:
+    - submit() places a function call on the bounded work queue, blocking while the queue is full
+    - submit_many() places each (key, fn) pair on the work queue in order
+    - submit_coalescing() is the same as submit(), the shared queue keeps no per device order to coalesce in
+    - shutdown() stops the workers, optionally draining the work that is still queued, a submission racing it
+      either lands before the stop sentinels or raises RuntimeError
+    - pending() returns the number of work items waiting in the queue
+    - a work item that raises is reported on stderr and its worker keeps running
+    - work discarded by shutdown(drain=False) is cancelled through its cancel() method, if it has one
+'''
+
+
+class WorkerPoolExecutor:
+    # Initializes an instance of WorkerPoolExecutor and starts its worker threads
+    def __init__(self, workers=4, queue_size=1024):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")  # A pool needs at least one worker
+        self.queue = queue.Queue(maxsize=queue_size)  # Bounded queue of (fn, args) work items
+        self.lock = threading.Lock()  # Lock to keep the accepting flag consistent with submissions
+        self.accepting = True  # Flag that is cleared once the executor is shut down
+        self.workers = []  # List of the worker threads
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker, name=f"SmartHomeHub-worker-{i}", daemon=True)
+            self.workers.append(worker)  # Keep track of the worker
+            worker.start()  # Start the worker
+
+    # Places fn(*args) on the work queue, key is accepted for interface compatibility and ignored
+    def submit(self, key, fn, *args):
+        with self.lock:  # Lock so the work can't be queued behind the stop sentinels of shutdown()
+            if not self.accepting:
+                raise RuntimeError("Executor has been shut down")  # No new work after shutdown
+            self.queue.put((fn, args))  # Blocks while the queue is full, which applies backpressure to callers
+
+    # Places each (key, fn) pair on the work queue in order
+    def submit_many(self, items):
+        with self.lock:  # Lock so the work can't be queued behind the stop sentinels of shutdown()
+            if not self.accepting:
+                raise RuntimeError("Executor has been shut down")  # No new work after shutdown
+            put = self.queue.put
+            for key, fn in items:
+                put((fn, ()))
+
+    # The shared queue doesn't keep commands in per device order, so commands are queued as they are
+    def submit_coalescing(self, key, tag, fn):
+        self.submit(key, fn)
+
+    # Lanes aren't used by this executor, so there's nothing to open
+    def open_lane(self, key):
+        pass
+
+    # Lanes aren't used by this executor, so there's nothing to close
+    def close_lane(self, key):
+        pass
+
+    # Returns the number of work items waiting in the queue
+    def pending(self):
+        return self.queue.qsize()
+
+    # Worker loop that runs queued work items until it receives the stop sentinel
+    def _worker(self):
+        while True:
+            item = self.queue.get()  # Waits for the next work item
+            if item is None:
+                return  # Stop sentinel, the worker exits
+            fn, args = item
+            try:
+                fn(*args)  # Runs the work item
+            except Exception as error:
+                # Keeps the worker alive if a command fails
+                print(f"Command failed in worker: {error!r}", file=sys.stderr)
+
+    # Stops the workers, returns True if every worker finished before the timeout
+    def shutdown(self, drain=True, timeout=None):
+        with self.lock:  # Lock before changing the accepting flag
+            if self.accepting:
+                self.accepting = False  # Rejects any further submissions
+                # Without draining, discard the work that hasn't started yet
+                if not drain:
+                    try:
+                        while True:
+                            _cancel(self.queue.get_nowait()[0])
+                    except queue.Empty:
+                        pass
+                # One stop sentinel per worker, queued behind any work that is being drained
+                for _ in self.workers:
+                    self.queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout  # Shared deadline for all joins
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(worker.is_alive() for worker in self.workers)  # True if all the workers exited
+
+
+'''
+Purpose: Hold the FIFO mailbox of commands for a single device lane
+Contract:
+    - mailbox holds the (fn, args) work items that haven't run yet, in submission order,
+      coalescible items are [fn, args, tag] lists so a newer command can take their place
+    - coalescible maps the tag of each coalescible item queued after the last other command to its item
+    - scheduled is True while a drain of this lane is queued or running on the pool
+'''
+
+
+class _Lane:
+    __slots__ = ("key", "mailbox", "coalescible", "scheduled", "lock")
+
+    # Initializes an instance of _Lane
+    def __init__(self, key):
+        self.key = key  # Key of the device that owns the lane
+        self.mailbox = deque()  # FIFO queue of work items for the device
+        self.coalescible = {}  # Dictionary with tag as key and the queued item a newer command may replace as value
+        self.scheduled = False  # Whether a drain of this lane is on the pool
+        self.lock = threading.Lock()  # Lock to keep mailbox and scheduled flag changes safe
+
+
+'''
+Purpose: Run device commands in per-device FIFO lanes that share a fixed-size pool of workers
+Contract:
+    - submit() appends a function call to the lane for key, commands in one lane run in submission order
+    - submit_many() appends each (key, fn) pair to its lane, taking each lane lock once per batch
+    - submit_coalescing() replaces the command with the same tag that is still queued in the lane, unless another
+      command was queued after it, so commands that aren't coalesced keep their order relative to the others
+      the new fn takes over the replaced one through fn.coalesce(replaced)
+    - open_lane() creates the lane for a key ahead of its first command
+    - close_lane() forgets the lane for a key once its queued commands have run
+    - shutdown() stops the workers, optionally draining the commands still queued in the lanes, a submission
+      racing it is either rejected with RuntimeError or counted before shutdown() waits, so it still runs
+    - pending() returns the number of commands that were submitted and haven't finished
+    - a command that raises is reported on stderr and its lane keeps draining
+    - work discarded by shutdown(drain=False) is cancelled through its cancel() method, if it has one
+'''
+
+
+class DeviceLaneExecutor:
+    # Initializes an instance of DeviceLaneExecutor
+    # batch is the number of commands a worker runs from one lane before giving other lanes a turn
+    def __init__(self, workers=4, batch=32):
+        # Pool that runs lane drains, at most one per lane is queued so the queue is left unbounded
+        self.pool = WorkerPoolExecutor(workers, queue_size=0)
+        self.lanes = {}  # Dictionary of lanes with the device key as key and lane as value
+        self.lock = threading.Lock()  # Lock to keep lane creation and removal safe
+        self.batch = batch  # Number of commands run per drain before the lane is requeued
+        self.idle = threading.Condition()  # Condition notified whenever the last outstanding command finishes
+        self.outstanding = 0  # Number of submitted commands that haven't finished yet
+        self.accepting = True  # Flag that is cleared once the executor is shut down
+
+    # Creates the lane for key if it doesn't exist yet and returns it
+    def open_lane(self, key):
+        lane = self.lanes.get(key)  # Lock free lookup, lanes are only created under the lock
+        if lane is None:
+            with self.lock:  # Lock before creating the lane
+                lane = self.lanes.get(key)
+                if lane is None:
+                    lane = _Lane(key)
+                    self.lanes[key] = lane  # Registers the new lane
+        return lane
+
+    # Forgets the lane for key, commands already queued in it still run
+    def close_lane(self, key):
+        with self.lock:  # Lock before removing the lane
+            self.lanes.pop(key, None)
+
+    # Appends fn(*args) to the lane for key and schedules the lane on the pool if it isn't already
+    def submit(self, key, fn, *args):
+        with self.idle:  # Lock so the check and the count can't race shutdown(), which waits for the count
+            if not self.accepting:
+                raise RuntimeError("Executor has been shut down")  # No new work after shutdown
+            self.outstanding += 1
+        lane = self.open_lane(key)  # Lane that keeps the commands for key in order
+        with lane.lock:  # Lock before changing the mailbox
+            lane.mailbox.append((fn, args))  # Queues the command behind the earlier ones for key
+            if lane.coalescible:
+                lane.coalescible.clear()  # Queued commands can't be replaced past this one
+            schedule = not lane.scheduled  # Only one drain per lane so a single worker touches the device
+            lane.scheduled = True
+        if schedule:
+            self.pool.submit(key, self._drain, lane)  # Hands the lane to the shared pool
+
+    # Replaces the queued command with the same tag in the lane for key with fn, or appends fn like submit()
+    def submit_coalescing(self, key, tag, fn):
+        with self.idle:  # Lock so the check and the count can't race shutdown(), which waits for the count
+            if not self.accepting:
+                raise RuntimeError("Executor has been shut down")  # No new work after shutdown
+            self.outstanding += 1
+        lane = self.open_lane(key)
+        with lane.lock:  # Lock before changing the mailbox
+            item = lane.coalescible.get(tag)
+            if item is None:
+                item = [fn, (), tag]
+                lane.coalescible[tag] = item  # Newer commands with the tag replace this one until it starts
+                lane.mailbox.append(item)
+                schedule = not lane.scheduled
+                lane.scheduled = True
+            else:
+                # The replaced command hasn't started and nothing was queued behind it, last writer wins
+                fn.coalesce(item[0])
+                item[0] = fn
+                schedule = None
+        if schedule is None:
+            self._finished(1)  # Took the place of a queued command, so the count is unchanged
+        elif schedule:
+            self.pool.submit(key, self._drain, lane)  # Hands the lane to the shared pool
+
+    # Appends each (key, fn) pair to its lane, keeping the order of the pairs within each lane
+    def submit_many(self, items):
+        grouped = {}  # Dictionary with the key as key and the list of functions for its lane as value
+        for key, fn in items:
+            grouped.setdefault(key, []).append((fn, ()))
+        with self.idle:  # Lock once to check and count every command, so they can't race shutdown()
+            if not self.accepting:
+                raise RuntimeError("Executor has been shut down")  # No new work after shutdown
+            self.outstanding += sum(len(work) for work in grouped.values())
+        for key, work in grouped.items():
+            lane = self.open_lane(key)
+            with lane.lock:  # Lock once per lane before changing the mailbox
+                lane.mailbox.extend(work)
+                if lane.coalescible:
+                    lane.coalescible.clear()  # Queued commands can't be replaced past these ones
+                schedule = not lane.scheduled
+                lane.scheduled = True
+            if schedule:
+                self.pool.submit(key, self._drain, lane)  # Hands the lane to the shared pool
+
+    # Returns the number of commands that were submitted and haven't finished
+    def pending(self):
+        with self.idle:  # Lock before reading the counter
+            return self.outstanding
+
+    # Runs up to batch commands from the lane, then requeues the lane if it still has work
+    def _drain(self, lane):
+        for _ in range(self.batch):
+            with lane.lock:  # Lock before taking from the mailbox
+                if not lane.mailbox:
+                    lane.scheduled = False  # The lane is empty, the next submit schedules it again
+                    return
+                item = lane.mailbox.popleft()  # Oldest command for the device
+                fn, args = item[0], item[1]
+                if len(item) == 3 and lane.coalescible.get(item[2]) is item:
+                    del lane.coalescible[item[2]]  # Started, so newer commands with the tag queue behind it
+            try:
+                fn(*args)  # Runs the command
+            except Exception as error:
+                # Keeps the lane draining if a command fails
+                print(f"Command failed in lane {lane.key}: {error!r}", file=sys.stderr)
+            finally:
+                self._finished(1)
+        with lane.lock:  # Lock before checking the mailbox
+            if not lane.mailbox:
+                lane.scheduled = False  # The lane is empty, the next submit schedules it again
+                return
+        self.pool.submit(lane.key, self._drain, lane)  # Lets other lanes run before continuing this one
+
+    # Marks count commands as finished and wakes up shutdown() if nothing is left
+    def _finished(self, count):
+        with self.idle:  # Lock before changing the counter
+            self.outstanding -= count
+            if self.outstanding == 0:
+                self.idle.notify_all()
+
+    # Stops the executor, returns True if every command finished and the workers exited before the timeout
+    def shutdown(self, drain=True, timeout=None):
+        with self.idle:  # Lock so every accepted command is counted, and waited for below
+            self.accepting = False  # Rejects any further submissions
+        # Without draining, discard the commands that haven't started yet
+        if not drain:
+            with self.lock:  # Lock before reading the lanes
+                lanes = list(self.lanes.values())
+            for lane in lanes:
+                with lane.lock:  # Lock before clearing the mailbox
+                    dropped = len(lane.mailbox)
+                    for item in lane.mailbox:
+                        _cancel(item[0])
+                    lane.mailbox.clear()
+                    lane.coalescible.clear()
+                if dropped:
+                    self._finished(dropped)  # Counts the discarded commands as finished
+        deadline = None if timeout is None else time.monotonic() + timeout  # Shared deadline for the waits
+        with self.idle:  # Waits for the lanes to empty before stopping the pool
+            if not self.idle.wait_for(lambda: self.outstanding == 0,
+                                      None if deadline is None else max(0, deadline - time.monotonic())):
+                return False
+        return self.pool.shutdown(drain=True,
+                                  timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+# Cancels a discarded work item if it supports cancellation
+def _cancel(fn):
+    cancel = getattr(fn, "cancel", None)
+    if cancel is not None:
+        cancel()
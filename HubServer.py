@@ -0,0 +1,564 @@
+from Commands import registry, DeviceNotFoundError, UnsupportedCommandError
+from Admission import AdmissionError, HubOverloadedError, RateLimitedError, CommandDroppedError
+from ShardedHub import shard_for
+from CommandCodec import CommandEncoder, CommandDecoder, encode_value, decode_value
+from concurrent.futures import Future
+from functools import partial
+import os
+import socket
+import struct
+import sys
+import threading
+
+'''
+Hub protocol:
+    messages travel in frames: u32 little-endian payload length, then the payload, which holds every message
+    the sender had ready back to back, each message starts with a u8 kind, a payload holds at most 16 MB,
+    more messages go in several frames and a result that can't fit in one is answered with an ERROR
+    requests:   a CommandCodec COMMAND record sends a command, the connection is one CommandCodec stream,
+                so the DEVICE, OPCODE and SHAPE definitions it needs come before it
+                STATUS (16)     device_id as a CommandCodec value
+                QUERY (17)      device_type and the {field: value} conditions as CommandCodec values, a (low, high)
+                                range condition travels as a two element list
+    responses:  RESULT (18)     u32 request number, then the result as a CommandCodec value
+                ERROR (19)      u32 request number, then the exception class name and message as CommandCodec values
+Requests are numbered from 0 in the order they are sent on a connection, definitions don't count. A client may
+send any number of requests without waiting for their responses, responses carry the number of their request
+and may come back in a different order than the requests were sent.
+'''
+
+_STATUS = 16
+_QUERY = 17
+_RESULT = 18
+_ERROR = 19
+_RESPONSE = struct.Struct("<BI")  # Kind, request number
+
+_FRAME = struct.Struct("<I")  # Payload length
+_MAX_FRAME = 16 * 1024 * 1024  # Largest payload accepted, protects the server from a corrupt length
+_ERRORS = {cls.__name__: cls for cls in (DeviceNotFoundError, UnsupportedCommandError, AdmissionError,
+                                         HubOverloadedError, RateLimitedError, CommandDroppedError,
+                                         TypeError, ValueError)}  # Exceptions rebuilt on the client side
+
+
+'''
+Purpose: Report a failure on the server that has no matching exception class on the client
+'''
+
+
+class RemoteCommandError(RuntimeError):
+    pass
+
+
+# Creates a socket for address, a path string for a Unix domain socket or a (host, port) pair for TCP
+def _socket_for(address):
+    if isinstance(address, (str, bytes, os.PathLike)):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Small frames shouldn't wait for Nagle
+    return sock
+
+
+# Joins encoded messages into one frame
+def _encode_frame(messages):
+    payload = b"".join(messages)
+    return _FRAME.pack(len(payload)) + payload
+
+
+# Joins encoded messages into as few frames as hold them without going over _MAX_FRAME bytes of payload
+def _encode_frames(messages):
+    if sum(map(len, messages)) <= _MAX_FRAME:
+        return _encode_frame(messages)  # The usual case, one frame for the whole batch
+    frames = []
+    run, size = [], 0  # Messages of the frame being filled and their length
+    for message in messages:
+        if run and size + len(message) > _MAX_FRAME:
+            frames.append(_encode_frame(run))
+            run, size = [], 0
+        run.append(message)
+        size += len(message)
+    frames.append(_encode_frame(run))
+    return b"".join(frames)
+
+
+# Returns the RESULT response of a request, raises ValueError if it wouldn't fit in a frame
+def _result(request_id, result):
+    encoded = encode_value(result)
+    if len(encoded) > _MAX_FRAME - _RESPONSE.size:
+        raise ValueError(f"The result of {len(encoded)} bytes doesn't fit in a frame")
+    return _RESPONSE.pack(_RESULT, request_id) + encoded
+
+
+# Returns the ERROR response of a request
+def _error(request_id, error):
+    # str() of a KeyError, like DeviceNotFoundError, quotes its key, so the key itself is the message
+    message = str(error.args[0]) if isinstance(error, KeyError) and error.args else str(error)
+    return _RESPONSE.pack(_ERROR, request_id) + encode_value(type(error).__name__) + encode_value(message)
+
+
+'''
+Purpose: Read frames from a socket, taking as many as one recv() returns at a time
+Contract:
+    - read() waits for data and returns the payloads of the whole frames received so far, or None once the
+      peer closed
+'''
+
+
+class _FrameReader:
+    __slots__ = ("sock", "buffer")
+
+    # Initializes an instance of _FrameReader for sock
+    def __init__(self, sock):
+        self.sock = sock  # Socket the frames come from
+        self.buffer = bytearray()  # Bytes received that don't make a whole frame yet
+
+    # Returns the payloads of the whole frames received so far, waiting for data if there are none
+    def read(self):
+        while True:
+            data = self.sock.recv(256 * 1024)
+            if not data:
+                return None  # The peer closed the connection
+            self.buffer += data
+            payloads = []
+            position = 0
+            with memoryview(self.buffer) as view:  # Released before the buffer is resized
+                while position + _FRAME.size <= len(view):
+                    length, = _FRAME.unpack_from(view, position)
+                    if length > _MAX_FRAME:
+                        raise ValueError(f"Frame of {length} bytes is too large")
+                    end = position + _FRAME.size + length
+                    if end > len(view):
+                        break  # The rest of the frame hasn't arrived yet
+                    payloads.append(bytes(view[position + _FRAME.size:end]))
+                    position = end
+            del self.buffer[:position]
+            if payloads:
+                return payloads
+
+
+'''
+Purpose: Serve a SmartHomeHub to other processes over a Unix domain socket or loopback TCP
+Contract:
+    - start() listens on address and returns the address served, port 0 picks a free TCP port
+    - each connection has a reader thread that runs the requests as they arrive, without waiting for earlier
+      ones to finish, and a writer thread that sends the responses finished meanwhile as one write
+    - commands go through hub.send_command(), so executors, admission control, journaling and metrics apply,
+      with direct=True non-blocking commands run on the connection's reader thread instead, which skips the
+      executor and its Future, commands of one connection then run in the order they were sent;
+      direct is ignored for hubs with a journal or an admission controller, which need the normal path
+    - close() stops accepting connections and closes the open ones
+'''
+
+
+class HubServer:
+    # Initializes an instance of HubServer for hub
+    def __init__(self, hub, address, direct=False, backlog=128):
+        self.hub = hub  # Hub the requests are run on
+        self.address = address  # Path of a Unix domain socket, or a (host, port) pair
+        self.direct = direct and hub.journal is None and hub.admission is None  # Whether commands run inline
+        self.backlog = backlog  # Connections the kernel queues before they are accepted
+        self.listener = None  # Listening socket, None until start()
+        self.connections = set()  # Open connection sockets
+        self.lock = threading.Lock()  # Lock to keep the set of connections safe
+        self.closed = False
+
+    # Starts listening and accepting connections in the background, returns the address served
+    def start(self):
+        self.listener = _socket_for(self.address)
+        if self.listener.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)  # Left behind by a server that didn't shut down cleanly
+        if self.listener.family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(self.address)
+        self.listener.listen(self.backlog)
+        self.address = self.listener.getsockname()  # Resolves port 0 to the port picked
+        threading.Thread(target=self._accept, name="SmartHome-server", daemon=True).start()
+        return self.address
+
+    # Accept loop, starts a connection handler for every client
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return  # The listener was closed
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                if self.closed:
+                    sock.close()
+                    return
+                self.connections.add(sock)
+            threading.Thread(target=self._serve, args=(sock,), name="SmartHome-server-connection",
+                             daemon=True).start()
+
+    # Connection loop, runs the requests of every frame batch and hands the responses to the writer
+    def _serve(self, sock):
+        outbox = []  # Responses waiting for the writer
+        ready = threading.Condition()  # Signals responses to the writer
+        state = {"open": True}
+
+        # Queues a response for the writer
+        def respond(response):
+            with ready:
+                outbox.append(response)
+                if len(outbox) == 1:
+                    ready.notify()
+
+        # Writer loop, sends every response queued since the last write with one sendall()
+        def write():
+            while True:
+                with ready:
+                    ready.wait_for(lambda: outbox or not state["open"])
+                    if not outbox:
+                        return
+                    batch = outbox[:]
+                    outbox.clear()
+                try:
+                    sock.sendall(_encode_frames(batch))
+                except OSError as error:
+                    print(f"Hub server connection failed: {error!r}", file=sys.stderr)
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)  # Closes the connection, so the client fails its requests
+                    except OSError:
+                        pass
+                    return
+
+        writer = threading.Thread(target=write, name="SmartHome-server-writer", daemon=True)
+        writer.start()
+        reader = _FrameReader(sock)
+        decoder = CommandDecoder()  # Follows the connection's stream of definitions
+        request_id = 0  # Number of the next request
+        try:
+            while True:
+                payloads = reader.read()
+                if payloads is None:
+                    break
+                for payload in payloads:
+                    with memoryview(payload) as view:
+                        offset = 0
+                        while offset < len(view):
+                            kind = view[offset]
+                            if kind == _STATUS:
+                                device_id, offset = decode_value(view, offset + 1)
+                                self._run(request_id, _STATUS, device_id, respond)
+                            elif kind == _QUERY:
+                                device_type, offset = decode_value(view, offset + 1)
+                                conditions, offset = decode_value(view, offset)
+                                self._run(request_id, _QUERY, (device_type, conditions), respond)
+                            else:
+                                command, offset = decoder.read(view, offset)
+                                if command is None:
+                                    continue  # A definition, not a request
+                                self._run(request_id, kind, command, respond)
+                            request_id += 1
+        except (OSError, ValueError) as error:
+            print(f"Hub server connection failed: {error!r}", file=sys.stderr)
+        finally:
+            with ready:
+                state["open"] = False  # The writer sends what is queued, then exits
+                ready.notify()
+            writer.join()
+            with self.lock:
+                self.connections.discard(sock)
+            sock.close()
+
+    # Runs one request and responds to it now, or once its command finishes
+    # fields are the (device_id, command, args) of a command, the device_id of a status request
+    # or the (device_type, conditions) of a query
+    def _run(self, request_id, kind, fields, respond):
+        try:
+            if kind == _STATUS:
+                result = self.hub.get_device_status(fields)
+            elif kind == _QUERY:
+                # Ranges arrive as JSON lists, a list can't be an equality condition, so each is a (low, high) range
+                conditions = {field: tuple(condition) if isinstance(condition, list) else condition
+                              for field, condition in fields[1].items()}
+                result = [device.device_id for device in self.hub.query(fields[0], **conditions)]
+            else:
+                device_id, command, args = fields
+                if self.direct:
+                    device = self.hub.devices.get(device_id)
+                    spec = None if device is None else registry.resolve(type(device), command)
+                    if spec is not None and not spec.blocking:
+                        respond(_result(request_id, self.hub.execute_device_command(device, command, *args)))
+                        return
+                future = self.hub.send_command(device_id, command, *args)
+                future.add_done_callback(partial(_respond, request_id, respond))
+                return
+            respond(_result(request_id, result))
+        except Exception as error:
+            respond(_error(request_id, error))
+
+    # Stops accepting connections and closes the open ones
+    def close(self):
+        with self.lock:
+            self.closed = True
+            connections = list(self.connections)
+        if self.listener is not None:
+            self.listener.close()
+            if self.listener.family == socket.AF_UNIX and isinstance(self.address, str):
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)  # Wakes the reader thread of the connection
+            except OSError:
+                pass
+
+
+# Builds the response of a request from its finished Future
+def _response(request_id, future):
+    error = future.exception()
+    if error is not None:
+        return _error(request_id, error)
+    return _result(request_id, future.result())
+
+
+# Done callback of a command's Future, responds to its request even if the result can't be encoded
+def _respond(request_id, respond, future):
+    try:
+        response = _response(request_id, future)
+    except Exception as error:
+        response = _error(request_id, error)  # e.g. a result CommandCodec has no type for
+    respond(response)
+
+
+# Returns a STATUS request
+def _encode_status(device_id):
+    return bytes((_STATUS,)) + encode_value(device_id)
+
+
+# Returns a QUERY request
+def _encode_query(device_type, conditions):
+    return bytes((_QUERY,)) + encode_value(device_type) + encode_value(conditions)
+
+
+'''
+Purpose: Connection to a HubServer that pipelines requests
+Contract:
+    - send_command() and the other requests return without waiting for earlier requests to be answered,
+      send_command() returns a Future, get_device_status() and query() wait for their answer
+    - a sender thread writes every request queued while the previous write was in progress with one sendall(),
+      a receiver thread resolves the Futures as the responses arrive
+    - failures on the server are raised as the matching exception class, or as RemoteCommandError
+    - close() closes the connection and fails the Futures still waiting with ConnectionError
+'''
+
+
+class HubClient:
+    # Initializes an instance of HubClient and connects to address
+    def __init__(self, address, timeout=None):
+        self.sock = _socket_for(address)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.sock.settimeout(None)  # The receiver waits for responses as long as the connection is open
+        self.outgoing = []  # Encoded requests waiting for the sender
+        self.encoder = CommandEncoder()  # Encodes the commands, the connection is one stream of definitions
+        self.pending = {}  # Dictionary with request_id as key and the Future of its response as value
+        self.next_id = 0
+        self.closed = False
+        self.lock = threading.Lock()  # Lock to keep request ids, outgoing and pending consistent
+        self.ready = threading.Condition(self.lock)  # Signals queued requests to the sender
+        self.sender = threading.Thread(target=self._send, name="SmartHome-client-sender", daemon=True)
+        self.receiver = threading.Thread(target=self._receive, name="SmartHome-client-receiver", daemon=True)
+        self.sender.start()
+        self.receiver.start()
+
+    # Queues a request, encoded by encode() under the lock so requests are numbered in the order they are sent
+    # Returns the Future of its response
+    def _request(self, encode, *fields):
+        future = Future()
+        with self.lock:  # Lock before numbering the request
+            if self.closed:
+                raise ConnectionError("The client is closed")
+            self.outgoing.append(encode(*fields))
+            self.pending[self.next_id] = future
+            self.next_id += 1
+            if len(self.outgoing) == 1:
+                self.ready.notify()  # Wakes the sender for the first request of a batch
+        return future
+
+    # Sends a command to a device on the server, returns a Future holding the command's result
+    def send_command(self, device_id, command, *args):
+        return self._request(self.encoder.encode, device_id, command, args)
+
+    # Sends a batch of (device_id, command, args) commands under one lock acquisition, returns their Futures
+    def send_commands(self, commands):
+        futures = []
+        with self.lock:  # Lock once for the whole batch
+            if self.closed:
+                raise ConnectionError("The client is closed")
+            notify = not self.outgoing
+            encode = self.encoder.encode
+            for entry in commands:
+                future = Future()
+                futures.append(future)
+                try:
+                    self.outgoing.append(encode(entry[0], entry[1], tuple(entry[2]) if len(entry) > 2 else ()))
+                except Exception as error:
+                    future.set_exception(error)  # Not sent, and defines nothing, like in SmartHomeHub.send_commands()
+                    continue
+                self.pending[self.next_id] = future
+                self.next_id += 1
+            if notify and self.outgoing:
+                self.ready.notify()
+        return futures
+
+    # Returns the status of a device on the server, or None if it doesn't exist
+    def get_device_status(self, device_id, timeout=None):
+        return self._request(_encode_status, device_id).result(timeout)
+
+    # Returns the ids of the server's devices matching device_type and the indexed field conditions
+    def query(self, device_type=None, timeout=None, **conditions):
+        return self._request(_encode_query, device_type, conditions).result(timeout)
+
+    # Sender loop, writes everything queued since the last write with one sendall()
+    def _send(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.outgoing or self.closed)
+                if self.closed:
+                    return
+                batch, self.outgoing = self.outgoing, []
+            try:
+                self.sock.sendall(_encode_frames(batch))
+            except OSError as error:
+                self._fail(error)
+                return
+
+    # Receiver loop, resolves the Future of every response
+    def _receive(self):
+        reader = _FrameReader(self.sock)
+        while True:
+            try:
+                payloads = reader.read()
+                if payloads is None:
+                    self._fail(ConnectionError("The server closed the connection"))
+                    return
+                responses = []  # (request number, result or None, exception or None) of every response
+                for payload in payloads:
+                    with memoryview(payload) as view:
+                        offset = 0
+                        while offset < len(view):
+                            kind, request_id = _RESPONSE.unpack_from(view, offset)
+                            value, offset = decode_value(view, offset + _RESPONSE.size)
+                            if kind == _RESULT:
+                                responses.append((request_id, value, None))
+                            elif kind == _ERROR:
+                                message, offset = decode_value(view, offset)
+                                responses.append((request_id, None, _ERRORS.get(value, RemoteCommandError)(message)))
+                            else:
+                                raise ValueError(f"Unknown response kind {kind}")
+            except (OSError, ValueError, struct.error) as error:
+                self._fail(error)
+                return
+            with self.lock:  # Lock once per batch before taking the Futures
+                futures = [self.pending.pop(response[0], None) for response in responses]
+            for future, (_, result, error) in zip(futures, responses):
+                if future is None:
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    # Fails every Future still waiting for a response
+    def _fail(self, error):
+        with self.lock:
+            self.closed = True
+            futures, self.pending = list(self.pending.values()), {}
+            self.ready.notify()
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection to the hub lost: {error!r}"))
+
+    # Closes the connection, requests still waiting for a response fail
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.receiver.join()
+        self.sender.join()
+        self.sock.close()
+
+    # Closes the client at the end of a with block
+    def __enter__(self):
+        return self
+
+    # Closes the client at the end of a with block
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+'''
+Purpose: Share a few pipelined connections to a HubServer between any number of threads
+Contract:
+    - the commands of a device always use the same connection, picked by shard_for(device_id, size),
+      so they reach the server in the order they were sent
+    - connections are opened on first use and replaced once they fail
+    - send_command(), send_commands(), get_device_status() and query() work like HubClient's
+'''
+
+
+class ClientPool:
+    # Initializes an instance of ClientPool with up to size connections to address
+    def __init__(self, address, size=4, timeout=None):
+        self.address = address  # Address of the HubServer
+        self.timeout = timeout  # Connect timeout of each connection
+        self.clients = [None] * size  # Connections, None until first used
+        self.lock = threading.Lock()  # Lock to keep connections from being opened twice
+
+    # Returns the open connection at index, opening it if needed
+    def _client(self, index):
+        client = self.clients[index]
+        if client is None or client.closed:
+            with self.lock:
+                client = self.clients[index]
+                if client is None or client.closed:
+                    client = self.clients[index] = HubClient(self.address, self.timeout)
+        return client
+
+    # Sends a command over the connection of its device, returns a Future holding the command's result
+    def send_command(self, device_id, command, *args):
+        return self._client(shard_for(device_id, len(self.clients))).send_command(device_id, command, *args)
+
+    # Sends a batch of (device_id, command, args) commands, one batch per connection, returns Futures in input order
+    def send_commands(self, commands):
+        by_client = {}  # Dictionary with connection index as key and its list of (position, command) as value
+        for position, entry in enumerate(commands):
+            by_client.setdefault(shard_for(entry[0], len(self.clients)), []).append((position, entry))
+        futures = [None] * len(commands)
+        for index, entries in by_client.items():
+            for (position, _), future in zip(entries, self._client(index).send_commands(entry for _, entry in entries)):
+                futures[position] = future
+        return futures
+
+    # Returns the status of a device on the server, or None if it doesn't exist
+    def get_device_status(self, device_id, timeout=None):
+        return self._client(shard_for(device_id, len(self.clients))).get_device_status(device_id, timeout)
+
+    # Returns the ids of the server's devices matching device_type and the indexed field conditions
+    def query(self, device_type=None, timeout=None, **conditions):
+        return self._client(0).query(device_type, timeout, **conditions)
+
+    # Closes every open connection
+    def close(self):
+        with self.lock:
+            clients, self.clients = self.clients, [None] * len(self.clients)
+        for client in clients:
+            if client is not None:
+                client.close()
+
+    # Closes the pool at the end of a with block
+    def __enter__(self):
+        return self
+
+    # Closes the pool at the end of a with block
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,277 @@
+from CommandCodec import CommandEncoder, CommandDecoder
+from collections import namedtuple
+import os
+import struct
+import sys
+import threading
+import zlib
+
+'''
+Journal layout:
+    the journal directory holds segment files named "<first offset, 20 digits>.journal" and checkpoint
+    snapshots named "checkpoint-<offset, 20 digits>.snap"
+    a segment is a sequence of records: u32 payload length, u32 CRC-32 of the payload, u64 offset, payload
+    the payload is the CommandCodec records of one command, preceded by the definitions it is the first in its
+    segment to use, so every segment decodes on its own
+Offsets are consecutive integers across segments. A record that is cut short or fails its CRC marks the end
+of the journal, it is what a crash in the middle of a write leaves behind.
+'''
+
+_RECORD = struct.Struct("<IIQ")  # Payload length, CRC-32 of the payload, offset
+_SEGMENT_SUFFIX = ".journal"
+_CHECKPOINT_PREFIX = "checkpoint-"
+
+JournalEntry = namedtuple("JournalEntry", ("offset", "device_id", "command", "args"))
+
+
+'''
+Purpose: Append-only write-ahead journal of the commands applied by a SmartHomeHub
+Contract:
+    - append() hands an entry to the background writer and returns its offset without doing any I/O,
+      on_durable(error) is called from the writer once the entry is on disk (error None) or failed to write
+    - the writer group commits: it gathers the entries appended within flush_interval (or max_batch of them),
+      writes them with one write call and makes them durable with one fsync
+    - wait_durable() and sync() wait until entries are on disk, durable_offset is the last durable offset
+    - segments are rotated once they grow past segment_size, compact() deletes the segments a checkpoint covers
+    - replay() yields the entries from an offset onwards, in offset order
+'''
+
+
+class CommandJournal:
+    # Initializes an instance of CommandJournal in directory, continuing after the last entry already there
+    # fsync=False leaves durability to the operating system, for tests and throwaway hubs
+    def __init__(self, directory, flush_interval=0.005, max_batch=4096, segment_size=64 * 1024 * 1024, fsync=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory  # Directory holding the segments and checkpoints
+        self.flush_interval = flush_interval  # Seconds the writer waits for more entries before a group commit
+        self.max_batch = max_batch  # Entries that trigger a group commit without waiting for flush_interval
+        self.segment_size = segment_size  # Bytes after which the writer starts a new segment
+        self.fsync = fsync  # Whether each group commit is fsynced
+        self.pending = []  # (offset, device_id, command, args, on_durable) entries appended but not written yet
+        self.lock = threading.Lock()  # Lock to keep offsets and the pending list consistent
+        self.changed = threading.Condition(self.lock)  # Signals new entries to the writer and commits to waiters
+        self.file_lock = threading.Lock()  # Lock to keep rotation and compaction away from a write in progress
+        self.file = None  # Segment the writer appends to, opened on the first write
+        self.encoder = CommandEncoder()  # Encodes the payloads, reset for every segment
+        self.file_size = 0  # Bytes in the current segment
+        self.resume = True  # Whether the first write continues the last segment of a previous run
+        self.error = None  # Exception that stopped the writer, raised by sync() and wait_durable()
+        self.closed = False
+        self.next_offset = self._recover()  # Offset the next entry gets
+        self.durable_offset = self.next_offset - 1  # Last offset known to be on disk
+        self.last_written = self.durable_offset  # Last offset written to the current segment
+        self.writer = threading.Thread(target=self._run, name="SmartHome-journal-writer", daemon=True)
+        self.writer.start()
+
+    # Finds the offset after the last whole entry on disk, cutting off a torn record at the end of the last segment
+    def _recover(self):
+        segments = self.segments()
+        checkpoint = self.latest_checkpoint()
+        next_offset = checkpoint[0] if checkpoint else 0
+        if not segments:
+            return next_offset
+        first, path = segments[-1]
+        end = 0
+        last = first - 1
+        for offset, _, record_end in _read_records(path):
+            last, end = offset, record_end
+        if end < os.path.getsize(path):
+            with open(path, "r+b") as file:
+                file.truncate(end)  # Drops the torn record so new entries follow the last whole one
+        return max(next_offset, last + 1)
+
+    # Returns the (first offset, path) of every segment, oldest first
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_SEGMENT_SUFFIX):
+                found.append((int(name[:-len(_SEGMENT_SUFFIX)]), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    # Returns the (offset, path) of the newest checkpoint, or None if there isn't one
+    def latest_checkpoint(self):
+        found = [(int(name[len(_CHECKPOINT_PREFIX):-5]), os.path.join(self.directory, name))
+                 for name in os.listdir(self.directory)
+                 if name.startswith(_CHECKPOINT_PREFIX) and name.endswith(".snap")]
+        return max(found) if found else None
+
+    # Queues an entry for the writer and returns its offset
+    def append(self, device_id, command, args=(), on_durable=None):
+        with self.lock:  # Lock so offsets are handed out in the order entries are queued
+            if self.closed:
+                raise RuntimeError("The journal is closed")
+            if self.error is not None:
+                raise self.error  # The writer stopped, the entry would never reach the disk
+            offset = self.next_offset
+            self.next_offset += 1
+            self.pending.append((offset, device_id, command, args, on_durable))
+            if len(self.pending) == 1 or len(self.pending) >= self.max_batch:
+                self.changed.notify_all()  # Wakes the writer for the first entry of a batch and for a full batch
+        return offset
+
+    # Waits until the entry at offset is on disk, returns True if that happened before the timeout
+    def wait_durable(self, offset, timeout=None):
+        with self.changed:
+            self.changed.wait_for(lambda: self.durable_offset >= offset or self.error is not None, timeout)
+            if self.error is not None:
+                raise self.error
+            return self.durable_offset >= offset
+
+    # Waits until every entry appended so far is on disk
+    def sync(self, timeout=None):
+        with self.lock:
+            last = self.next_offset - 1
+        return self.wait_durable(last, timeout)
+
+    # Writer loop, each pass is one group commit
+    def _run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return  # Closed and nothing left to write
+                if len(self.pending) < self.max_batch and not self.closed:
+                    # Gives other commands flush_interval to join the batch, so one fsync covers all of them
+                    self.changed.wait_for(lambda: len(self.pending) >= self.max_batch or self.closed,
+                                          self.flush_interval)
+                batch, self.pending = self.pending, []
+            try:
+                self._write(batch)
+            except Exception as error:
+                print(f"Command journal failed: {error!r}", file=sys.stderr)
+                with self.changed:
+                    self.error = error
+                    self.changed.notify_all()
+                _notify(batch, error)
+                return
+            with self.changed:
+                self.durable_offset = batch[-1][0]
+                self.changed.notify_all()  # Wakes wait_durable() callers
+            _notify(batch, None)
+
+    # Encodes a batch, appends it to the current segment and fsyncs it
+    def _write(self, batch):
+        with self.file_lock:  # Lock so rotate() and compact() don't swap the file mid write
+            if self.file is None or self.file_size >= self.segment_size:
+                self._open_segment(batch[0][0])
+            # Encoded once the segment is known, since the first payloads of a segment carry its definitions
+            chunks = []
+            encode = self.encoder.encode
+            for offset, device_id, command, args, _ in batch:
+                payload = encode(device_id, command, args)
+                chunks.append(_RECORD.pack(len(payload), zlib.crc32(payload), offset))
+                chunks.append(payload)
+            data = b"".join(chunks)
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.file_size += len(data)
+            self.last_written = batch[-1][0]
+
+    # Starts a new segment whose first entry is first_offset, or continues the last one if it has room
+    # The caller holds file_lock
+    def _open_segment(self, first_offset):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        # A segment continued from a previous run gets its definitions again, the later ones win when replaying
+        self.encoder.reset()
+        if self.resume:
+            self.resume = False
+            segments = self.segments()
+            if segments and os.path.getsize(segments[-1][1]) < self.segment_size:
+                path = segments[-1][1]  # Continues the segment left by the previous run
+                self.file = open(path, "ab")
+                self.file_size = os.path.getsize(path)
+                return
+        path = os.path.join(self.directory, f"{first_offset:020d}{_SEGMENT_SUFFIX}")
+        self.file = open(path, "ab")
+        self.file_size = 0
+
+    # Closes the current segment, the next group commit starts a new one
+    # Returns the (path, last offset) of the closed segment, or None if no segment was open
+    def rotate(self):
+        with self.file_lock:  # Lock before closing the segment
+            self.resume = False  # Makes the next write start a new segment
+            if self.file is None:
+                return None
+            self.file.close()
+            closed, self.file = (self.file.name, self.last_written), None
+            return closed
+
+    # Writes a checkpoint with write_checkpoint(path) and deletes the segments and checkpoints it makes redundant
+    # Returns the checkpoint offset: entries below it are in the checkpoint, entries from it on are replayed
+    # Commands running while the checkpoint is written may be both in the checkpoint and replayed after it,
+    # which is harmless because commands set state rather than adjust it
+    def compact(self, write_checkpoint):
+        with self.lock:
+            offset = self.next_offset  # Every entry below this was applied before the checkpoint starts
+        self.sync()
+        closed = self.rotate()  # Later entries go to a new segment, so the current one can be deleted
+        path = os.path.join(self.directory, f"{_CHECKPOINT_PREFIX}{offset:020d}.snap")
+        write_checkpoint(path + ".tmp")
+        os.replace(path + ".tmp", path)  # The checkpoint only appears once it is complete
+        with self.file_lock:  # Lock so the writer doesn't open a segment while old ones are deleted
+            segments = self.segments()
+            for (first, segment_path), (next_first, _) in zip(segments, segments[1:]):
+                if next_first <= offset:
+                    os.remove(segment_path)  # Every entry of the segment is below the checkpoint
+            if closed is not None and closed[1] < offset and os.path.exists(closed[0]):
+                os.remove(closed[0])  # The segment closed above only holds entries below the checkpoint
+        for name in os.listdir(self.directory):
+            if name.startswith(_CHECKPOINT_PREFIX) and name.endswith(".snap") and \
+                    int(name[len(_CHECKPOINT_PREFIX):-5]) < offset:
+                os.remove(os.path.join(self.directory, name))
+        return offset
+
+    # Yields the JournalEntry of every durable entry from from_offset on, in offset order
+    def replay(self, from_offset=0):
+        segments = self.segments()
+        for index, (first, path) in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1][0] <= from_offset:
+                continue  # Every entry of the segment is below from_offset
+            decoder = CommandDecoder()  # Every segment defines its own codes
+            for offset, payload, _ in _read_records(path):
+                # Decoded even below from_offset, for the definitions the later entries rely on
+                device_id, command, args = decoder.decode(payload)[0]
+                if offset >= from_offset:
+                    yield JournalEntry(offset, device_id, command, tuple(args))
+
+    # Writes the pending entries and stops the writer
+    def close(self, timeout=None):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        self.writer.join(timeout)
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Calls the on_durable callbacks of a written batch
+def _notify(batch, error):
+    for entry in batch:
+        on_durable = entry[4]
+        if on_durable is not None:
+            try:
+                on_durable(error)
+            except Exception as callback_error:
+                # Keeps the writer alive if a callback fails
+                print(f"Journal callback failed: {callback_error!r}", file=sys.stderr)
+
+
+# Yields (offset, payload, end position) for every whole record of a segment, stopping at the first torn one
+def _read_records(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    position = 0
+    while position + _RECORD.size <= len(data):
+        length, checksum, offset = _RECORD.unpack_from(data, position)
+        start = position + _RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return  # Torn or corrupt record, the journal ends here
+        position = start + length
+        yield offset, payload, position
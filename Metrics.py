@@ -0,0 +1,311 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import os
+import threading
+import time
+
+'''
+Purpose: Count observations of a duration in fixed, exponentially growing buckets
+Contract:
+    - observe() adds one duration in seconds, in O(log buckets) and without allocating
+    - bounds are the bucket upper bounds, from 1 microsecond doubling up to about 17 seconds, plus +Inf
+    - snapshot() returns the count, sum and approximate percentiles, read from the bucket bounds
+'''
+
+
+class Histogram:
+    BOUNDS = tuple(1e-6 * 2 ** i for i in range(25))  # 1us, 2us, 4us ... about 16.8s
+
+    __slots__ = ("counts", "sum", "count", "lock")
+
+    # Initializes an instance of Histogram
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # Observations per bucket, the last bucket is +Inf
+        self.sum = 0.0  # Sum of every observation
+        self.count = 0  # Number of observations
+        self.lock = threading.Lock()  # Lock so concurrent observations aren't lost
+
+    # Adds one observation
+    def observe(self, seconds):
+        with self.lock:  # Lock before updating the counts
+            self.add(seconds)
+
+    # Adds one observation, the caller holds the lock guarding the histogram
+    def add(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    # Returns the upper bound of the bucket holding the given fraction of the observations
+    def percentile(self, fraction, counts=None, count=None):
+        counts = self.counts if counts is None else counts
+        count = self.count if count is None else count
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return self.BOUNDS[index] if index < len(self.BOUNDS) else float("inf")
+        return float("inf")
+
+    # Returns a copy of the histogram, the caller holds the lock guarding it
+    def copy(self):
+        copied = Histogram()
+        copied.counts, copied.sum, copied.count = list(self.counts), self.sum, self.count
+        return copied
+
+    # Returns a consistent copy of the histogram as a dictionary, with percentiles in seconds
+    def snapshot(self):
+        with self.lock:  # Lock so the counts, sum and count agree with each other
+            counts, total, count = list(self.counts), self.sum, self.count
+        return {"count": count, "sum": total, "buckets": counts,
+                "p50": self.percentile(0.50, counts, count), "p99": self.percentile(0.99, counts, count),
+                "p999": self.percentile(0.999, counts, count)}
+
+
+'''
+Purpose: Wrap a lock and record how long callers wait to acquire it
+Contract:
+    - behaves like the wrapped lock: acquire(), release(), locked() and use in a with block
+    - only contended acquisitions are timed and recorded, one that succeeds straight away costs a single
+      non-blocking acquire, so the histogram count is the number of times a caller had to wait
+'''
+
+
+class InstrumentedLock:
+    __slots__ = ("inner", "waits")
+
+    # Initializes an instance of InstrumentedLock around inner, recording waits in the waits Histogram
+    def __init__(self, inner, waits):
+        self.inner = inner  # Lock being wrapped
+        self.waits = waits  # Histogram of the wait times
+
+    # Acquires the lock, timing the wait if it is contended
+    def acquire(self, blocking=True, timeout=-1):
+        if self.inner.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.inner.acquire(True, timeout)
+        self.waits.observe(time.perf_counter() - start)
+        return acquired
+
+    # Releases the lock
+    def release(self):
+        self.inner.release()
+
+    # Returns True if the lock is held
+    def locked(self):
+        return self.inner.locked()
+
+    # Acquires the lock at the start of a with block, the same as acquire() without the extra call
+    def __enter__(self):
+        if not self.inner.acquire(False):
+            start = time.perf_counter()
+            self.inner.acquire()
+            self.waits.observe(time.perf_counter() - start)
+        return self
+
+    # Releases the lock at the end of a with block
+    def __exit__(self, *exc_info):
+        self.inner.release()
+
+
+'''
+Purpose: Collect the metrics of a SmartHomeHub
+Contract:
+    - record() adds a finished command: its latency, the time in the handler, and its dispatch wait, the time
+      from send_command() to the handler starting, which covers queueing and thread startup,
+      per (device_type, command) pair and under a single lock acquisition
+    - hub_lock_wait and device_lock_wait record the contended waits for the hub lock and the device locks
+    - started() and record() (or finished() for cancelled commands) track the commands in flight,
+      started() takes no lock since it runs on the caller's send path
+    - error() counts failures by exception type, superseded() the queued commands replaced by a newer one
+    - snapshot() returns every metric as a dictionary, render_prometheus() in the Prometheus text format
+'''
+
+
+class HubMetrics:
+    # Initializes an instance of HubMetrics
+    def __init__(self):
+        self.commands = {}  # Dictionary with (device_type, command) as key and (latency, dispatch wait) as value
+        self.errors = {}  # Dictionary with (device_type, command, exception name) as key and count as value
+        self.hub_lock_wait = Histogram()  # Waits for SmartHomeHub.lock
+        self.device_lock_wait = Histogram()  # Waits for SmartDevice.lock
+        # next() on an itertools.count is atomic, so started() doesn't need the lock on the send path
+        # _in_flight() reads the counter with next() too, and subtracts the reads it made
+        self.sent = itertools.count()
+        self.sent_reads = 0  # Times _in_flight() advanced the sent counter
+        self.done = 0  # Commands finished, cancelled or replaced
+        self.coalesced = 0  # Queued commands replaced by a newer call of the same setter
+        self.lock = threading.Lock()  # Lock to keep the dictionaries and counters safe
+
+    # Counts a command that was sent
+    def started(self):
+        next(self.sent)
+
+    # Returns the number of commands sent but not finished, the caller holds the lock
+    def _in_flight(self):
+        sent = next(self.sent) - self.sent_reads
+        self.sent_reads += 1
+        return sent - self.done
+
+    # Records a command that finished, with its dispatch wait and latency in seconds
+    def record(self, device_type, command, wait, latency):
+        key = (device_type, command)
+        with self.lock:  # One acquisition covers both histograms and the in-flight count
+            histograms = self.commands.get(key)
+            if histograms is None:
+                histograms = self.commands[key] = (Histogram(), Histogram())
+            histograms[0].add(latency)
+            histograms[1].add(wait)
+            self.done += 1
+
+    # Counts a command that was cancelled before it ran
+    def finished(self):
+        with self.lock:
+            self.done += 1
+
+    # Counts a queued command that a newer call of the same setter replaced, it never runs on its own
+    def superseded(self):
+        with self.lock:
+            self.coalesced += 1
+            self.done += 1
+
+    # Counts a command that raised error
+    def error(self, device_type, command, error):
+        key = (device_type, command, type(error).__name__)
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    # Returns every metric as a dictionary, commands are keyed "<device_type>.<command>"
+    def snapshot(self):
+        with self.lock:  # The command histograms are guarded by the metrics lock, not their own
+            commands = {key: (latency.copy(), wait.copy()) for key, (latency, wait) in self.commands.items()}
+            errors = dict(self.errors)
+            in_flight = self._in_flight()
+            coalesced = self.coalesced
+        return {
+            "in_flight": in_flight,
+            "coalesced": coalesced,
+            "commands": {f"{device_type}.{command}": {"latency": latency.snapshot(), "dispatch_wait": wait.snapshot()}
+                         for (device_type, command), (latency, wait) in sorted(commands.items(), key=_sort_key)},
+            "errors": {f"{device_type}.{command}.{name}": count
+                       for (device_type, command, name), count in sorted(errors.items(), key=_sort_key)},
+            "hub_lock_wait": self.hub_lock_wait.snapshot(),
+            "device_lock_wait": self.device_lock_wait.snapshot(),
+        }
+
+    # Returns every metric in the Prometheus text exposition format
+    def render_prometheus(self):
+        with self.lock:  # Lock so the commands and errors are copied in one consistent step
+            commands = sorted(((key, (latency.copy(), wait.copy())) for key, (latency, wait) in self.commands.items()),
+                              key=_sort_key)
+            errors = sorted(self.errors.items(), key=_sort_key)
+            in_flight = self._in_flight()
+            coalesced = self.coalesced
+        lines = ["# HELP smarthome_commands_in_flight Commands sent but not finished",
+                 "# TYPE smarthome_commands_in_flight gauge",
+                 f"smarthome_commands_in_flight {in_flight}",
+                 "# HELP smarthome_commands_coalesced_total Queued commands replaced by a newer call",
+                 "# TYPE smarthome_commands_coalesced_total counter",
+                 f"smarthome_commands_coalesced_total {coalesced}"]
+        for name, index, help_text in (("smarthome_command_latency_seconds", 0, "Time spent in the handler"),
+                                       ("smarthome_command_dispatch_wait_seconds", 1,
+                                        "Time from send_command() to the handler starting")):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for (device_type, command), histograms in commands:
+                labels = f'device_type="{_escape(device_type)}",command="{_escape(command)}"'
+                lines += _histogram_lines(name, labels, histograms[index].snapshot())
+        lines += ["# HELP smarthome_command_errors_total Commands that raised, by exception type",
+                  "# TYPE smarthome_command_errors_total counter"]
+        for (device_type, command, error), count in errors:
+            lines.append(f'smarthome_command_errors_total{{device_type="{_escape(device_type)}",'
+                         f'command="{_escape(command)}",error="{_escape(error)}"}} {count}')
+        for name, histogram, help_text in (("smarthome_hub_lock_wait_seconds", self.hub_lock_wait,
+                                            "Waits for the hub lock"),
+                                           ("smarthome_device_lock_wait_seconds", self.device_lock_wait,
+                                            "Waits for device locks")):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            lines += _histogram_lines(name, "", histogram.snapshot())
+        return "\n".join(lines) + "\n"
+
+
+'''
+Purpose: Export the metrics of a hub in the Prometheus text format, to a file or over HTTP
+Contract:
+    - write() atomically replaces a file with the current metrics, for the node exporter's textfile collector
+    - serve() answers every HTTP GET on host:port with the current metrics from a background thread
+    - close() stops the HTTP server
+'''
+
+
+class PrometheusExporter:
+    # Initializes an instance of PrometheusExporter for a HubMetrics
+    def __init__(self, metrics):
+        self.metrics = metrics  # HubMetrics being exported
+        self.server = None  # HTTP server started by serve(), None until then
+
+    # Writes the current metrics to path, replacing the file in one step so scrapers never see half of it
+    def write(self, path):
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(self.metrics.render_prometheus())
+        os.replace(temporary, path)
+
+    # Serves the metrics over HTTP on host:port, port 0 picks a free port, returns the (host, port) served on
+    def serve(self, host="127.0.0.1", port=9464):
+        metrics = self.metrics
+
+        # Answers every GET with the metrics
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes aren't worth a line on stderr each
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="SmartHome-metrics", daemon=True).start()
+        return self.server.server_address
+
+    # Stops the HTTP server
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# Returns the Prometheus lines of one histogram snapshot, with cumulative buckets
+def _histogram_lines(name, labels, snapshot):
+    lines = []
+    cumulative = 0
+    separator = "," if labels else ""
+    for bound, count in zip(Histogram.BOUNDS + (float("inf"),), snapshot["buckets"]):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else f"{bound:.6g}"
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{le}"}} {cumulative}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {snapshot['sum']:.9g}")
+    lines.append(f"{name}_count{suffix} {snapshot['count']}")
+    return lines
+
+
+# Sorts (key tuple, value) items by the text of their keys, device_type is None for unknown devices
+def _sort_key(item):
+    return tuple(str(part) for part in item[0])
+
+
+# Escapes a label value for the Prometheus text format
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
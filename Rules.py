@@ -0,0 +1,241 @@
+from collections import deque
+from functools import partial
+import heapq
+import sys
+import threading
+import time
+
+'''
+Purpose: Describe an automation rule: when a device field meets a condition, run actions
+Contract:
+    - the trigger is field on device_id, or on every device of device_type when device_id is None
+    - condition is the value the field must change to, or a callable taking the new value and returning a bool
+    - between = (start, end) limits the rule to a time of day window, as "HH:MM" strings, and may wrap midnight
+    - duration is the number of seconds the condition must hold before the rule fires, None fires right away
+    - actions are (device_id, command, *args) tuples sent through SmartHomeHub.send_command(),
+      or callables called with (rule, event)
+    - fired counts how many times the rule fired
+'''
+
+
+class Rule:
+    # Initializes an instance of Rule
+    def __init__(self, name, field, condition=True, actions=(), device_id=None, device_type=None, between=None,
+                 duration=None):
+        if device_id is None and device_type is None:
+            raise ValueError("A rule needs a device_id or a device_type")  # Rules are indexed by device or type
+        self.name = name  # Unique name of the rule
+        self.field = field  # Device field the rule watches, e.g. 'motion_detected'
+        self.condition = condition  # Value to match, or a predicate on the new value
+        self.actions = tuple(actions)  # Commands or callables run when the rule fires
+        self.device_id = device_id  # Device the rule watches, None for every device of device_type
+        self.device_type = device_type  # Device type the rule watches when device_id is None
+        self.between = None if between is None else tuple(_seconds_of_day(bound) for bound in between)
+        self.duration = duration  # Seconds the condition must hold before the rule fires
+        self.fired = 0  # Number of times the rule fired
+
+    # Returns True if the new value of the field satisfies the condition
+    def matches(self, value):
+        if callable(self.condition):
+            return bool(self.condition(value))
+        return value == self.condition
+
+    # Returns True if now, a time.time() value, is inside the rule's time of day window
+    def active_at(self, now):
+        if self.between is None:
+            return True
+        start, end = self.between
+        moment = time.localtime(now)
+        second = moment.tm_hour * 3600 + moment.tm_min * 60 + moment.tm_sec
+        if start <= end:
+            return start <= second < end
+        return second >= start or second < end  # The window wraps midnight, e.g. 22:00 to 06:00
+
+
+'''
+Purpose: Evaluate automation rules against the events of a SmartHomeHub's devices
+Contract:
+    - add() compiles a rule into an index keyed on (device_id, field) or (device_type, field), remove() drops it
+    - evaluate() is called with every device event and only checks the rules indexed under the event's
+      device and field, so its cost doesn't grow with the number of unrelated rules
+    - rules with a duration are armed when their condition becomes true and disarmed when it stops holding,
+      tick() fires the armed rules whose duration has passed, a timer thread calls it unless timer is False
+    - evaluate() runs on the thread that applied the change, which still holds the device lock of the event,
+      so command actions are handed to an action thread that sends them through send_command(), a full
+      executor queue or admission controller only ever blocks that thread, failed commands are logged
+    - callable actions run on the thread that evaluated the event, holding the device lock of the event's
+      device, so they mustn't block, send commands or call that device's methods, command actions can
+    - drain() waits until the action thread has sent every queued command action
+    - clock returns the current time as a time.time() value, so tests can control time
+'''
+
+
+class RuleEngine:
+    # Initializes an instance of RuleEngine for hub
+    def __init__(self, hub, clock=time.time, timer=True):
+        self.hub = hub  # Hub whose send_command() runs the actions
+        self.clock = clock  # Returns the current time
+        self.timer = timer  # Whether a background thread fires the rules with a duration
+        self.rules = {}  # Dictionary with rule name as key and rule as value
+        self.by_device = {}  # Dictionary with (device_id, field) as key and the tuple of rules as value
+        self.by_type = {}  # Dictionary with (device_type, field) as key and the tuple of rules as value
+        self.armed = {}  # Dictionary with (rule name, device_id) as key and (deadline, event) as value
+        self.deadlines = []  # Heap of (deadline, rule name, device_id), entries may be stale
+        self.lock = threading.Lock()  # Lock to keep the indexes and armed rules consistent
+        self.wakeup = threading.Condition(self.lock)  # Signals the timer thread about new deadlines
+        self.thread = None  # Timer thread, started with the first rule that has a duration
+        self.outbox = deque()  # (rule, command actions) of the fired rules, oldest first
+        self.dispatch = threading.Condition()  # Guards the outbox, signals the action thread and drain()
+        self.dispatcher = None  # Action thread, started when a rule with command actions first fires
+
+    # Adds a rule, replacing any rule with the same name
+    def add(self, rule):
+        with self.lock:  # Lock before changing the indexes
+            self._remove(rule.name)
+            self.rules[rule.name] = rule
+            index, key = self._key(rule)
+            index[key] = index.get(key, ()) + (rule,)  # Copied on write, evaluate() reads it without the lock
+            if rule.duration is not None and self.timer and self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="SmartHome-rule-timer", daemon=True)
+                self.thread.start()
+        return rule
+
+    # Removes the rule called name, returns True if there was one
+    def remove(self, name):
+        with self.lock:  # Lock before changing the indexes
+            return self._remove(name)
+
+    # Removes a rule and disarms it, the caller holds the lock
+    def _remove(self, name):
+        rule = self.rules.pop(name, None)
+        if rule is None:
+            return False
+        index, key = self._key(rule)
+        remaining = tuple(r for r in index[key] if r is not rule)
+        if remaining:
+            index[key] = remaining
+        else:
+            del index[key]
+        for armed in [armed for armed in self.armed if armed[0] == name]:
+            del self.armed[armed]
+        return True
+
+    # Returns the index and key a rule is filed under
+    def _key(self, rule):
+        if rule.device_id is not None:
+            return self.by_device, (rule.device_id, rule.field)
+        return self.by_type, (rule.device_type, rule.field)
+
+    # Checks the rules that watch the event's device and field, and runs the actions of those that fire
+    def evaluate(self, event):
+        rules = self.by_device.get((event.device_id, event.field), ()) + \
+            self.by_type.get((event.device_type, event.field), ())
+        if not rules:
+            return  # Most events have no rule watching them
+        now = self.clock()
+        fired = []
+        for rule in rules:
+            matched = rule.matches(event.new) and rule.active_at(now)
+            if rule.duration is None:
+                if matched:
+                    fired.append(rule)
+                continue
+            key = (rule.name, event.device_id)
+            with self.lock:  # Lock before arming or disarming the rule
+                if not matched:
+                    self.armed.pop(key, None)  # The condition stopped holding before the duration passed
+                elif key not in self.armed:
+                    deadline = now + rule.duration
+                    self.armed[key] = (deadline, event)
+                    heapq.heappush(self.deadlines, (deadline, rule.name, event.device_id))
+                    self.wakeup.notify()
+        for rule in fired:
+            self._fire(rule, event)
+
+    # Fires the armed rules whose duration has passed, returns the number of rules fired
+    def tick(self, now=None):
+        now = self.clock() if now is None else now
+        due = []
+        with self.lock:  # Lock before taking the due rules
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, name, device_id = heapq.heappop(self.deadlines)
+                armed = self.armed.get((name, device_id))
+                if armed is not None and armed[0] == deadline:  # Skips rules disarmed or re-armed since
+                    del self.armed[(name, device_id)]
+                    due.append((self.rules[name], armed[1]))
+        for rule, event in due:
+            if rule.active_at(now):
+                self._fire(rule, event)
+        return len(due)
+
+    # Runs the callable actions of a rule and queues its command actions for the action thread
+    def _fire(self, rule, event):
+        rule.fired += 1
+        commands = []
+        for action in rule.actions:
+            if not callable(action):
+                commands.append(action)
+                continue
+            try:
+                action(rule, event)
+            except Exception as error:
+                # A failing action doesn't stop the other actions or the command that triggered the rule
+                _report(rule, error)
+        if commands:
+            with self.dispatch:  # Lock before queuing the commands
+                self.outbox.append((rule, commands))
+                if self.dispatcher is None:
+                    self.dispatcher = threading.Thread(target=self._send, name="SmartHome-rule-actions",
+                                                       daemon=True)
+                    self.dispatcher.start()
+                self.dispatch.notify_all()
+
+    # Action thread loop, sends the queued command actions in the order their rules fired
+    def _send(self):
+        while True:
+            with self.dispatch:
+                while not self.outbox:
+                    self.dispatch.wait()
+                rule, commands = self.outbox[0]  # Stays queued until sent, so drain() waits for it
+            for action in commands:
+                try:
+                    future = self.hub.send_command(*action)
+                except Exception as error:
+                    _report(rule, error)
+                else:
+                    future.add_done_callback(partial(_check, rule))  # The command runs asynchronously
+            with self.dispatch:
+                self.outbox.popleft()
+                self.dispatch.notify_all()  # Wakes drain()
+
+    # Waits until every queued command action was sent, returns False if the timeout passed first
+    def drain(self, timeout=None):
+        with self.dispatch:
+            return self.dispatch.wait_for(lambda: not self.outbox, timeout)
+
+    # Timer loop, sleeps until the next deadline and fires the rules that are due
+    def _run(self):
+        while True:
+            with self.wakeup:
+                if self.deadlines:
+                    self.wakeup.wait(max(0.0, self.deadlines[0][0] - self.clock()))
+                else:
+                    self.wakeup.wait()
+            self.tick()
+
+
+# Reports the failure of an action of rule
+def _report(rule, error):
+    print(f"Rule '{rule.name}' action failed: {error!r}", file=sys.stderr)
+
+
+# Reports a command action whose Future failed
+def _check(rule, future):
+    if not future.cancelled() and future.exception() is not None:
+        _report(rule, future.exception())
+
+
+# Converts "HH:MM" or "HH:MM:SS" to seconds since midnight
+def _seconds_of_day(text):
+    parts = [int(part) for part in text.split(":")]
+    return parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
@@ -0,0 +1,277 @@
+import datetime
+import math
+import sys
+import threading
+import time
+
+'''
+Purpose: Describe a command scheduled on a SmartHomeHub
+Contract:
+    - deadline is the time.time() value the command is due at next
+    - cron is the CronSpec of a recurring command, None for a one-off command
+    - cancelled is True once the command was cancelled, runs counts how many times it was sent
+'''
+
+
+class ScheduledCommand:
+    __slots__ = ("id", "deadline", "device_id", "command", "args", "cron", "cancelled", "runs", "slot", "level")
+
+    # Initializes an instance of ScheduledCommand
+    def __init__(self, timer_id, deadline, device_id, command, args, cron=None):
+        self.id = timer_id  # Number that orders commands due in the same tick
+        self.deadline = deadline  # Time the command is due at
+        self.device_id = device_id  # Device that receives the command
+        self.command = command  # Name of the command
+        self.args = args  # Arguments passed through to the handler
+        self.cron = cron  # CronSpec of a recurring command, None for a one-off command
+        self.cancelled = False  # Whether cancel() was called
+        self.runs = 0  # Number of times the command was sent
+        self.slot = None  # Wheel slot (a set) holding the command, None while it isn't in the wheel
+        self.level = 0  # Wheel level of the slot
+
+
+'''
+Purpose: Run commands at given times through a hierarchical timing wheel driven by a single thread
+Contract:
+    - schedule() adds a command due at a time.time() deadline, recurring by a CronSpec if one is given
+    - cancel() cancels a scheduled command, both in O(1) whatever the number of pending commands
+    - advance() moves the wheel up to a given time and sends the due commands through hub.send_command(),
+      the driver thread calls it at every tick unless driver is False
+    - commands due in the same tick are sent in deadline order, a command is never sent before its deadline
+    - clock returns the current time as a time.time() value, so tests can control time
+'''
+
+
+class Scheduler:
+    BITS = 8  # log2 of the slots per level
+    LEVELS = 4  # Levels of the wheel, 256 ** 4 ticks reach about 490 days at the default 10ms tick
+
+    # Initializes an instance of Scheduler for hub, with a tick of resolution seconds
+    def __init__(self, hub, clock=time.time, resolution=0.01, driver=True):
+        self.hub = hub  # Hub whose send_command() sends the due commands
+        self.clock = clock  # Returns the current time
+        self.resolution = resolution  # Seconds per tick
+        self.driver = driver  # Whether a background thread advances the wheel
+        self.mask = (1 << self.BITS) - 1
+        # One list of slots per level, slot i of level l holds the commands whose due tick has i in bits l*8..l*8+7
+        self.wheels = [[set() for _ in range(1 << self.BITS)] for _ in range(self.LEVELS)]
+        self.counts = [0] * self.LEVELS  # Commands held by each level
+        self.ready = []  # Commands already due when they were scheduled
+        # Last tick the wheel has processed, rounded down like advance() so the wheel doesn't start a tick ahead
+        self.current = math.floor(clock() / resolution)
+        self.pending = 0  # Commands in the wheel or the ready list
+        self.next_id = 0
+        self.lock = threading.Lock()  # Lock to keep the wheel consistent
+        self.wakeup = threading.Condition(self.lock)  # Signals the driver about the first scheduled command
+        self.thread = None  # Driver thread, started with the first scheduled command
+
+    # Returns the tick a deadline falls in, rounded up so nothing runs early
+    def _tick(self, deadline):
+        return math.ceil(deadline / self.resolution)
+
+    # Schedules command on device_id at deadline, recurring by cron if given, returns the ScheduledCommand
+    def schedule(self, deadline, device_id, command, args=(), cron=None):
+        with self.lock:  # Lock before changing the wheel
+            timer = ScheduledCommand(self.next_id, deadline, device_id, command, tuple(args), cron)
+            self.next_id += 1
+            self._insert(timer)
+            self.pending += 1
+            if self.driver and self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="SmartHome-scheduler", daemon=True)
+                self.thread.start()
+            elif timer.slot is None or timer.level == 0:
+                self.wakeup.notify()  # Due soon, the driver may be sleeping until a later tick
+        return timer
+
+    # Cancels a scheduled command, returns True if it was still pending
+    def cancel(self, timer):
+        with self.lock:  # Lock before changing the wheel
+            if timer.cancelled:
+                return False
+            timer.cancelled = True  # Also stops a recurring command that is being sent right now
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                self.counts[timer.level] -= 1
+                timer.slot = None
+                self.pending -= 1
+                return True
+            if timer in self.ready:
+                self.ready.remove(timer)  # Rare, only commands scheduled in the past wait here
+                self.pending -= 1
+                return True
+            return False
+
+    # Puts a command in the slot of its due tick, or in the ready list if it is already due
+    # The caller holds the lock
+    def _insert(self, timer):
+        due = self._tick(timer.deadline)
+        delta = due - self.current
+        if delta <= 0:
+            self.ready.append(timer)
+            timer.slot = None
+            return
+        for level in range(self.LEVELS):
+            if delta < 1 << (self.BITS * (level + 1)):
+                break
+        else:
+            # Beyond the range of the wheel, parked in the furthest slot and re-inserted when it cascades
+            due = self.current + (1 << (self.BITS * self.LEVELS)) - 1
+        slot = self.wheels[level][(due >> (self.BITS * level)) & self.mask]
+        slot.add(timer)
+        timer.slot = slot
+        timer.level = level
+        self.counts[level] += 1
+
+    # Moves the commands of a higher level slot down the wheel, the caller holds the lock
+    def _cascade(self, level, index):
+        slot = self.wheels[level][index]
+        timers = list(slot)
+        slot.clear()
+        self.counts[level] -= len(timers)
+        for timer in timers:
+            self._insert(timer)
+
+    # Advances the wheel to now and sends every command that is due, returns the number of commands sent
+    def advance(self, now=None):
+        now = self.clock() if now is None else now
+        target = math.floor(now / self.resolution)
+        with self.lock:  # Lock before changing the wheel
+            due = []
+            while self.current < target:
+                if not any(self.counts):
+                    self.current = target  # Nothing in the wheel, no tick needs processing
+                    break
+                lowest = next(level for level, count in enumerate(self.counts) if count)
+                if lowest:
+                    # The levels below lowest are empty, so nothing happens before lowest cascades again
+                    boundary = self.current | ((1 << (self.BITS * lowest)) - 1)
+                    if boundary >= target:
+                        self.current = target
+                        break
+                    self.current = boundary
+                self.current += 1
+                tick = self.current
+                level = 0
+                while level + 1 < self.LEVELS and (tick >> (self.BITS * level)) & self.mask == 0:
+                    level += 1
+                    self._cascade(level, (tick >> (self.BITS * level)) & self.mask)  # Wrapped, next level moves down
+                slot = self.wheels[0][tick & self.mask]
+                if slot:
+                    self.counts[0] -= len(slot)
+                    due.extend(slot)
+                    slot.clear()
+            due.extend(self.ready)  # Scheduled in the past, or cascaded straight to their due tick
+            self.ready = []
+            for timer in due:
+                timer.slot = None
+            self.pending -= len(due)
+        due.sort(key=lambda timer: (timer.deadline, timer.id))
+        for timer in due:
+            self._send(timer, now)
+        return len(due)
+
+    # Sends a due command and schedules the next run of a recurring one
+    def _send(self, timer, now):
+        if timer.cancelled:
+            return
+        timer.runs += 1
+        try:
+            self.hub.send_command(timer.device_id, timer.command, *timer.args)  # The normal dispatch path
+        except Exception as error:
+            # A failing command doesn't stop the scheduler
+            print(f"Scheduled command '{timer.command}' failed: {error!r}", file=sys.stderr)
+        if timer.cron is not None:
+            with self.lock:  # Lock before changing the wheel
+                if not timer.cancelled:
+                    timer.deadline = timer.cron.next_after(max(now, timer.deadline))
+                    self._insert(timer)
+                    self.pending += 1
+
+    # Driver loop, sleeps until the next tick that can have due commands and advances the wheel
+    def _run(self):
+        while True:
+            with self.wakeup:
+                if not self.pending:
+                    self.wakeup.wait()  # Nothing scheduled, sleeps until schedule() notifies
+                    continue
+                if self.ready or not any(self.counts):
+                    wake = self.current + 1
+                else:
+                    # Nothing is due before the lowest level holding commands cascades again
+                    lowest = next(level for level, count in enumerate(self.counts) if count)
+                    wake = (self.current | ((1 << (self.BITS * lowest)) - 1)) + 1
+                delay = wake * self.resolution - self.clock()
+                if delay > 0:
+                    self.wakeup.wait(delay)  # schedule() wakes the driver early for commands due sooner
+                    continue
+            self.advance()
+
+
+'''
+Purpose: Parse a five field cron expression and find the times it matches
+Contract:
+    - the fields are minute, hour, day of month, month and day of week (0 or 7 is Sunday), in local time
+    - each field is "*", a number, a range "a-b", a list "a,b,c", or any of those with a step "*/n" or "a-b/n"
+    - like cron, when both day of month and day of week are restricted a day matching either one matches
+    - next_after() returns the first matching minute after a time.time() value
+'''
+
+
+class CronSpec:
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))  # Allowed values of each field
+
+    # Initializes an instance of CronSpec from an expression like "0 22 * * *"
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' needs 5 fields")
+        self.expression = expression
+        parsed = [_parse_cron_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}  # 7 and 0 are both Sunday
+        self.any_day = fields[2] == "*"  # Whether day of month is unrestricted
+        self.any_weekday = fields[4] == "*"  # Whether day of week is unrestricted
+
+    # Returns True if the day of moment matches the day of month and day of week fields
+    def _day_matches(self, moment):
+        weekday = (moment.weekday() + 1) % 7  # Python counts from Monday, cron from Sunday
+        if self.any_day or self.any_weekday:
+            return moment.day in self.days and weekday in self.weekdays
+        return moment.day in self.days or weekday in self.weekdays
+
+    # Returns the time.time() value of the first matching minute after timestamp
+    def next_after(self, timestamp):
+        moment = datetime.datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0)
+        moment += datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 5)  # Covers February 29 combined with a day of week
+        while moment < limit:
+            if moment.month not in self.months:
+                year, month = (moment.year + 1, 1) if moment.month == 12 else (moment.year, moment.month + 1)
+                moment = moment.replace(year=year, month=month, day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+
+# Returns the set of values a cron field allows
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(bound) for bound in part.split("-"))
+        else:
+            start = int(part)
+            end = high if step else start  # "5/15" means every 15 from 5
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field '{field}' is out of range {low}-{high}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
@@ -0,0 +1,414 @@
+from SmartHomeHub import SmartHomeHub
+from concurrent.futures import Future
+import multiprocessing
+import os
+import pickle
+import threading
+import zlib
+
+'''
+Shard protocol:
+    the parent and each shard process exchange batches, a batch is a list sent with one Connection.send() call
+    a request is (request_id, operation, payload), the shard answers it with (request_id, ok, value), where
+    value is the result when ok is True and the exception when it is False
+    operations: "add" device, "remove" device_id, "status" device_id, "send" (device_id, command, args),
+    "batch" [(device_id, command, args)...], "query" (device_type, conditions),
+    "broadcast" (device_type, command, args), "shutdown" (drain, timeout)
+    a None batch stops the shard once every answer was sent
+'''
+
+
+# Returns the shard index of a device_id out of shards, the same in every process and on every run
+def shard_for(device_id, shards):
+    return zlib.crc32(str(device_id).encode("utf-8")) % shards
+
+
+'''
+Purpose: Connection from the parent process to one shard process, with batched requests and answers
+Contract:
+    - request() queues a request and returns the Future of its answer, without waiting for any I/O
+    - a sender thread sends every request queued while the previous batch was being sent as one batch,
+      a receiver thread resolves the Futures of each batch of answers
+    - a request that can't be pickled fails its own Future, the other requests of its batch are still sent
+    - close() stops the shard process and the threads
+'''
+
+
+class _ShardClient:
+    # Initializes an instance of _ShardClient and starts the shard process with the given SmartHomeHub options
+    def __init__(self, context, index, hub_options):
+        self.connection, child = context.Pipe()  # Duplex pipe, each direction is used by one thread
+        self.process = context.Process(target=_shard_main, args=(child, hub_options), name=f"SmartHome-shard-{index}",
+                                       daemon=True)
+        self.process.start()
+        child.close()  # The shard holds its own end
+        self.outgoing = []  # Requests waiting for the sender
+        self.pending = {}  # Dictionary with request_id as key and the Future of the answer as value
+        self.next_id = 0
+        self.closed = False
+        self.lock = threading.Lock()  # Lock to keep request ids, outgoing and pending consistent
+        self.ready = threading.Condition(self.lock)  # Signals queued requests to the sender
+        self.sender = threading.Thread(target=self._send, name=f"SmartHome-shard-{index}-sender", daemon=True)
+        self.receiver = threading.Thread(target=self._receive, name=f"SmartHome-shard-{index}-receiver", daemon=True)
+        self.sender.start()
+        self.receiver.start()
+
+    # Queues a request for the shard, returns the Future of its answer
+    def request(self, operation, payload):
+        future = Future()
+        with self.lock:  # Lock before handing out the request id
+            if self.closed:
+                raise RuntimeError("The sharded hub has been shut down")
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = future
+            self.outgoing.append((request_id, operation, payload))
+            if len(self.outgoing) == 1:
+                self.ready.notify()  # Wakes the sender for the first request of a batch
+        return future
+
+    # Queues a batch of (operation, payload) requests under one lock acquisition, returns their Futures
+    def request_many(self, requests):
+        futures = []
+        with self.lock:  # Lock once for the whole batch
+            if self.closed:
+                raise RuntimeError("The sharded hub has been shut down")
+            notify = not self.outgoing
+            for operation, payload in requests:
+                future = Future()
+                futures.append(future)
+                self.pending[self.next_id] = future
+                self.outgoing.append((self.next_id, operation, payload))
+                self.next_id += 1
+            if notify and self.outgoing:
+                self.ready.notify()
+        return futures
+
+    # Sender loop, sends everything queued since the last send as one batch
+    def _send(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.outgoing or self.closed)
+                batch, self.outgoing = self.outgoing, []
+                closed = self.closed
+            try:
+                if batch:
+                    try:
+                        self.connection.send(batch)  # One pickle and one write for the whole batch
+                    except Exception as error:
+                        if isinstance(error, OSError):
+                            raise
+                        self.connection.send(self._picklable(batch))  # Nothing was written, a payload can't be pickled
+                if closed:
+                    self.connection.send(None)  # Asks the shard to stop once it answered everything
+                    return
+            except (OSError, EOFError) as error:
+                self._fail(error)
+                return
+
+    # Returns the requests of batch that can be pickled, failing the Futures of the others
+    def _picklable(self, batch):
+        requests = []
+        for request in batch:
+            try:
+                pickle.dumps(request)
+            except Exception as error:
+                with self.lock:
+                    future = self.pending.pop(request[0])
+                future.set_exception(pickle.PicklingError(f"The {request[1]} request can't be sent: {error!r}"))
+                continue
+            requests.append(request)
+        return requests
+
+    # Receiver loop, resolves the Futures of each batch of answers
+    def _receive(self):
+        while True:
+            try:
+                batch = self.connection.recv()
+            except (OSError, EOFError) as error:
+                self._fail(error)  # The shard exited, nothing else will be answered
+                return
+            if batch is None:
+                return  # The shard stopped
+            with self.lock:  # Lock once per batch before taking the Futures
+                futures = [self.pending.pop(request_id) for request_id, _, _ in batch]
+            for future, (_, ok, value) in zip(futures, batch):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    # Fails every Future still waiting for an answer
+    def _fail(self, error):
+        with self.lock:
+            futures, self.pending = list(self.pending.values()), {}
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError(f"Shard connection lost: {error!r}"))
+
+    # Stops the shard process and waits for it and the threads to finish
+    def close(self, timeout=None):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.sender.join(timeout)
+        self.receiver.join(timeout)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()  # Didn't stop in time
+        self.connection.close()
+
+
+'''
+Purpose: Partition the devices of a smart home across several processes, each running its own SmartHomeHub,
+so device handlers run on several cores instead of sharing one GIL
+Contract:
+    - devices are routed to shard_for(device_id, shards), a stable hash, so a device always lives on the same shard
+    - add_device(), remove_device(), send_command(), send_commands() and get_device_status() work like
+      SmartHomeHub's, add_device() hands the shard a copy of the device, later changes happen to the copy
+    - requests to a shard are sent in batches over a pipe, so one pickle and one write carry many commands,
+      requests to the same shard are applied in the order they were made
+    - send_batch() sends a batch with one request per shard and returns a single Future of all the results,
+      which keeps the parent's cost per command far below the shards', so throughput grows with the shards
+    - broadcast() sends a command to every device (of a device_type) on every shard, query() returns copies of the
+      matching devices from every shard
+    - hub_options are passed to the SmartHomeHub of every shard, e.g. executor or event_sink, and must be picklable
+    - start_method is the multiprocessing start method, "spawn" by default since the parent runs threads
+'''
+
+
+class ShardedHub:
+    # Initializes an instance of ShardedHub and starts its shard processes, one per CPU by default
+    def __init__(self, shards=None, start_method="spawn", **hub_options):
+        shards = shards or os.cpu_count() or 1
+        hub_options.setdefault("executor", "lanes")  # Keeps each device's commands in order within its shard
+        context = multiprocessing.get_context(start_method)
+        self.shards = [_ShardClient(context, index, hub_options) for index in range(shards)]
+
+    # Returns the shard client a device lives on
+    def _shard(self, device_id):
+        return self.shards[shard_for(device_id, len(self.shards))]
+
+    # Adds a copy of a device to its shard
+    def add_device(self, device):
+        self._shard(device.device_id).request("add", device).result()
+
+    # Removes a device from its shard
+    def remove_device(self, device_id):
+        self._shard(device_id).request("remove", device_id).result()
+
+    # Returns the status of a device, or None if it doesn't exist, like SmartHomeHub.get_device_status()
+    def get_device_status(self, device_id):
+        return self._shard(device_id).request("status", device_id).result()
+
+    # Sends a command to its device's shard, returns a Future holding the command's result
+    def send_command(self, device_id, command, *args):
+        return self._shard(device_id).request("send", (device_id, command, args))
+
+    # Sends a batch of (device_id, command, args) commands, one batch per shard, returns their Futures in input order
+    def send_commands(self, commands):
+        by_shard = {}  # Dictionary with shard index as key and its list of (position, request) as value
+        for position, entry in enumerate(commands):
+            args = tuple(entry[2]) if len(entry) > 2 else ()
+            index = shard_for(entry[0], len(self.shards))
+            by_shard.setdefault(index, []).append((position, ("send", (entry[0], entry[1], args))))
+        futures = [None] * len(commands)
+        for index, requests in by_shard.items():
+            for (position, _), future in zip(requests, self.shards[index].request_many(r for _, r in requests)):
+                futures[position] = future
+        return futures
+
+    # Sends a batch of (device_id, command, args) commands with one request per shard
+    # Returns a Future of the list of results in input order, holding the exception of each command that raised
+    def send_batch(self, commands):
+        by_shard = {}  # Dictionary with shard index as key and its (positions, commands) as value
+        for position, entry in enumerate(commands):
+            positions, batch = by_shard.setdefault(shard_for(entry[0], len(self.shards)), ([], []))
+            positions.append(position)
+            batch.append((entry[0], entry[1], tuple(entry[2]) if len(entry) > 2 else ()))
+        combined = Future()
+        results = [None] * len(commands)
+        remaining = [len(by_shard)]
+        lock = threading.Lock()
+
+        # Places the results of one shard and resolves the combined Future after the last shard
+        def place(future, positions):
+            error = future.exception()
+            for position, result in zip(positions, future.result() if error is None else ()):
+                results[position] = result
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if error is not None:
+                if not combined.done():
+                    combined.set_exception(error)  # The shard connection failed
+            elif last and not combined.done():
+                combined.set_result(results)
+
+        if not by_shard:
+            combined.set_result(results)
+        for index, (positions, batch) in by_shard.items():
+            self.shards[index].request("batch", batch).add_done_callback(
+                lambda future, positions=positions: place(future, positions))
+        return combined
+
+    # Sends command to every device, or every device of device_type, on every shard
+    # Returns a dictionary with device_id as key and the command's result, or the exception it raised, as value
+    def broadcast(self, command, *args, device_type=None):
+        results = {}
+        for future in [shard.request("broadcast", (device_type, command, args)) for shard in self.shards]:
+            results.update(future.result())
+        return results
+
+    # Returns copies of the devices matching device_type and the indexed field conditions, from every shard
+    def query(self, device_type=None, **conditions):
+        matches = []
+        for future in [shard.request("query", (device_type, conditions)) for shard in self.shards]:
+            matches.extend(future.result())
+        return matches
+
+    # Shuts down the hub of every shard and stops the shard processes
+    # Returns True if every shard's commands finished before the timeout
+    def shutdown(self, drain=True, timeout=None):
+        finished = [shard.request("shutdown", (drain, timeout)) for shard in self.shards]
+        finished = all(future.result() for future in finished)
+        for shard in self.shards:
+            shard.close(timeout)
+        return finished
+
+
+# Main loop of a shard process, runs a SmartHomeHub and answers the requests coming over connection
+def _shard_main(connection, hub_options):
+    hub = SmartHomeHub(**hub_options)
+    answers = []  # (request_id, ok, value) answers waiting for the sender
+    lock = threading.Lock()
+    ready = threading.Condition(lock)  # Signals answers to the sender
+    stopping = []  # Holds True once the parent asked the shard to stop
+
+    # Queues an answer for the parent
+    def answer(request_id, ok, value):
+        with lock:
+            answers.append((request_id, ok, value))
+            if len(answers) == 1:
+                ready.notify()
+
+    # Answers a request with the outcome of a Future once it is done
+    def answer_future(request_id, future):
+        error = future.exception()
+        answer(request_id, error is None, future.result() if error is None else error)
+
+    # Answers a request with the results of several Futures once they are all done, as a list in order,
+    # or as a dictionary keyed by keys, a command that raised contributes its exception
+    def answer_all(request_id, futures, keys=None):
+        remaining = [len(futures)]
+
+        # Counts a finished Future and answers after the last one
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            results = [future.exception() or future.result() for future in futures]
+            answer(request_id, True, results if keys is None else dict(zip(keys, results)))
+
+        if not futures:
+            answer(request_id, True, [] if keys is None else {})
+        for future in futures:
+            future.add_done_callback(finished)
+
+    # Sends a run of commands through one send_commands() call and answers each once it is done
+    def send_all(sends):
+        futures = hub.send_commands([payload for _, payload in sends])
+        for (request_id, _), future in zip(sends, futures):
+            future.add_done_callback(lambda future, request_id=request_id: answer_future(request_id, future))
+
+    # Sends every queued answer as one batch, until the shard stops
+    def send_answers():
+        while True:
+            with ready:
+                ready.wait_for(lambda: answers or stopping)
+                batch = answers[:]
+                answers.clear()
+                done = stopping and not batch
+            try:
+                if batch:
+                    try:
+                        connection.send(batch)
+                    except Exception as error:
+                        if isinstance(error, OSError):
+                            raise
+                        connection.send(_picklable(batch))  # Nothing was written, a value couldn't be pickled
+                if done:
+                    connection.send(None)
+                    return
+            except OSError:
+                return  # The parent went away, nobody is waiting for the answers
+
+    sender = threading.Thread(target=send_answers, name="SmartHome-shard-answers", daemon=True)
+    sender.start()
+    while True:
+        try:
+            batch = connection.recv()
+        except EOFError:
+            hub.shutdown(drain=False, timeout=0)  # The parent went away without shutting the shard down
+            break
+        if batch is None:
+            break  # The parent already shut the hub down through a "shutdown" request
+        sends = []  # (request_id, command) of the run of "send" requests being gathered
+        for request_id, operation, payload in batch:
+            if operation == "send":
+                sends.append((request_id, payload))
+                continue
+            if sends:
+                send_all(sends)  # Keeps the order of the commands relative to the other requests
+                sends = []
+            try:
+                if operation == "batch":
+                    answer_all(request_id, hub.send_commands(payload))
+                elif operation == "broadcast":
+                    device_type, command, args = payload
+                    devices = hub.query(device_type) if device_type is not None else list(hub.devices.values())
+                    answer_all(request_id, hub.send_commands([(device.device_id, command, args) for device in devices]),
+                               [device.device_id for device in devices])
+                else:
+                    answer(request_id, True, _serve(hub, operation, payload))
+            except Exception as error:
+                answer(request_id, False, error)
+        if sends:
+            send_all(sends)
+    with ready:
+        stopping.append(True)
+        ready.notify()
+    sender.join()
+    connection.close()
+
+
+# Returns the answers of batch with every answer that can't be pickled replaced by an error answer
+def _picklable(batch):
+    answers = []
+    for request_id, ok, value in batch:
+        try:
+            pickle.dumps(value)
+        except Exception as error:
+            ok, value = False, pickle.PicklingError(f"The answer of request {request_id} can't be sent: {error!r}")
+        answers.append((request_id, ok, value))
+    return answers
+
+
+# Runs a request that doesn't send commands on a shard's hub and returns its result
+def _serve(hub, operation, payload):
+    if operation == "status":
+        return hub.get_device_status(payload)
+    if operation == "add":
+        hub.add_device(payload)
+    elif operation == "remove":
+        hub.remove_device(payload)
+    elif operation == "query":
+        device_type, conditions = payload
+        return hub.query(device_type, **conditions)
+    elif operation == "shutdown":
+        drain, timeout = payload
+        return hub.shutdown(drain=drain, timeout=timeout)
+    else:
+        raise ValueError(f"Unknown shard operation '{operation}'")
+    return None
@@ -0,0 +1,898 @@
+from SmartHomeHub import *
+from Devices import *
+from Events import NullSink, set_event_sink
+from DeviceTable import DeviceTable
+from Snapshot import write_snapshot, snapshot_fields
+from Journal import CommandJournal
+from Rules import Rule, RuleEngine
+from Scheduler import Scheduler
+from Admission import AdmissionController
+from ShardedHub import ShardedHub
+from HubServer import HubServer, ClientPool
+from CommandCodec import CommandEncoder, CommandDecoder
+from Telemetry import TelemetryStore
+from Events import make_event
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+'''
+Purpose: Benchmarks for the smart home system, run with "python SmartHomeBenchmarks.py <benchmark>"
+Contract:
+    - every benchmark function returns a dictionary of results that is printed as JSON
+    - device events go to a NullSink and hub messages are discarded while a benchmark runs
+'''
+
+
+# Discards device events and hub messages so the benchmarks don't measure console output
+@contextlib.contextmanager
+def quiet():
+    previous = set_event_sink(NullSink())
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        set_event_sink(previous)
+
+
+# Points the standard output of processes started inside the block at os.devnull, so shard processes stay quiet
+@contextlib.contextmanager
+def quiet_processes():
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)  # Inherited by the processes started in the block
+    try:
+        yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+# Measures get_device_status throughput with reader threads polling while a writer adds and removes devices
+# Compares the lock free reads with reads that take the hub lock, which is how the hub used to read
+def bench_registry_contention(devices=1000, readers=4, duration=1.0):
+    results = {"benchmark": "registry_contention", "devices": devices, "readers": readers}
+    for mode in ("locked", "lock_free"):
+        hub = SmartHomeHub()
+        with quiet():
+            for i in range(devices):
+                hub.add_device(Lightbulb(f"Light {i}"))
+        stop = threading.Event()
+        counts = [0] * readers  # Reads done by each reader thread
+        writes = [0]  # Add and remove operations done by the writer
+
+        # Polls device status until told to stop
+        def reader(index):
+            done = 0
+            ids = [f"Light {i}" for i in range(devices)]
+            while not stop.is_set():
+                for device_id in ids:
+                    if mode == "locked":
+                        with hub.lock:  # The old behaviour, every read takes the hub lock
+                            hub.get_device_status(device_id)
+                    else:
+                        hub.get_device_status(device_id)
+                done += len(ids)
+            counts[index] = done
+
+        # Adds and removes a device as fast as possible, holding the hub lock for every change
+        def writer():
+            i = 0
+            while not stop.is_set():
+                hub.add_device(Lightbulb(f"Churn {i}"))
+                hub.remove_device(f"Churn {i}")
+                i += 1
+            writes[0] = 2 * i
+
+        with quiet():
+            threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+            threads.append(threading.Thread(target=writer))
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        results[mode] = {"reads_per_sec": round(sum(counts) / elapsed), "writes_per_sec": round(writes[0] / elapsed)}
+    return results
+
+
+DEVICE_CLASSES = (Lightbulb, Thermostat, SecurityCamera, Television, Refrigerator, Lock, AirPurifier, GarageDoor)
+
+
+# Measures the bytes each device costs at several fleet sizes, with one lock per device and with striped locks
+# Device ids are created before measuring, so only the device objects themselves are counted
+def bench_device_memory(sizes=(10_000, 100_000, 1_000_000), stripes=1024):
+    results = {"benchmark": "device_memory", "stripes": stripes, "sizes": {}}
+    for size in sizes:
+        ids = [f"Device {i}" for i in range(size)]
+        row = {}
+        for mode, lock_stripes in (("lock_per_device", None), ("striped_locks", stripes)):
+            use_lock_stripes(lock_stripes)
+            try:
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                fleet = [DEVICE_CLASSES[i % len(DEVICE_CLASSES)](device_id) for i, device_id in enumerate(ids)]
+                used = tracemalloc.get_traced_memory()[0] - before
+                tracemalloc.stop()
+            finally:
+                use_lock_stripes(None)
+            row[mode] = round(used / size, 1)  # Bytes per device, including the list slot holding it
+            del fleet
+        results["sizes"][size] = row
+    return results
+
+
+# Measures fleet wide vectorized updates and aggregates on a DeviceTable against a loop over the device objects
+def bench_device_table(devices=1_000_000, loop_devices=100_000):
+    lights = [Lightbulb(f"Light {i}") for i in range(devices)]
+    table = DeviceTable()
+    start = time.perf_counter()
+    table.attach_many(lights)
+    attach = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table.update(Lightbulb, status="on", brightness=100)  # Turns on every light
+    turn_on = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dimmed = table.update(Lightbulb, where=table.select(Lightbulb, ids=[f"Light {i}" for i in range(0, devices, 3)]),
+                          brightness=40)  # Dims every third light, selected by id
+    dim = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mean = table.aggregate(Lightbulb, "brightness", "mean", where=table.select(Lightbulb, status="on"))
+    aggregate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table.update(Lightbulb, status="off", brightness=0)  # Turns off every light
+    turn_off = time.perf_counter() - start
+
+    standalone = [Lightbulb(f"Loop Light {i}") for i in range(min(devices, loop_devices))]
+    with quiet():
+        start = time.perf_counter()
+        for light in standalone:
+            light.turn_on()  # The per object path the table replaces
+        loop = time.perf_counter() - start
+    return {"benchmark": "device_table", "devices": devices, "attach_ms": round(attach * 1000, 1),
+            "turn_on_all_ms": round(turn_on * 1000, 2), "dim_selected_ms": round(dim * 1000, 2),
+            "dimmed": dimmed, "mean_brightness": mean, "aggregate_ms": round(aggregate * 1000, 2),
+            "turn_off_all_ms": round(turn_off * 1000, 2), "object_loop_devices": len(standalone),
+            "object_loop_ms": round(loop * 1000, 1)}
+
+
+# Compares the binary snapshot with pickle and JSON for saving and restoring the same fleet
+# Restoring the snapshot is lazy, so the time to build a sample of devices afterwards is reported as well
+def bench_snapshot(devices=1_000_000, sample=1000):
+    fleet = [DEVICE_CLASSES[i % len(DEVICE_CLASSES)](f"Device {i}") for i in range(devices)]
+    # pickle and JSON get the same state the snapshot stores, devices themselves hold unpicklable locks
+    fields = {cls: [name for name, _ in snapshot_fields(cls)] for cls in DEVICE_CLASSES}
+    state = [(type(d).__name__, d.device_id, {name: getattr(d, name) for name in fields[type(d)]}) for d in fleet]
+    results = {"benchmark": "snapshot", "devices": devices}
+    sample_ids = random.Random(0).sample([d.device_id for d in fleet], min(sample, devices))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "fleet")
+
+        start = time.perf_counter()
+        write_snapshot(fleet, path + ".snap")
+        save = time.perf_counter() - start
+        hub = SmartHomeHub(event_sink=NullSink())
+        start = time.perf_counter()
+        hub.load_snapshot(path + ".snap")
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        for device_id in sample_ids:
+            hub.get_device_status(device_id)  # Builds the device on first access
+        first_access = time.perf_counter() - start
+        results["snapshot"] = {"save_s": round(save, 3), "load_s": round(load, 3),
+                               "first_access_us": round(first_access / len(sample_ids) * 1e6, 2),
+                               "bytes": os.path.getsize(path + ".snap")}
+
+        start = time.perf_counter()
+        with open(path + ".pickle", "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        save = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path + ".pickle", "rb") as file:
+            pickle.load(file)
+        load = time.perf_counter() - start
+        results["pickle"] = {"save_s": round(save, 3), "load_s": round(load, 3),
+                             "bytes": os.path.getsize(path + ".pickle")}
+
+        start = time.perf_counter()
+        with open(path + ".json", "w") as file:
+            json.dump(state, file)
+        save = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(path + ".json") as file:
+            json.load(file)
+        load = time.perf_counter() - start
+        results["json"] = {"save_s": round(save, 3), "load_s": round(load, 3), "bytes": os.path.getsize(path + ".json")}
+    return results
+
+
+# Measures journaled command throughput with group commit, from sending the commands to every entry being durable
+# Also reports the raw append rate of the journal and the replay rate
+def bench_journal(commands=200_000, devices=1000, workers=4, flush_interval=0.005, fsync=True):
+    with tempfile.TemporaryDirectory() as directory:
+        journal = CommandJournal(directory, flush_interval=flush_interval, fsync=fsync)
+        hub = SmartHomeHub(executor="lanes", workers=workers, event_sink=NullSink(), journal=journal)
+        with quiet():
+            for i in range(devices):
+                hub.add_device(Lightbulb(f"Light {i}"))
+        batch = [(f"Light {i % devices}", "change_brightness", (i % 100,)) for i in range(commands)]
+        start = time.perf_counter()
+        futures = []
+        for offset in range(0, commands, 1000):
+            futures.extend(hub.send_commands(batch[offset:offset + 1000]))
+        wait_all(futures)
+        journaled = time.perf_counter() - start
+        hub.shutdown()
+
+        start = time.perf_counter()
+        for i in range(commands):
+            journal.append("Light 0", "change_brightness", (i % 100,))
+        journal.sync()
+        append = time.perf_counter() - start
+
+        restored = SmartHomeHub(event_sink=NullSink(), journal=journal)
+        with quiet():
+            for i in range(devices):
+                restored.add_device(Lightbulb(f"Light {i}"))
+        start = time.perf_counter()
+        replayed = restored.replay()
+        replay = time.perf_counter() - start
+        journal.close()
+        size = sum(os.path.getsize(path) for _, path in journal.segments())
+    return {"benchmark": "journal", "commands": commands, "fsync": fsync,
+            "journaled_commands_per_sec": round(commands / journaled),
+            "appends_per_sec": round(commands / append), "replayed": replayed,
+            "replayed_per_sec": round(replayed / replay), "journal_bytes": size}
+
+
+# Measures command throughput with no subscribers and with many subscribers on the hub's event bus
+# Subscribers watch one device each, except a few that watch a field across every device
+def bench_event_bus(commands=100_000, devices=1000, subscribers=1000, workers=4):
+    results = {"benchmark": "event_bus", "commands": commands, "devices": devices}
+    for count in (0, subscribers):
+        hub = SmartHomeHub(executor="lanes", workers=workers, event_sink=NullSink())
+        with quiet():
+            for i in range(devices):
+                hub.add_device(Television(f"TV {i}"))
+        subscriptions = [hub.subscribe(device_id=f"TV {i % devices}") for i in range(count - count // 100)]
+        subscriptions += [hub.subscribe(field="volume", policy="coalesce") for _ in range(count // 100)]
+        batch = [(f"TV {i % devices}", "set_volume", (i % 100,)) for i in range(commands)]
+        start = time.perf_counter()
+        futures = []
+        for offset in range(0, commands, 1000):
+            futures.extend(hub.send_commands(batch[offset:offset + 1000]))
+        wait_all(futures)
+        elapsed = time.perf_counter() - start
+        hub.bus.flush()
+        delivered = time.perf_counter() - start
+        hub.shutdown()
+        results[f"{count}_subscribers"] = {
+            "commands_per_sec": round(commands / elapsed), "delivered_ms": round(delivered * 1000, 1),
+            "buffered": sum(len(s.buffer) for s in subscriptions), "dropped": sum(s.dropped for s in subscriptions)}
+    return results
+
+
+# Sends a slider storm of set_volume commands, with a turn_on every barrier_every commands per device,
+# with and without coalescing, and reports how many handler calls (device work) each mode needed
+def bench_coalescing(devices=100, commands=100_000, workers=4, barrier_every=100):
+    results = {"benchmark": "coalescing", "devices": devices, "commands": commands}
+    for coalesce in (False, True):
+        hub = SmartHomeHub(executor="lanes", workers=workers, event_sink=NullSink(), metrics=True,
+                           coalesce=coalesce)
+        with quiet():
+            for i in range(devices):
+                hub.add_device(Television(f"TV {i}"))
+        # Every device gets a turn_on as its barrier_every-th command, which setters can't be coalesced across
+        batch = [(f"TV {i % devices}", "turn_on", ()) if (i // devices) % barrier_every == 0 else
+                 (f"TV {i % devices}", "set_volume", (i % 101,)) for i in range(commands)]
+        start = time.perf_counter()
+        futures = []
+        for offset in range(0, commands, 1000):
+            futures.extend(hub.send_commands(batch[offset:offset + 1000]))
+        wait_all(futures)
+        elapsed = time.perf_counter() - start
+        hub.shutdown()
+        metrics = hub.metrics()
+        runs = sum(command["latency"]["count"] for command in metrics["commands"].values())
+        results["coalesced" if coalesce else "plain"] = {
+            "commands_per_sec": round(commands / elapsed), "handler_calls": runs,
+            "coalesced": metrics["coalesced"], "work_reduction": round(commands / runs, 1)}
+    return results
+
+
+# Measures rule evaluation with the (device, field) index against checking every rule on every event
+# Then feeds a paced stream of rate events per second for duration seconds and reports how busy the engine was
+def bench_rules(rules=10_000, devices=5000, events=100_000, rate=10_000, duration=1.0):
+    fields = (("Smart Lightbulb", "brightness", lambda value: value > 80), ("Lock", "is_locked", False),
+              ("Garage Door", "is_open", True), ("Thermostat", "temperature", lambda value: value < 60))
+    fired = [0]
+
+    # Action of every rule, counts the firings instead of sending commands so only the engine is measured
+    def count(rule, event):
+        fired[0] += 1
+
+    engine = RuleEngine(None, timer=False)
+    for i in range(rules):
+        _, field, condition = fields[i % len(fields)]
+        engine.add(Rule(f"Rule {i}", field, condition, (count,), device_id=f"Device {i % devices}"))
+    generator = random.Random(0)
+    stream = []
+    for _ in range(events):
+        device = generator.randrange(devices * 2)  # Half of the events come from devices without rules
+        device_type, field, _ = fields[device % len(fields)]
+        stream.append(make_event(f"Device {device}", device_type, "change", field, None, generator.randrange(100),
+                                 None))
+
+    start = time.perf_counter()
+    for event in stream:
+        engine.evaluate(event)
+    indexed = time.perf_counter() - start
+
+    naive_events = stream[:min(len(stream), 2000)]
+    all_rules = list(engine.rules.values())
+    start = time.perf_counter()
+    for event in naive_events:
+        for rule in all_rules:  # What an engine without the index does
+            if rule.device_id == event.device_id and rule.field == event.field and rule.matches(event.new):
+                count(rule, event)
+    naive = time.perf_counter() - start
+
+    busy = 0.0
+    late = 0.0
+    interval = 1.0 / rate
+    sent = int(rate * duration)
+    begin = time.perf_counter()
+    for n in range(sent):
+        due = begin + n * interval
+        now = time.perf_counter()
+        if now < due:
+            time.sleep(due - now)
+        else:
+            late = max(late, now - due)
+        start = time.perf_counter()
+        engine.evaluate(stream[n % len(stream)])
+        busy += time.perf_counter() - start
+    elapsed = time.perf_counter() - begin
+    return {"benchmark": "rules", "rules": rules, "indexed_events_per_sec": round(len(stream) / indexed),
+            "naive_events_per_sec": round(len(naive_events) / naive), "fired": fired[0],
+            "stream": {"rate": rate, "events": sent, "elapsed_s": round(elapsed, 3),
+                       "busy_fraction": round(busy / elapsed, 4), "max_lag_ms": round(late * 1000, 2)}}
+
+
+# Measures scheduling, cancelling and firing timers on the timing wheel, with a simulated clock
+# The hub is replaced by a counter so only the scheduler is measured
+def bench_scheduler(timers=200_000, horizon=3600.0, cancel_fraction=0.5):
+
+    # Stands in for the hub, counts the commands sent and checks none of them ran early
+    class Counter:
+        sent = 0
+        early = 0
+
+        def send_command(self, device_id, command, *args):
+            Counter.sent += 1
+            if args[0] > now[0]:
+                Counter.early += 1
+
+    now = [1_000_000.0]
+    scheduler = Scheduler(Counter(), clock=lambda: now[0], driver=False)
+    generator = random.Random(0)
+    deadlines = [now[0] + generator.uniform(0, horizon) for _ in range(timers)]
+    start = time.perf_counter()
+    handles = [scheduler.schedule(deadline, "Device", "turn_off", (deadline,)) for deadline in deadlines]
+    schedule = time.perf_counter() - start
+
+    cancelled = handles[:int(timers * cancel_fraction)]
+    start = time.perf_counter()
+    for handle in cancelled:
+        scheduler.cancel(handle)
+    cancel = time.perf_counter() - start
+
+    start = time.perf_counter()
+    while now[0] < 1_000_000.0 + horizon + 1:
+        now[0] += 1.0  # One simulated second per step
+        scheduler.advance()
+    fire = time.perf_counter() - start
+    return {"benchmark": "scheduler", "timers": timers, "schedule_us": round(schedule / timers * 1e6, 2),
+            "cancel_us": round(cancel / max(1, len(cancelled)) * 1e6, 2), "sent": Counter.sent,
+            "sent_early": Counter.early, "fire_all_s": round(fire, 3),
+            "fire_us_per_timer": round(fire / max(1, Counter.sent) * 1e6, 2)}
+
+
+# Commands each device class receives in the throughput benchmark, as (command, args) pairs
+COMMAND_MIX = {
+    Lightbulb: (("turn_on", ()), ("change_brightness", (75,)), ("turn_off", ())),
+    Thermostat: (("turn_on", ()), ("set_temperature", (70.5,)), ("turn_off", ())),
+    SecurityCamera: (("turn_on", ()), ("detect_motion", ()), ("turn_off", ())),
+    Television: (("turn_on", ()), ("set_volume", (30,)), ("change_source", ("HDMI 1",)), ("turn_off", ())),
+    Refrigerator: (("set_refrigerator_temp", (38,)), ("set_freezer_temp", (0,)), ("door_status", (True,)),
+                   ("door_status", (False,))),
+    Lock: (("unlock", ()), ("get_lock_status", ()), ("lock", ())),
+    AirPurifier: (("turn_on", ()), ("set_purification_level", (2,)), ("set_fan_speed", (3,)),
+                  ("get_fan_speed", ()), ("turn_off", ())),
+    GarageDoor: (("open_door", ()), ("close_door", ())),
+}
+
+
+# Returns the p50, p95, p99 and p999 of a list of latencies in seconds, in milliseconds
+def latency_percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {name: round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+            for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999))}
+
+
+# Returns the resident set size of the process in bytes, or None where /proc isn't available
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Drives a hub with every device class and the COMMAND_MIX from several client threads, once per executor mode
+# Reports commands/sec, latency percentiles from send_command() to handler completion, memory and peak thread count
+# Without a rate the clients send as fast as they can, so latencies include queueing, with a rate (commands/sec
+# across all clients) they are paced and the latencies show the service time at that load
+# metrics runs the hubs with metrics enabled, to measure the cost of the instrumentation
+def bench_throughput(devices=1000, commands=50_000, clients=4, executors=("thread", "pool", "lanes"), workers=4,
+                     rate=None, metrics=False):
+    classes = list(COMMAND_MIX)
+    results = {"benchmark": "throughput", "devices": devices, "commands": commands, "clients": clients,
+               "workers": workers, "rate": rate, "metrics": metrics, "executors": {}}
+    for mode in executors:
+        hub = SmartHomeHub(executor=mode, workers=workers, queue_size=4096, event_sink=NullSink(), metrics=metrics)
+        with quiet():
+            for i in range(devices):
+                hub.add_device(classes[i % len(classes)](f"Device {i}"))
+        plan = []  # (device_id, command, args) in the order the clients send them
+        for n in range(commands):
+            device = n % devices
+            mix = COMMAND_MIX[classes[device % len(classes)]]
+            command, args = mix[(n // devices) % len(mix)]
+            plan.append((f"Device {device}", command, args))
+        latencies = [[] for _ in range(clients)]  # Latencies recorded for each client
+        peak_threads = [threading.active_count()]
+        done = threading.Event()
+
+        # Samples the thread count while the commands run
+        def monitor():
+            while not done.wait(0.005):
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+        # Sends every clients-th command of the plan and records each latency when its Future resolves
+        def client(index):
+            futures = []
+            record = latencies[index].append
+            interval = clients / rate if rate else 0.0  # Seconds between the commands of this client
+            begin = time.perf_counter()
+            for n, (device_id, command, args) in enumerate(plan[index::clients]):
+                if interval:
+                    delay = begin + n * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                sent = time.perf_counter()
+                future = hub.send_command(device_id, command, *args)
+                future.add_done_callback(lambda _, sent=sent: record(time.perf_counter() - sent))
+                futures.append(future)
+            wait_all(futures, return_exceptions=True)
+
+        memory_before = resident_memory()
+        sampler = threading.Thread(target=monitor)
+        sampler.start()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        with quiet():
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            hub.shutdown()
+        done.set()
+        sampler.join()
+        memory_after = resident_memory()
+        samples = [latency for client_latencies in latencies for latency in client_latencies]
+        results["executors"][mode] = {
+            "commands_per_sec": round(commands / elapsed), "latency_ms": latency_percentiles(samples),
+            "peak_threads": peak_threads[0],
+            "rss_mb": None if memory_after is None else round(memory_after / 2 ** 20, 1),
+            "rss_growth_mb": None if memory_before is None else round((memory_after - memory_before) / 2 ** 20, 1)}
+    return results
+
+
+# Television whose set_volume takes service_time seconds on a radio link that serves one command at a time
+class SlowTelevision(Television):
+    service_time = 0.001
+    link = threading.Lock()  # Simulated radio link
+
+    # Sets the volume after waiting for the simulated device
+    def set_volume(self, volume):
+        with self.link:
+            time.sleep(self.service_time)
+        super().set_volume(volume)
+
+
+# Floods one slow device from a client that sends as fast as it can, while another client sends paced commands
+# to the other devices, once without admission control and once with an in-flight limit and a rate limit per device
+# Reports the latency of the paced commands, how many flood commands were rejected and the peak thread count
+def bench_admission(executor="thread", devices=100, flood=20_000, paced=2000, rate=1000, max_in_flight=256,
+                    device_rate=500, service_time=0.001, workers=4):
+    results = {"benchmark": "admission", "executor": executor, "flood": flood, "paced": paced, "rate": rate}
+    SlowTelevision.service_time = service_time
+    for limited in (False, True):
+        admission = AdmissionController(max_in_flight=max_in_flight, rate=device_rate, policy="reject") \
+            if limited else None
+        hub = SmartHomeHub(executor=executor, workers=workers, queue_size=4096, event_sink=NullSink(),
+                           admission=admission)
+        with quiet():
+            hub.add_device(SlowTelevision("TV 0"))
+            for i in range(1, devices):
+                hub.add_device(Television(f"TV {i}"))
+        latencies = []
+        peak_threads = [threading.active_count()]
+        done = threading.Event()
+
+        # Samples the thread count while the commands run
+        def monitor():
+            while not done.wait(0.005):
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+        # Sends the flood to TV 0 without pacing
+        def flooder():
+            futures = [hub.send_command("TV 0", "set_volume", i % 101) for i in range(flood)]
+            wait_all(futures, return_exceptions=True)
+
+        # Sends paced commands to the other devices and records their latencies
+        def client():
+            futures = []
+            begin = time.perf_counter()
+            for n in range(paced):
+                delay = begin + n / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                sent = time.perf_counter()
+                future = hub.send_command(f"TV {1 + n % (devices - 1)}", "set_volume", n % 101)
+                future.add_done_callback(lambda _, sent=sent: latencies.append(time.perf_counter() - sent))
+                futures.append(future)
+            wait_all(futures, return_exceptions=True)
+
+        threads = [threading.Thread(target=monitor), threading.Thread(target=flooder), threading.Thread(target=client)]
+        with quiet():
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads[1:]:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            hub.shutdown()
+        done.set()
+        threads[0].join()
+        results["limited" if limited else "unlimited"] = {
+            "elapsed_s": round(elapsed, 2), "paced_latency_ms": latency_percentiles(latencies),
+            "rejected": admission.rejected if limited else 0, "peak_threads": peak_threads[0]}
+    return results
+
+
+# Measures batched command throughput of a ShardedHub at several shard counts, against one in-process hub
+# parent_us_per_command is the CPU the routing process spends per command, it bounds how far the shards can scale
+def bench_sharding(devices=1000, commands=200_000, shard_counts=None, batch=1000, workers=4):
+    shard_counts = shard_counts or sorted({1, 2, os.cpu_count() or 1})
+    plan = [(f"TV {i % devices}", "set_volume", (i % 101,)) for i in range(commands)]
+    results = {"benchmark": "sharding", "devices": devices, "commands": commands, "cpus": os.cpu_count()}
+    for shards in [0] + list(shard_counts):
+        with quiet(), quiet_processes():
+            if shards:
+                hub = ShardedHub(shards=shards, workers=workers, event_sink=NullSink())
+            else:
+                hub = SmartHomeHub(executor="lanes", workers=workers, event_sink=NullSink())
+            for i in range(devices):
+                hub.add_device(Television(f"TV {i}"))
+        start, cpu = time.perf_counter(), time.process_time()
+        if shards:
+            wait_all([hub.send_batch(plan[offset:offset + batch]) for offset in range(0, commands, batch)])
+        else:
+            wait_all([future for offset in range(0, commands, batch)
+                      for future in hub.send_commands(plan[offset:offset + batch])])
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+        with quiet():
+            hub.shutdown()
+        results[f"{shards}_shards" if shards else "in_process"] = {
+            "commands_per_sec": round(commands / elapsed), "parent_us_per_command": round(cpu / commands * 1e6, 2)}
+    return results
+
+
+# Measures pipelined command throughput through a HubServer on a Unix domain socket or loopback TCP
+# Client and server share this process, so on few cores the client side's own CPU is part of the figure
+def bench_server(devices=1000, commands=200_000, connections=4, batch=1000, tcp=False, direct=False, workers=4):
+    results = {"benchmark": "server", "devices": devices, "commands": commands, "connections": connections,
+               "transport": "tcp" if tcp else "unix", "direct": direct, "cpus": os.cpu_count()}
+    plan = [(f"TV {i % devices}", "set_volume", (i % 101,)) for i in range(commands)]
+    with quiet():
+        hub = SmartHomeHub(executor="lanes", workers=workers, event_sink=NullSink())
+        for i in range(devices):
+            hub.add_device(Television(f"TV {i}"))
+    with tempfile.TemporaryDirectory() as directory:
+        server = HubServer(hub, ("127.0.0.1", 0) if tcp else os.path.join(directory, "hub.sock"), direct=direct)
+        with ClientPool(server.start(), size=connections) as pool:
+            pool.send_command("TV 0", "turn_on").result()  # Opens a connection before the clock starts
+            start = time.perf_counter()
+            futures = []
+            for offset in range(0, commands, batch):
+                futures.extend(pool.send_commands(plan[offset:offset + batch]))
+            wait_all(futures)
+            elapsed = time.perf_counter() - start
+        server.close()
+    with quiet():
+        hub.shutdown()
+    results["commands_per_sec"] = round(commands / elapsed)
+    return results
+
+
+# Measures the CommandCodec encode and decode cost per command, and its size, against JSON and pickle
+def bench_codec(commands=200_000, devices=1000):
+    plan = [(f"TV {i % devices}", "set_volume", (i % 101,)) for i in range(commands)]
+    encoder = CommandEncoder()
+    encoder.encode_many(plan[:devices])  # Steady state, every device is defined already
+    start = time.perf_counter()
+    for device_id, command, args in plan:
+        encoder.encode(device_id, command, args)
+    encode = time.perf_counter() - start
+    data = CommandEncoder().encode_many(plan)  # One stream, the definitions are a small part of it
+    start = time.perf_counter()
+    decoded = CommandDecoder().decode(data)
+    decode = time.perf_counter() - start
+    assert decoded == plan
+    start = time.perf_counter()
+    text = json.dumps(plan)
+    json.loads(text)
+    json_round_trip = time.perf_counter() - start
+    start = time.perf_counter()
+    pickled = pickle.dumps(plan, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(pickled)
+    pickle_round_trip = time.perf_counter() - start
+    return {"benchmark": "codec", "commands": commands, "devices": devices,
+            "encode_us_per_command": round(encode / commands * 1e6, 3),
+            "decode_us_per_command": round(decode / commands * 1e6, 3),
+            "bytes_per_command": round(len(data) / commands, 2),
+            "json_round_trip_us_per_command": round(json_round_trip / commands * 1e6, 3),
+            "json_bytes_per_command": round(len(text) / commands, 2),
+            "pickle_round_trip_us_per_command": round(pickle_round_trip / commands * 1e6, 3),
+            "pickle_bytes_per_command": round(len(pickled) / commands, 2)}
+
+
+# Measures reads of one lightbulb's status and brightness while a writer keeps turning it on and off
+# Compares reads that take the device lock with optimistic reads checked against the device version
+def bench_device_reads(readers=4, duration=1.0):
+    results = {"benchmark": "device_reads", "readers": readers}
+    for mode in ("locked", "optimistic"):
+        bulb = Lightbulb("Dashboard Light")
+        bulb.event_sink = NullSink()
+        stop = threading.Event()
+        counts = [0] * readers  # Reads done by each reader thread
+        torn = [0] * readers  # Reads that saw the bulb on with brightness 0 or off with brightness 100
+        writes = [0]  # Transitions done by the writer
+
+        # Reads status and brightness together until told to stop
+        def reader(index):
+            done = bad = 0
+            while not stop.is_set():
+                for _ in range(1000):
+                    if mode == "locked":
+                        with bulb.lock:
+                            state = (bulb.status, bulb.brightness)
+                    else:
+                        state = tuple(bulb.read_fields("status", "brightness"))
+                    bad += state not in (("on", 100), ("off", 0))
+                done += 1000
+            counts[index], torn[index] = done, bad
+
+        # Turns the bulb on and off as fast as possible
+        def writer():
+            i = 0
+            while not stop.is_set():
+                bulb.turn_on()
+                bulb.turn_off()
+                i += 1
+            writes[0] = 2 * i
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+        threads.append(threading.Thread(target=writer))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results[mode] = {"reads_per_sec": round(sum(counts) / elapsed), "writes_per_sec": round(writes[0] / elapsed),
+                         "torn_reads": sum(torn)}
+    return results
+
+
+# Measures telemetry recording and 24 hour queries across a fleet of thermostats with a sample every interval
+def bench_telemetry(devices=10_000, hours=24, interval=300.0, records=100_000):
+    store = TelemetryStore(capacity=devices)
+    ids = [f"Thermostat {i}" for i in range(devices)]
+    base = [60 + 20 * i / devices for i in range(devices)]  # Each thermostat hovers around its own temperature
+    steps = int(hours * 3600 / interval)
+    start = time.perf_counter()
+    for step in range(steps):
+        drift = math.sin(step / 12)
+        store.record_many("temperature", ids, step * interval, [temp + drift for temp in base])
+    bulk = time.perf_counter() - start
+    end = steps * interval
+    results = {"benchmark": "telemetry", "devices": devices, "samples": steps * devices,
+               "record_many_us_per_sample": round(bulk / (steps * devices) * 1e6, 3)}
+    for name, query in (("aggregate_24h_ms", lambda: store.aggregate("temperature", end - 86400, end)),
+                        ("history_24h_hourly_ms", lambda: store.history("temperature", end - 86400, end)),
+                        ("aggregate_6h_minutes_ms", lambda: store.aggregate("temperature", end - 21600, end,
+                                                                            resolution="minute")),
+                        ("aggregate_raw_ms", lambda: store.aggregate("temperature", end - 3600, end, resolution="raw")),
+                        ("samples_one_series_ms", lambda: store.samples(ids[0], "temperature", end - 3600, end))):
+        start = time.perf_counter()
+        query()
+        results[name] = round((time.perf_counter() - start) * 1e3, 3)
+    start = time.perf_counter()
+    for i in range(records):
+        store.record(ids[i % devices], "temperature", end + i * 1e-3, 70.0)  # One sample per device event
+    store.flush()
+    results["record_us_per_sample"] = round((time.perf_counter() - start) / records * 1e6, 3)
+    results["bytes_per_series"] = round(store.nbytes() / store.series_count())
+    return results
+
+
+# Builds the command line parser, with one sub-command per benchmark
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run a smart home benchmark and print its results as JSON")
+    parser.add_argument("--output", help="also write the JSON results to this file, e.g. to compare runs")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    contention = benchmarks.add_parser("contention", help="get_device_status throughput under write load")
+    contention.set_defaults(function=bench_registry_contention)
+    contention.add_argument("--devices", type=int, default=1000)
+    contention.add_argument("--readers", type=int, default=4)
+    contention.add_argument("--duration", type=float, default=1.0)
+
+    memory = benchmarks.add_parser("memory", help="bytes per device at several fleet sizes")
+    memory.set_defaults(function=bench_device_memory)
+    memory.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    memory.add_argument("--stripes", type=int, default=1024)
+
+    table = benchmarks.add_parser("table", help="vectorized DeviceTable updates against a per object loop")
+    table.set_defaults(function=bench_device_table)
+    table.add_argument("--devices", type=int, default=1_000_000)
+    table.add_argument("--loop-devices", dest="loop_devices", type=int, default=100_000)
+
+    snapshot = benchmarks.add_parser("snapshot", help="binary snapshot against pickle and JSON")
+    snapshot.set_defaults(function=bench_snapshot)
+    snapshot.add_argument("--devices", type=int, default=1_000_000)
+    snapshot.add_argument("--sample", type=int, default=1000)
+
+    journal = benchmarks.add_parser("journal", help="journaled command throughput with group commit")
+    journal.set_defaults(function=bench_journal)
+    journal.add_argument("--commands", type=int, default=200_000)
+    journal.add_argument("--devices", type=int, default=1000)
+    journal.add_argument("--workers", type=int, default=4)
+    journal.add_argument("--flush-interval", dest="flush_interval", type=float, default=0.005)
+    journal.add_argument("--no-fsync", dest="fsync", action="store_false")
+
+    bus = benchmarks.add_parser("bus", help="command throughput with event bus subscribers")
+    bus.set_defaults(function=bench_event_bus)
+    bus.add_argument("--commands", type=int, default=100_000)
+    bus.add_argument("--devices", type=int, default=1000)
+    bus.add_argument("--subscribers", type=int, default=1000)
+    bus.add_argument("--workers", type=int, default=4)
+
+    coalescing = benchmarks.add_parser("coalescing", help="device work under a setter storm with coalescing")
+    coalescing.set_defaults(function=bench_coalescing)
+    coalescing.add_argument("--devices", type=int, default=100)
+    coalescing.add_argument("--commands", type=int, default=100_000)
+    coalescing.add_argument("--workers", type=int, default=4)
+    coalescing.add_argument("--barrier-every", dest="barrier_every", type=int, default=100)
+
+    rules = benchmarks.add_parser("rules", help="indexed rule evaluation against a full scan")
+    rules.set_defaults(function=bench_rules)
+    rules.add_argument("--rules", type=int, default=10_000)
+    rules.add_argument("--devices", type=int, default=5000)
+    rules.add_argument("--events", type=int, default=100_000)
+    rules.add_argument("--rate", type=int, default=10_000)
+    rules.add_argument("--duration", type=float, default=1.0)
+
+    scheduler = benchmarks.add_parser("scheduler", help="timing wheel schedule, cancel and fire costs")
+    scheduler.set_defaults(function=bench_scheduler)
+    scheduler.add_argument("--timers", type=int, default=200_000)
+    scheduler.add_argument("--horizon", type=float, default=3600.0)
+    scheduler.add_argument("--cancel-fraction", dest="cancel_fraction", type=float, default=0.5)
+
+    throughput = benchmarks.add_parser("throughput", help="commands/sec and latency percentiles per executor")
+    throughput.set_defaults(function=bench_throughput)
+    throughput.add_argument("--devices", type=int, default=1000)
+    throughput.add_argument("--commands", type=int, default=50_000)
+    throughput.add_argument("--clients", type=int, default=4)
+    throughput.add_argument("--executors", nargs="+", default=["thread", "pool", "lanes"],
+                            choices=["thread", "pool", "lanes"])
+    throughput.add_argument("--workers", type=int, default=4)
+    throughput.add_argument("--rate", type=float, help="commands/sec across all clients, unpaced by default")
+    throughput.add_argument("--metrics", action="store_true", help="enable the hub's metrics")
+
+    admission = benchmarks.add_parser("admission", help="paced command latency while one device is flooded")
+    admission.set_defaults(function=bench_admission)
+    admission.add_argument("--executor", default="thread", choices=["thread", "pool", "lanes"])
+    admission.add_argument("--devices", type=int, default=100)
+    admission.add_argument("--flood", type=int, default=20_000)
+    admission.add_argument("--paced", type=int, default=2000)
+    admission.add_argument("--rate", type=float, default=1000)
+    admission.add_argument("--max-in-flight", dest="max_in_flight", type=int, default=256)
+    admission.add_argument("--device-rate", dest="device_rate", type=float, default=500)
+    admission.add_argument("--service-time", dest="service_time", type=float, default=0.001)
+    admission.add_argument("--workers", type=int, default=4)
+
+    sharding = benchmarks.add_parser("sharding", help="batched command throughput per number of shard processes")
+    sharding.set_defaults(function=bench_sharding)
+    sharding.add_argument("--devices", type=int, default=1000)
+    sharding.add_argument("--commands", type=int, default=200_000)
+    sharding.add_argument("--shards", dest="shard_counts", type=int, nargs="+", help="shard counts to measure")
+    sharding.add_argument("--batch", type=int, default=1000)
+    sharding.add_argument("--workers", type=int, default=4)
+
+    server = benchmarks.add_parser("server", help="pipelined command throughput through a HubServer")
+    server.set_defaults(function=bench_server)
+    server.add_argument("--devices", type=int, default=1000)
+    server.add_argument("--commands", type=int, default=200_000)
+    server.add_argument("--connections", type=int, default=4)
+    server.add_argument("--batch", type=int, default=1000)
+    server.add_argument("--tcp", action="store_true", help="loopback TCP instead of a Unix domain socket")
+    server.add_argument("--direct", action="store_true", help="run non-blocking commands on the reader threads")
+    server.add_argument("--workers", type=int, default=4)
+
+    codec = benchmarks.add_parser("codec", help="binary command encoding against JSON and pickle")
+    codec.set_defaults(function=bench_codec)
+    codec.add_argument("--commands", type=int, default=200_000)
+    codec.add_argument("--devices", type=int, default=1000)
+
+    reads = benchmarks.add_parser("reads", help="optimistic device reads against locked reads under write load")
+    reads.set_defaults(function=bench_device_reads)
+    reads.add_argument("--readers", type=int, default=4)
+    reads.add_argument("--duration", type=float, default=1.0)
+
+    telemetry = benchmarks.add_parser("telemetry", help="telemetry recording and 24 hour fleet queries")
+    telemetry.set_defaults(function=bench_telemetry)
+    telemetry.add_argument("--devices", type=int, default=10_000)
+    telemetry.add_argument("--hours", type=float, default=24)
+    telemetry.add_argument("--interval", type=float, default=300.0)
+    telemetry.add_argument("--records", type=int, default=100_000)
+    return parser
+
+
+if __name__ == "__main__":
+    options = vars(build_parser().parse_args())
+    options.pop("benchmark")
+    output = options.pop("output")
+    function = options.pop("function")  # Benchmark chosen on the command line
+    report = json.dumps(function(**options), indent=2)
+    print(report)
+    if output:
+        with open(output, "w") as file:
+            file.write(report + "\n")
@@ -1,23 +1,111 @@
 from Devices import *
+from Commands import registry, DeviceNotFoundError, UnsupportedCommandError
+from Executors import ThreadPerCommandExecutor, WorkerPoolExecutor, DeviceLaneExecutor
+from DeviceTable import DeviceTable
+from DeviceIndex import DeviceIndex
+from Events import get_event_sink
+from EventBus import EventBus
+from Rules import RuleEngine
+from Scheduler import Scheduler, CronSpec
+from Metrics import HubMetrics, InstrumentedLock, PrometheusExporter
+from Admission import AdmissionError
+from Snapshot import write_snapshot, SnapshotReader, LazyDeviceMap
+from CommandCodec import DeviceHandles, CommandEncoder, CommandDecoder
+from concurrent.futures import Future
+import concurrent.futures
 import threading
+import time
+
+_running = threading.local()  # running is True on a thread while it runs an admitted command
 
 '''
 Purpose: Act as a central hub and management system for all the devices in the smart home
 Contract:
     - add_device() adds a new device to the smart home system
     - remove_device() removes a device from the smart home system
-    - get_device_status() returns the status of a given device 
-    - send_command() sends a command to be executed by the given device class
-    - execute_device_command() executes the given command if the device can receive it 
+    - get_device_status() returns the status of a given device, without waiting for add_device()/remove_device()
+    - send_command() sends a command to be executed by the given device class, returns a Future of its result
+    - send_commands() sends a batch of (device_id, command, args) commands, returns their Futures in input order
+    - every device gets an integer handle when it is added, command_encoder() encodes commands in the compact
+      CommandCodec format using those handles, send_encoded() sends the commands of an encoded buffer
+    - execute_device_command() executes the given command if the device can receive it, raises if it can't
+    - shutdown() stops the command executor, optionally draining the commands still queued
+    - query() returns the devices matching a device_type and indexed field values or ranges, using the secondary
+      indexes
+    - bulk_update() applies a vectorized update to the DeviceTable and keeps the indexes in step
+    - save_snapshot() writes the state of every device to a compact, versioned binary file
+    - load_snapshot() restores the devices of a snapshot, each device is only built on first access, query() indexes
+      them from the mapped file and only builds the devices it returns
+    - with a journal, every state changing command is appended to it once applied, and the Future of a command
+      sent through send_command() only resolves once its journal entry is durable
+    - checkpoint() snapshots the hub into the journal and compacts it, replay() rebuilds state after a crash
+    - subscribe() returns a Subscription that receives the change events of matching devices, instead of polling
+    - add_rule() and remove_rule() manage automation rules, which are evaluated against every device event
+    - schedule_at(), schedule_after() and schedule_cron() send a command later or repeatedly, cancel() cancels it
+    - with coalescing enabled, a setter marked coalesce replaces the same setter still queued for the device,
+      when no other command was queued after it, and the Futures of both resolve with the newer command's result
+    - with an admission controller, commands over its in-flight or per-device rate limits are blocked, rejected
+      or make room by dropping older commands, a rejected or dropped command's Future fails with an AdmissionError,
+      commands sent while an admitted command runs on the same thread are rejected rather than wait for room
+    - with metrics enabled, metrics() returns command latency and dispatch wait histograms, lock wait times,
+      in-flight and error counts, and prometheus_exporter() exports them in the Prometheus text format
+    - with a telemetry store, the values of its fields are recorded when a device is added and on every change,
+      telemetry holds their raw history and minute and hour rollups, see Telemetry.TelemetryStore
 '''
 
 
 class SmartHomeHub:
     # Initializes instance of SmartHomeHub
-    def __init__(self):
-        self.devices = {}  # Dictionary to store all the devices with device_id as a key and device as value
-        self.lock = threading.Lock()  # Lock to keep dictionary modifications safe
-        self.threads = []  # List to keep track of the threads
+    # executor is "thread" (one thread per command), "pool" (fixed worker pool),
+    # "lanes" (per-device FIFO lanes drained by a worker pool) or an executor instance
+    # columnar keeps the state of every SmartDevice in a NumPy backed DeviceTable for vectorized operations
+    # indexed_fields are the device fields query() can filter on, event_sink receives the events of the hub's devices
+    # journal is a CommandJournal that records the applied commands, None disables journaling
+    # metrics instruments the command path and the hub and device locks, see Metrics.HubMetrics
+    # coalesce lets queued setters be replaced by newer ones, it needs the "lanes" executor to have an effect
+    # admission is an AdmissionController that limits the commands in flight and the rate per device
+    # telemetry is a TelemetryStore that records the history of numeric device fields, None disables it
+    def __init__(self, executor="thread", workers=4, queue_size=1024, columnar=False,
+                 indexed_fields=("status", "is_locked", "is_open", "door_open"), event_sink=None, journal=None,
+                 metrics=False, coalesce=False, admission=None, telemetry=None):
+        # Dictionary to store all the devices with device_id as a key and device as value
+        # Only writers take the lock, readers rely on single dictionary lookups being atomic and never block
+        self.devices = {}
+        self.lock = threading.Lock()  # Lock to keep dictionary modifications safe, taken by writers only
+        self.handles = DeviceHandles()  # Integer handle of every device, assigned when the device is added
+        self.executor = self._create_executor(executor, workers, queue_size)  # Runs the device commands
+        # List to keep track of the threads, only populated in "thread" mode
+        self.threads = getattr(self.executor, "threads", [])
+        self.table = DeviceTable() if columnar else None  # Columnar store of device state, None when disabled
+        self.index = DeviceIndex(indexed_fields)  # Secondary indexes by device_type and field values
+        self.unindexed = []  # Locations of the snapshot devices loaded since the last query, not indexed yet
+        self.event_sink = event_sink  # Sink the device events are forwarded to, None uses the default sink
+        self.event_router = _HubEventRouter(self)  # Sink of every added device, keeps the indexes up to date
+        self.journal = journal  # Write-ahead journal of the applied commands, None when disabled
+        # Dictionary with device_id as key and the lock held while a command is applied and journaled as value
+        self.journal_locks = {}
+        self.bus = EventBus()  # Publishes the events of the hub's devices to subscribers
+        self.rules = RuleEngine(self)  # Automation rules evaluated against the events of the hub's devices
+        self.scheduler = Scheduler(self)  # Timing wheel that sends scheduled commands through send_command()
+        self.instrumentation = HubMetrics() if metrics else None  # Metrics of the hub, None when disabled
+        self.coalesce = coalesce  # Whether queued setters marked coalesce are replaced by newer ones
+        self.admission = admission  # Decides which commands are accepted, None accepts every command
+        self.telemetry = telemetry  # History of the numeric fields of the hub's devices, None when disabled
+        if metrics:
+            self.lock = InstrumentedLock(self.lock, self.instrumentation.hub_lock_wait)  # Times the writers' waits
+
+    # Creates the command executor for the given executor mode
+    @staticmethod
+    def _create_executor(executor, workers, queue_size):
+        if executor == "thread":
+            return ThreadPerCommandExecutor()  # A new thread for every command
+        elif executor == "pool":
+            return WorkerPoolExecutor(workers, queue_size)  # Fixed worker pool with a bounded queue
+        elif executor == "lanes":
+            return DeviceLaneExecutor(workers)  # Commands to one device run in order, devices run in parallel
+        elif isinstance(executor, str):
+            raise ValueError(f"Unknown executor mode '{executor}'")  # Message if the mode isn't supported
+        return executor  # Executor instance supplied by the caller
 
     # Adds a new device to the smart home system
     def add_device(self, device):
@@ -25,89 +113,518 @@ class SmartHomeHub:
             # If the device doesn't exist in the system...
             if device.device_id not in self.devices:
                 self.devices[device.device_id] = device  # Add it to the devices dictionary
+                self._register(device)
                 print(f"Device {device.device_id} added.")  # Print updated status that device was added
             else:
                 print(
                     f"Device {device.device_id} already exists in the system.")  # Message if the device already exists
 
+    # Sets up the lane, table row, indexes and event routing of a device that was added to the devices dictionary
+    def _register(self, device):
+        self.handles.assign(device.device_id)  # Names the device in encoded commands
+        self.executor.open_lane(device.device_id)  # Gives the device its own command lane
+        if self.table is not None and isinstance(device, SmartDevice):
+            self.table.attach(device)  # Moves the device state into its table row
+        self.index.add(device)  # Indexes the device under its type and field values
+        device.event_sink = self.event_router  # Routes the device's events through the hub
+        if self.telemetry is not None:
+            self.telemetry.track(device)  # Starts the history with the device's current values
+        if self.instrumentation is not None and hasattr(device, "lock"):
+            # Times the waits for the device lock, the handlers take it through device.lock as usual
+            device.lock = InstrumentedLock(device.lock, self.instrumentation.device_lock_wait)
+
     # Removes an existing device from the smart home system
     def remove_device(self, device_id):
         with self.lock:  # lock before removing device
             # If the device is found in the devices dictionary...
             if device_id in self.devices:
-                del self.devices[device_id]  # Remove that device from it
+                device = self.devices.pop(device_id)  # Remove that device from it
+                device.event_sink = None  # The device's events go to the default sink again
+                if isinstance(getattr(device, "lock", None), InstrumentedLock):
+                    device.lock = device.lock.inner  # Hands the device back its own lock
+                self.index.remove(device)  # Drops the device from the indexes
+                if self.table is not None and isinstance(device, SmartDevice):
+                    self.table.detach(device)  # Moves the device state back into the device object
+                self.executor.close_lane(device_id)  # Drops the command lane of the device
+                self.handles.release(device_id)
+                if self.telemetry is not None:
+                    self.telemetry.forget(device_id)  # Frees the history of the device
+                self.journal_locks.pop(device_id, None)
                 print(f"Device {device_id} removed.")  # Prints updated status that device was removed
             else:
                 print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
 
-    # Gets and returns the status of a given device
+    # Gets and returns the status of a given device without taking the hub lock
     def get_device_status(self, device_id):
-        with self.lock:  # Lock before getting status
-            # If the device is in the devices dictionary...
-            if device_id in self.devices:
-                return self.devices[device_id].get_status()  # Returns the status of it
-            else:
-                print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
-                return None  # Returns None since device doesn't exist
+        device = self.devices.get(device_id)  # Single atomic lookup, so readers don't contend with writers
+        # If the device is in the devices dictionary...
+        if device is not None:
+            return device.get_status()  # Returns the status of it
+        else:
+            print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
+            return None  # Returns None since device doesn't exist
 
-    # Send a command to the given device to be executed
+    # Send a command to the given device to be executed, returns a Future holding the command's result
     def send_command(self, device_id, command, *args):
-        with self.lock:  # Lock before sending command
-            # If the device is found in the devices dictionary...
-            if device_id in self.devices:
-                device = self.devices[device_id]  # Sets device to a device_id
-                # Creates a new thread to execute the command
-                thread = threading.Thread(target=self.execute_device_command, args=(device, command) + args)
-                self.threads.append(thread)  # Add the thread to the list of threads
-                thread.start()  # Start the thread
+        future = Future()  # Resolved with the handler's return value or exception
+        device = self.devices.get(device_id)  # Lock free lookup, like get_device_status()
+        # If the device isn't found in the devices dictionary...
+        if device is None:
+            print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
+            future.set_exception(DeviceNotFoundError(device_id))
+            if self.instrumentation is not None:
+                self.instrumentation.error(None, command, future.exception())
+            return future
+        task = _CommandTask(self, future, device, command, args)
+        if self.admission is not None and not self._admit(device_id, task):
+            return future  # Rejected, the Future holds the AdmissionError
+        if self.instrumentation is not None:
+            task.submitted = time.perf_counter()  # Start of the dispatch wait
+            self.instrumentation.started()
+        # Hands the command to the executor outside of the lock so a full queue doesn't block the hub
+        self._submit(device_id, task)
+        return future
+
+    # Asks the admission controller to accept a task, fails the task's Future and returns False if it doesn't
+    def _admit(self, device_id, task):
+        try:
+            # May block, depending on the policy, but not while this thread holds a slot it would wait for
+            self.admission.admit(device_id, task, wait=not getattr(_running, "running", False))
+        except AdmissionError as error:
+            task.future.set_exception(error)  # Reports the rejection back to the caller
+            if self.instrumentation is not None:
+                self.instrumentation.error(getattr(task.device, "device_type", None), task.command, error)
+            return False
+        return True
+
+    # Hands a task to the executor, letting it replace a queued setter when coalescing is enabled
+    def _submit(self, device_id, task):
+        if self.coalesce:
+            spec = registry.resolve(type(task.device), task.command)
+            if spec is not None and spec.coalesce:
+                self.executor.submit_coalescing(device_id, task.command, task)
+                return
+        self.executor.submit(device_id, task)
+
+    # Sends a batch of (device_id, command, args) commands, validating them all under one lock acquisition
+    # Returns a Future per command in input order, commands that fail validation get a failed Future
+    def send_commands(self, commands):
+        futures = []  # Futures in the same order as the commands
+        tasks = []  # (device_id, task) pairs for the commands that passed validation
+        resolve = registry.resolve
+        with self.lock:  # Lock once for the whole batch
+            devices = self.devices
+            for entry in commands:
+                device_id, command = entry[0], entry[1]
+                args = tuple(entry[2]) if len(entry) > 2 else ()  # The arguments are optional
+                future = Future()
+                futures.append(future)
+                device = devices.get(device_id)
+                if device is None:
+                    future.set_exception(DeviceNotFoundError(device_id))  # The device isn't in the system
+                elif resolve(type(device), command) is None:
+                    future.set_exception(UnsupportedCommandError(command))  # The device can't run the command
+                else:
+                    tasks.append((device_id, _CommandTask(self, future, device, command, args)))
+                    continue
+                if self.instrumentation is not None:
+                    self.instrumentation.error(getattr(device, "device_type", None), command, future.exception())
+        if self.admission is not None:
+            # Admitted outside of the lock, since the "block" policy may wait for room
+            tasks = [(device_id, task) for device_id, task in tasks if self._admit(device_id, task)]
+        if self.instrumentation is not None:
+            submitted = time.perf_counter()  # Start of the dispatch wait of the whole batch
+            for _, task in tasks:
+                task.submitted = submitted
+                self.instrumentation.started()
+        # Hands the whole batch to the executor outside of the lock
+        if self.coalesce:
+            for device_id, task in tasks:
+                self._submit(device_id, task)  # Each setter may replace one queued earlier
+        else:
+            self.executor.submit_many(tasks)
+        return futures
+
+    # Returns a CommandEncoder whose device codes are the handles of the hub's devices
+    def command_encoder(self):
+        return CommandEncoder(self.handles)
+
+    # Sends the commands of a buffer encoded by a CommandEncoder as one batch, returns their Futures in order
+    # decoder follows a stream across several buffers, by default the buffer must hold its own definitions
+    def send_encoded(self, data, decoder=None):
+        return self.send_commands((decoder or CommandDecoder()).decode(data))
+
+    # Returns the devices of device_type (if given) whose indexed fields match every field condition, a condition
+    # is field=value or field=(low, high) for an inclusive range, e.g. query("Lock", is_locked=False) or
+    # query(status="on", brightness=(50, 100)), the cost follows the size of the smallest match
+    def query(self, device_type=None, **conditions):
+        self._index_snapshot()  # Only the matching devices restored from a snapshot are built
+        devices = self.devices
+        return [devices[device_id] for device_id in self.index.query(device_type, **conditions)
+                if device_id in devices]
+
+    # Assigns field values on the DeviceTable rows of device_class selected by where, then refreshes the indexes
+    # Returns the number of devices updated, like DeviceTable.update()
+    def bulk_update(self, device_class, where=None, **values):
+        if self.table is None:
+            raise RuntimeError("bulk_update() needs a hub created with columnar=True")  # No table to update
+        self._materialize_snapshot(device_class)  # Devices restored from a snapshot only get a table row once built
+        updated = self.table.update(device_class, where=where, **values)
+        indexed = [field for field in values if field in self.index.fields]
+        if indexed:
+            # Bulk updates don't emit device events, so the indexed fields are moved here, a bucket at a time
+            for field in indexed:
+                self.index.assign(field, self.table.groups(device_class, field, where=where))
+        return updated
+
+    # Writes the state of every SmartDevice in the hub to path, returns the number of devices written
+    def save_snapshot(self, path):
+        return write_snapshot(list(self.devices.values()), path)
+
+    # Restores the devices saved in the snapshot at path, returns the number of devices restored
+    # The file is memory-mapped and each device is only built the first time it is looked up,
+    # devices whose id is already in the hub are skipped
+    def load_snapshot(self, path):
+        reader = SnapshotReader(path)
+        with self.lock:  # Lock before replacing the devices dictionary
+            built = dict(dict.items(self.devices))  # Devices that already exist, without building pending ones
+            pending = dict(getattr(self.devices, "pending", {}))
+            locations = reader.locations()
+            if built or pending:
+                # Keeps the devices the hub already has, the snapshot only adds new ids
+                locations = {device_id: location for device_id, location in locations.items()
+                             if device_id not in built and device_id not in pending}
+                pending.update(locations)
             else:
-                print(f"Device {device_id} not found in the system.")  # Message if the device isn't found in the system
+                pending = locations  # Nothing to merge with, the locations are used as they are
+            self.devices = LazyDeviceMap(built, pending, self._register)
+            self.unindexed.append(locations)  # Indexed by the next query, straight from the mapped columns
+        return len(locations)
+
+    # Indexes the devices still pending from loaded snapshots by reading their rows, without building them
+    def _index_snapshot(self):
+        if not self.unindexed:
+            return
+        devices = self.devices
+        with devices.lock:  # Lock so no device is built, and indexed from its object, while its row is indexed
+            unindexed = list(self.unindexed)
+            for locations in unindexed:
+                sections = {}  # Dictionary with section as key and the ids and rows of its pending devices as value
+                for device_id, (section, row) in locations.items():
+                    if device_id in devices.pending:  # Built devices were indexed when they were built
+                        ids, rows = sections.setdefault(section, ([], []))
+                        ids.append(device_id)
+                        rows.append(row)
+                for section, (ids, rows) in sections.items():
+                    self.index.add_many(section.device_type, ids, section.columns(self.index.fields, rows))
+            del self.unindexed[:len(unindexed)]  # Cleared last, so a concurrent query waits for the lock
+
+    # Builds the devices still pending from a snapshot, only those of device_class if given
+    def _materialize_snapshot(self, device_class=None):
+        devices = self.devices
+        if not getattr(devices, "pending", None):
+            return
+        if device_class is None:
+            devices.materialize_all()
+            return
+        for device_id, (section, row) in list(devices.pending.items()):
+            if issubclass(section.cls, device_class):
+                devices.get(device_id)  # Builds the device, which gives it its table row
+
+    # Subscribes to the events of the hub's devices, filtered by device_id, device_type and field
+    # e.g. subscribe(device_type="Thermostat", field="temperature"), see Subscription for maxsize and policy
+    def subscribe(self, device_id=None, device_type=None, field=None, kinds=("change",), maxsize=1024,
+                  policy="drop_oldest"):
+        return self.bus.subscribe(device_id, device_type, field, kinds, maxsize, policy)
+
+    # Adds an automation rule, see Rules.Rule, and returns it
+    def add_rule(self, rule):
+        return self.rules.add(rule)
+
+    # Removes the automation rule called name, returns True if there was one
+    def remove_rule(self, name):
+        return self.rules.remove(name)
+
+    # Returns the hub's metrics as a dictionary, see HubMetrics.snapshot()
+    def metrics(self):
+        if self.instrumentation is None:
+            raise RuntimeError("metrics() needs a hub created with metrics=True")  # Nothing was recorded
+        return self.instrumentation.snapshot()
+
+    # Returns a PrometheusExporter for the hub's metrics, to write them to a file or serve them over HTTP
+    def prometheus_exporter(self):
+        if self.instrumentation is None:
+            raise RuntimeError("prometheus_exporter() needs a hub created with metrics=True")  # Nothing to export
+        return PrometheusExporter(self.instrumentation)
+
+    # Sends a command at when, a time.time() value or a datetime, returns the ScheduledCommand to cancel it with
+    def schedule_at(self, when, device_id, command, *args):
+        if hasattr(when, "timestamp"):
+            when = when.timestamp()  # Accepts datetimes as well as timestamps
+        return self.scheduler.schedule(when, device_id, command, args)
+
+    # Sends a command after delay seconds, e.g. schedule_after(1800, "Samsung TV", "turn_off")
+    def schedule_after(self, delay, device_id, command, *args):
+        return self.scheduler.schedule(self.scheduler.clock() + delay, device_id, command, args)
+
+    # Sends a command every time the cron expression matches, e.g. schedule_cron("0 22 * * *", "Masterlock", "lock")
+    def schedule_cron(self, expression, device_id, command, *args):
+        cron = CronSpec(expression)
+        return self.scheduler.schedule(cron.next_after(self.scheduler.clock()), device_id, command, args, cron)
+
+    # Cancels a scheduled command, returns True if it was still pending
+    def cancel(self, scheduled):
+        return self.scheduler.cancel(scheduled)
+
+    # Snapshots the hub into its journal and deletes the journal segments the snapshot covers
+    # Returns the journal offset replay() continues from after loading the snapshot
+    def checkpoint(self):
+        if self.journal is None:
+            raise RuntimeError("checkpoint() needs a hub created with a journal")  # Nothing to compact
+        return self.journal.compact(self.save_snapshot)
+
+    # Rebuilds device state from the journal after a crash, returns the number of commands re-applied
+    # By default the newest checkpoint is loaded and the commands journaled after it are re-applied,
+    # with from_offset the commands from that offset on are re-applied to the devices already in the hub
+    # Commands for devices that aren't in the hub are skipped, replayed commands aren't journaled again
+    def replay(self, from_offset=None):
+        if self.journal is None:
+            raise RuntimeError("replay() needs a hub created with a journal")  # Nothing to replay
+        if from_offset is None:
+            checkpoint = self.journal.latest_checkpoint()
+            from_offset = 0
+            if checkpoint is not None:
+                from_offset, path = checkpoint
+                self.load_snapshot(path)
+        applied = 0
+        for entry in self.journal.replay(from_offset):
+            device = self.devices.get(entry.device_id)
+            spec = registry.resolve(type(device), entry.command) if device is not None else None
+            if spec is not None:
+                spec.function(device, *entry.args)  # Calls the handler directly so the entry isn't journaled twice
+                applied += 1
+        return applied
+
+    # Stops the command executor, returns True if all the queued commands finished before the timeout
+    # The journal, if any, is synced once the commands have run
+    def shutdown(self, drain=True, timeout=None):
+        if drain:
+            self.rules.drain(timeout)  # Commands of rules that already fired are sent before the executor stops
+        finished = self.executor.shutdown(drain=drain, timeout=timeout)
+        if self.journal is not None:
+            finished = self.journal.sync(timeout) and finished
+        return finished
 
     # Executes the given command on the specific device, if command isn't applicable prints an error
+    # State changing commands are appended to the journal once they are applied
     def execute_device_command(self, device, command, *args):
-        # if-elif statements to link the command to the specific device passing the arguments through it
-        if command == "turn_on":
-            device.turn_on()
-        elif command == "turn_off":
-            device.turn_off()
-        elif command == "set_temperature" and isinstance(device, Thermostat):
-            device.set_temperature(*args)
-        elif command == "change_brightness" and isinstance(device, Lightbulb):
-            device.change_brightness(*args)
-        elif command == "detect_motion" and isinstance(device, SecurityCamera):
-            device.detect_motion()
-        elif command == "set_volume" and isinstance(device, Television):
-            device.set_volume(*args)
-        elif command == "change_source" and isinstance(device, Television):
-            device.change_source(*args)
-        elif command == "set_refrigerator_temp" and isinstance(device, Refrigerator):
-            device.set_refrigerator_temp(*args)
-        elif command == "set_freezer_temp" and isinstance(device, Refrigerator):
-            device.set_freezer_temp(*args)
-        elif command == "door_status" and isinstance(device, Refrigerator):
-            device.door_status(*args)
-        elif command == "lock" and isinstance(device, Lock):
-            device.locked()
-        elif command == "unlock" and isinstance(device, Lock):
-            device.unlocked()
-        elif command == "get_lock_status" and isinstance(device, Lock):
-            device.get_lock_status()
-        elif command == "set_purification_level" and isinstance(device, AirPurifier):
-            device.set_purification_level(*args)
-        elif command == "set_fan_speed" and isinstance(device, AirPurifier):
-            device.set_fan_speed(*args)
-        elif command == "get_fan_speed" and isinstance(device, AirPurifier):
-            device.get_fan_speed()
-        elif command == "get_purification_status" and isinstance(device, AirPurifier):
-            device.get_purification_status()
-        elif command == "open_door" and isinstance(device, GarageDoor):
-            device.open_door()
-        elif command == "close_door" and isinstance(device, GarageDoor):
-            device.close_door()
+        if self.journal is None:
+            return self._apply(device, command, args)[1]
+        with self._journal_lock(device.device_id):  # Journals the commands of a device in the order they applied
+            spec, result = self._apply(device, command, args)
+            if not spec.query:
+                self.journal.append(device.device_id, command, args)
+        return result
 
+    # Returns the lock a command to device_id holds from applying it until it's appended to the journal
+    # The device lock is released once the handler returns, so it can't keep the journal in order on its own
+    def _journal_lock(self, device_id):
+        return self.journal_locks.get(device_id) or self.journal_locks.setdefault(device_id, threading.Lock())
+
+    # Runs the handler of command on device, returns the resolved CommandSpec and the handler's result
+    def _apply(self, device, command, args):
+        # Looks up the handler registered for the command on the device class, cached per class
+        spec = registry.resolve(type(device), command)
         # If the command isn't supported for a specific device, prints an error
-        else:
+        if spec is None:
             print(f"Command '{command}' not supported for device {device.device_id}")
+            raise UnsupportedCommandError(command)
+        return spec, spec.function(device, *args)  # Runs the handler, passing the arguments through it
+
+
+'''
+Purpose: Event sink of the devices added to a SmartHomeHub
+Contract:
+    - emit() refreshes the hub's indexes and records telemetry for change events, evaluates the hub's rules,
+      publishes the event on the hub's bus, then forwards it to the hub's event sink
+'''
+
+
+class _HubEventRouter:
+    __slots__ = ("hub",)
+
+    # Initializes an instance of _HubEventRouter
+    def __init__(self, hub):
+        self.hub = hub  # Hub whose devices emit to this router
+
+    # Keeps the indexes and the telemetry in step with the change and forwards the event
+    def emit(self, event):
+        hub = self.hub
+        if event.kind == "change" and event.field in hub.index.fields:
+            device = hub.devices.get(event.device_id)
+            if device is not None:
+                hub.index.refresh(device, event.field)
+        if hub.telemetry is not None and event.kind == "change" and event.field in hub.telemetry.fields:
+            hub.telemetry.record(event.device_id, event.field, event.timestamp, event.new)
+        hub.rules.evaluate(event)  # Only checks the rules indexed under the event's device and field
+        hub.bus.publish(event)  # Queued for the bus dispatcher, the fan-out happens off this thread
+        (hub.event_sink or get_event_sink()).emit(event)
+
+    # Routes a batch of events
+    def write(self, events):
+        for event in events:
+            self.emit(event)
+
+    # Flushes the sink the events are forwarded to
+    def flush(self, timeout=None):
+        return (self.hub.event_sink or get_event_sink()).flush(timeout)
+
+
+'''
+Purpose: Run one command sent through SmartHomeHub.send_command() and resolve its Future
+Contract:
+    - calling the task executes the command and stores its return value or exception in the Future
+    - with a journal, the result is only stored once the journal entry of the command is durable, the worker
+      doesn't wait for it, so one fsync confirms every command of a group commit
+    - coalesce() makes the task take the place of a queued task for the same setter, the replaced task's Future
+      (and those it replaced) resolve or are cancelled together with the task's own
+    - drop() fails the Future of a task the admission controller dropped, the task does nothing once called
+    - cancel() cancels the Future of a task that an executor discarded before it ran
+'''
+
+
+class _CommandTask:
+    __slots__ = ("hub", "future", "device", "command", "args", "result", "submitted", "replaced")
+
+    # Initializes an instance of _CommandTask
+    def __init__(self, hub, future, device, command, args):
+        self.hub = hub  # Hub that executes the command
+        self.future = future  # Future handed back to the caller of send_command()
+        self.device = device  # Device that receives the command
+        self.command = command  # Name of the command
+        self.args = args  # Arguments passed through to the handler
+        self.result = None  # Return value of the handler, held until the journal entry is durable
+        self.submitted = 0.0  # perf_counter() value when the task was sent, only set when metrics are enabled
+        self.replaced = ()  # Futures of the queued tasks this one replaced
+
+    # Executes the command, and frees its admission slot once it finished
+    def __call__(self):
+        admission = self.hub.admission
+        if admission is None:
+            return self._timed()
+        if not admission.started(self):
+            return  # Dropped while it was queued, the Future already holds the error
+        outer = getattr(_running, "running", False)  # True if this command runs inline within another
+        _running.running = True  # Commands sent from the handler or its inline rule actions mustn't wait
+        try:
+            self._timed()
+        finally:
+            _running.running = outer
+            admission.release(self)
+
+    # Executes the command, timing it when the hub records metrics
+    def _timed(self):
+        metrics = self.hub.instrumentation
+        if metrics is None:
+            return self._run()
+        start = time.perf_counter()
+        try:
+            self._run()
+        finally:
+            # The dispatch wait covers queueing and thread startup, the latency the handler itself
+            metrics.record(getattr(self.device, "device_type", None), self.command, start - self.submitted,
+                           time.perf_counter() - start)
+
+    # Executes the command unless its Future was cancelled while it was queued
+    def _run(self):
+        if not self.future.set_running_or_notify_cancel():
+            for future in self.replaced:
+                future.cancel()  # The replaced commands share the fate of the command that replaced them
+            return
+        if self.replaced:
+            self.replaced = tuple(future for future in self.replaced if future.set_running_or_notify_cancel())
+        hub = self.hub
+        try:
+            if hub.journal is None:
+                spec, result = hub._apply(self.device, self.command, self.args)
+            else:
+                # Applied and appended under one lock, so with any executor the journal of a device is in the
+                # order its commands were applied, and replay() rebuilds the same state
+                with hub._journal_lock(self.device.device_id):
+                    spec, result = hub._apply(self.device, self.command, self.args)
+                    if not spec.query:
+                        self.result = result
+                        # The journal writer resolves the Future once the entry is on disk
+                        hub.journal.append(self.device.device_id, self.command, self.args, self._on_durable)
+                        return
+        except BaseException as error:
+            self._resolve(None, error)  # Hands the failure to the caller instead of the worker
+            if hub.instrumentation is not None:
+                hub.instrumentation.error(getattr(self.device, "device_type", None), self.command, error)
+        else:
+            self._resolve(result, None)
+
+    # Resolves the Future once the journal entry of the command is durable, or failed to write
+    def _on_durable(self, error):
+        self._resolve(self.result, error)
+
+    # Stores the result or the exception in the Future and in the Futures of the replaced tasks
+    def _resolve(self, result, error):
+        for future in (self.future,) + self.replaced:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # Takes the place of a queued task for the same command, the executor runs this task instead
+    def coalesce(self, replaced):
+        hub = self.hub
+        # The replaced task never runs, so it gives its admission slot back, unless it was dropped
+        if hub.admission is not None and not hub.admission.discard(replaced):
+            return  # Dropped, its Futures already failed
+        self.replaced = replaced.replaced + (replaced.future,)
+        if hub.instrumentation is not None:
+            hub.instrumentation.superseded()
+
+    # Fails the Futures of a task that was dropped to make room for newer commands
+    def drop(self, error):
+        for future in (self.future,) + self.replaced:
+            if future.set_running_or_notify_cancel():  # Skips a Future its caller cancelled
+                future.set_exception(error)
+        if self.hub.instrumentation is not None:
+            self.hub.instrumentation.error(getattr(self.device, "device_type", None), self.command, error)
+            self.hub.instrumentation.finished()
+
+    # Cancels the Future of a task that will never run
+    def cancel(self):
+        if self.hub.admission is not None and not self.hub.admission.discard(self):
+            return  # Dropped, its Futures already failed
+        self.future.cancel()
+        for future in self.replaced:
+            future.cancel()
+        if self.hub.instrumentation is not None:
+            self.hub.instrumentation.finished()
+
+
+# Waits for every Future and returns their results in the same order
+# Raises the first exception unless return_exceptions is True, and TimeoutError if they aren't all done in time
+def wait_all(futures, timeout=None, return_exceptions=False):
+    futures = list(futures)
+    _, not_done = concurrent.futures.wait(futures, timeout=timeout)
+    if not_done:
+        raise TimeoutError(f"{len(not_done)} of {len(futures)} commands still pending")
+    results = []
+    for future in futures:
+        error = future.exception()
+        if error is not None and not return_exceptions:
+            raise error
+        results.append(error if error is not None else future.result())
+    return results
+
+
+# Yields the Futures as they complete, whichever finishes first comes first
+def as_completed(futures, timeout=None):
+    return concurrent.futures.as_completed(futures, timeout=timeout)
 
 
 if __name__ == "__main__":
@@ -197,3 +714,6 @@ if __name__ == "__main__":
 
     # Example of command not found
     home_controller.send_command("Garage Door", "open_garage")
+
+    # Waits for all the commands to finish before exiting
+    home_controller.shutdown()
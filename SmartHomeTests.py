@@ -1,5 +1,29 @@
 from SmartHomeHub import *
 from Devices import *
+from Executors import *
+from Commands import *
+from AsyncSmartHomeHub import *
+from Events import *
+from SmartHomeBenchmarks import *
+from DeviceTable import *
+from DeviceIndex import *
+from Snapshot import *
+from Journal import *
+from EventBus import *
+from Rules import *
+from Scheduler import *
+from Metrics import *
+from Admission import *
+from ShardedHub import ShardedHub, shard_for
+from HubServer import *
+from CommandCodec import *
+from Telemetry import *
+import asyncio
+import datetime
+import pickle
+import threading
+import time
+import pytest
 
 # All Device Initializations for the tests 
 light = Lightbulb("Kitchen Light")
@@ -406,3 +430,1573 @@ def test_get_device_status():
 def test_get_device_status_device():
     status = control_unit.get_device_status("Device Doesn't Exist")
     assert status is None
+
+
+'''Tests for SmartHomeHub Executors'''
+
+
+# Test that the worker pool runs every command on a fixed number of threads
+def test_worker_pool_executor():
+    hub = SmartHomeHub(executor="pool", workers=2, queue_size=8)
+    hub.add_device(Thermostat("Pool Thermostat"))
+    threads_before = threading.active_count()
+    for temp in range(200):
+        hub.send_command("Pool Thermostat", "set_temperature", temp)
+    assert threading.active_count() == threads_before
+    assert hub.shutdown(drain=True, timeout=5)
+    assert hub.devices["Pool Thermostat"].temperature in range(200)
+    assert hub.executor.pending() == 0
+
+
+# Test that shutdown without draining discards queued commands
+def test_worker_pool_shutdown_without_drain():
+    executor = WorkerPoolExecutor(workers=1, queue_size=100)
+    gate = threading.Event()
+    ran = []
+    executor.submit(None, gate.wait)
+    for i in range(10):
+        executor.submit(None, ran.append, i)
+    executor.shutdown(drain=False, timeout=0)
+    gate.set()
+    assert executor.shutdown(timeout=5)
+    assert ran == []
+
+
+# Test that a submission waiting for room while the pool shuts down still runs, and that failures go to stderr
+def test_worker_pool_submit_racing_shutdown(capsys):
+    executor = WorkerPoolExecutor(workers=1, queue_size=1)
+    gate = threading.Event()
+    ran = []
+    executor.submit(None, int, "not a number")
+    executor.submit(None, gate.wait, 10)
+    executor.submit(None, ran.append, 1)  # Fills the queue while the worker waits on the gate
+    submitter = threading.Thread(target=executor.submit, args=(None, ran.append, 2))
+    submitter.start()  # Waits for room in the queue
+    time.sleep(0.05)
+    stopper = threading.Thread(target=executor.shutdown)
+    stopper.start()  # Its stop sentinel must not get ahead of the waiting submission
+    time.sleep(0.05)
+    gate.set()
+    submitter.join(5)
+    stopper.join(5)
+    assert ran == [1, 2]
+    with pytest.raises(RuntimeError):
+        executor.submit(None, ran.append, 3)
+    assert "Command failed in worker: ValueError" in capsys.readouterr().err
+
+
+# Test that a lane submission accepted just before shutdown still runs instead of landing in a drained lane
+def test_lane_executor_submit_racing_shutdown():
+    executor = DeviceLaneExecutor(workers=1)
+    opening, gate = threading.Event(), threading.Event()
+    open_lane = executor.open_lane
+
+    # Holds the submission between its accepting check and its mailbox until the gate opens
+    def slow_open_lane(key):
+        opening.set()
+        gate.wait(5)
+        return open_lane(key)
+
+    executor.open_lane = slow_open_lane
+    ran = []
+    submitter = threading.Thread(target=executor.submit, args=("Racing Lane", ran.append, 1))
+    submitter.start()
+    assert opening.wait(5)
+    finished = []
+    stopper = threading.Thread(target=lambda: finished.append(executor.shutdown(drain=False, timeout=5)))
+    stopper.start()
+    time.sleep(0.05)
+    gate.set()
+    submitter.join(5)
+    stopper.join(5)
+    assert ran == [1] and finished == [True]
+    with pytest.raises(RuntimeError):
+        executor.submit("Racing Lane", ran.append, 2)
+
+
+# Test that the thread-per-command executor prunes finished threads
+def test_thread_executor_reaps_threads():
+    hub = SmartHomeHub()
+    hub.add_device(Lightbulb("Reaped Light"))
+    for _ in range(300):
+        hub.send_command("Reaped Light", "turn_on")
+    assert hub.shutdown(timeout=5)
+    assert len(hub.threads) < 300
+
+
+# Test that an unknown executor mode is rejected
+def test_unknown_executor_mode():
+    with pytest.raises(ValueError):
+        SmartHomeHub(executor="fibers")
+
+
+# Test that commands to one device run in submission order on the lane executor
+def test_lane_executor_orders_device_commands():
+    hub = SmartHomeHub(executor="lanes", workers=4)
+    bulb = Lightbulb("Lane Light")
+    hub.add_device(bulb)
+    hub.send_command("Lane Light", "turn_on")
+    hub.send_command("Lane Light", "change_brightness", 75)
+    for temp in range(50):
+        hub.send_command("Lane Light", "change_brightness", temp)
+    hub.send_command("Lane Light", "change_brightness", 42)
+    assert hub.shutdown(timeout=5)
+    assert bulb.status == "on"
+    assert bulb.brightness == 42
+
+
+# Test that a busy device lane doesn't hold up the commands of other devices
+def test_lane_executor_runs_devices_in_parallel():
+    executor = DeviceLaneExecutor(workers=2)
+    gate = threading.Event()
+    done = threading.Event()
+    executor.submit("slow device", gate.wait, 5)
+    executor.submit("fast device", done.set)
+    assert done.wait(5)
+    gate.set()
+    assert executor.shutdown(timeout=5)
+    assert executor.pending() == 0
+
+
+'''Tests for the Command Registry'''
+
+
+# Test that commands resolve to the most derived implementation through the MRO
+def test_registry_resolves_through_mro():
+    spec = registry.resolve(Lightbulb, "turn_on")
+    assert spec.function is Lightbulb.turn_on
+    assert registry.resolve(Lock, "lock").function is Lock.locked
+    assert registry.resolve(Thermostat, "lock") is None
+    assert registry.resolve(Lightbulb, "turn_on") is registry.resolve(Lightbulb, "turn_on")
+
+
+# Test that a plugin device class registers its commands with the decorator
+def test_registry_plugin_device():
+    class SmartBlinds(SmartDevice):
+        def __init__(self, device_id):
+            super().__init__(device_id, "Smart Blinds")
+            self.position = 0
+
+        @command("raise_blinds")
+        def raise_to(self, position):
+            self.position = position
+            return self.position
+
+    hub = SmartHomeHub()
+    blinds = SmartBlinds("Bedroom Blinds")
+    hub.add_device(blinds)
+    assert hub.execute_device_command(blinds, "raise_blinds", 60) == 60
+    assert hub.execute_device_command(blinds, "turn_on") is None
+    assert blinds.status == "on"
+    assert "raise_blinds" in registry.supported_commands(SmartBlinds)
+    assert "turn_off" in registry.supported_commands(SmartBlinds)
+
+
+# Test that unsupported commands are not executed
+def test_registry_unsupported_command():
+    hub = SmartHomeHub()
+    bulb = Lightbulb("Registry Light")
+    with pytest.raises(UnsupportedCommandError):
+        hub.execute_device_command(bulb, "set_volume", 10)
+    assert hub.execute_device_command(bulb, "change_brightness", 10) is None
+    assert bulb.brightness == 0
+
+
+'''Tests for send_command Futures'''
+
+
+# Test that query commands hand their return values back through the Future
+def test_send_command_returns_results():
+    for mode in ("thread", "pool", "lanes"):
+        hub = SmartHomeHub(executor=mode)
+        hub.add_device(Lock("Future Lock"))
+        hub.add_device(AirPurifier("Future Purifier"))
+        hub.send_command("Future Lock", "unlock").result(timeout=5)
+        hub.send_command("Future Purifier", "set_fan_speed", 2).result(timeout=5)
+        futures = [hub.send_command("Future Lock", "get_lock_status"),
+                   hub.send_command("Future Purifier", "get_fan_speed")]
+        assert wait_all(futures, timeout=5) == ["unlocked", 2]
+        assert {f.result() for f in as_completed(futures, timeout=5)} == {"unlocked", 2}
+        hub.shutdown()
+
+
+# Test that errors are carried by the Future instead of being lost on the worker
+def test_send_command_errors():
+    hub = SmartHomeHub(executor="pool")
+    hub.add_device(Lightbulb("Future Light"))
+    missing = hub.send_command("Missing Device", "turn_on")
+    unsupported = hub.send_command("Future Light", "set_volume", 10)
+    bad_args = hub.send_command("Future Light", "change_brightness")
+    with pytest.raises(DeviceNotFoundError):
+        missing.result(timeout=5)
+    assert isinstance(unsupported.exception(timeout=5), UnsupportedCommandError)
+    results = wait_all([missing, bad_args], timeout=5, return_exceptions=True)
+    assert isinstance(results[0], DeviceNotFoundError)
+    assert isinstance(results[1], TypeError)
+    hub.shutdown()
+
+
+# Test that commands discarded by a shutdown without draining are cancelled
+def test_send_command_cancelled_on_shutdown():
+    hub = SmartHomeHub(executor="lanes", workers=1)
+    hub.add_device(Thermostat("Cancelled Thermostat"))
+    gate = threading.Event()
+    hub.executor.submit("Cancelled Thermostat", gate.wait, 5)
+    future = hub.send_command("Cancelled Thermostat", "set_temperature", 80)
+    hub.shutdown(drain=False, timeout=0)
+    gate.set()
+    assert hub.shutdown(timeout=5)
+    assert future.cancelled()
+
+
+'''Tests for AsyncSmartHomeHub Class'''
+
+
+# Test that the async hub mirrors the SmartHomeHub methods
+def test_async_hub_commands():
+    async def scenario():
+        hub = AsyncSmartHomeHub()
+        await hub.add_device(Lightbulb("Async Light"))
+        await hub.add_device(Lock("Async Lock"))
+        assert await hub.get_device_status("Async Light") == "off"
+        await hub.send_command("Async Light", "turn_on")
+        assert await hub.send_command("Async Lock", "get_lock_status") == "locked"
+        assert await hub.get_device_status("Async Light") == "on"
+        with pytest.raises(UnsupportedCommandError):
+            await hub.send_command("Async Light", "lock")
+        await hub.remove_device("Async Light")
+        with pytest.raises(DeviceNotFoundError):
+            await hub.send_command("Async Light", "turn_off")
+        assert await hub.get_device_status("Async Light") is None
+
+    asyncio.run(scenario())
+
+
+# Test that many in-flight commands run in per-device order on a single event loop
+def test_async_hub_concurrent_commands():
+    async def scenario():
+        hub = AsyncSmartHomeHub(mailbox_size=16)
+        thermostats = [Thermostat(f"Async Thermostat {i}") for i in range(20)]
+        for thermostat in thermostats:
+            await hub.add_device(thermostat)
+        commands = [hub.send_command(t.device_id, "set_temperature", temp)
+                    for temp in range(50) for t in thermostats]
+        await asyncio.gather(*commands)
+        await hub.shutdown()
+        assert all(t.temperature == 49 for t in thermostats)
+
+    asyncio.run(scenario())
+
+
+# Test that only handlers marked as blocking are offloaded from the event loop
+def test_async_hub_blocking_handler():
+    class SlowSensor(SmartDevice):
+        def __init__(self, device_id):
+            super().__init__(device_id, "Slow Sensor")
+
+        @command("read_slowly", blocking=True)
+        def read_slowly(self):
+            return threading.current_thread().name
+
+        @command("read_quickly")
+        def read_quickly(self):
+            return threading.current_thread().name
+
+    async def scenario():
+        hub = AsyncSmartHomeHub()
+        await hub.add_device(SlowSensor("Basement Sensor"))
+        slow = await hub.send_command("Basement Sensor", "read_slowly")
+        quick = await hub.send_command("Basement Sensor", "read_quickly")
+        assert quick == threading.current_thread().name
+        assert slow != quick
+
+    asyncio.run(scenario())
+
+
+# Test that a batch of commands returns results and errors in input order
+def test_send_commands_batch():
+    for mode in ("thread", "pool", "lanes"):
+        hub = SmartHomeHub(executor=mode)
+        hub.add_device(Lock("Batch Lock"))
+        hub.add_device(Television("Batch TV"))
+        futures = hub.send_commands([
+            ("Batch Lock", "unlock"),
+            ("Batch TV", "set_volume", (55,)),
+            ("Missing Device", "turn_on", ()),
+            ("Batch TV", "lock", ()),
+            ("Batch Lock", "get_lock_status", []),
+        ])
+        results = wait_all(futures, timeout=5, return_exceptions=True)
+        assert results[0] is None
+        assert results[1] is None
+        assert isinstance(results[2], DeviceNotFoundError)
+        assert isinstance(results[3], UnsupportedCommandError)
+        assert hub.devices["Batch TV"].volume == 55
+        if mode == "lanes":
+            assert results[4] == "unlocked"
+        hub.shutdown()
+
+
+'''Tests for Device Event Sinks'''
+
+
+# Sink that keeps the events it receives in a list
+class CollectingSink:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def write(self, events):
+        self.events.extend(events)
+
+    def flush(self, timeout=None):
+        return True
+
+
+# Test that device changes are emitted as structured events
+def test_device_emits_structured_events():
+    sink = CollectingSink()
+    bulb = Lightbulb("Event Light")
+    bulb.event_sink = sink
+    bulb.turn_on()
+    bulb.change_brightness(30)
+    bulb.turn_off()
+    bulb.change_brightness(80)
+    changes = [(e.field, e.old, e.new) for e in sink.events if e.kind == "change"]
+    assert changes == [("status", "off", "on"), ("brightness", 0, 100), ("brightness", 100, 30),
+                       ("status", "on", "off"), ("brightness", 30, 0)]
+    assert sink.events[-1].kind == "notice"
+    assert all(e.device_id == "Event Light" and e.device_type == "Smart Lightbulb" for e in sink.events)
+    assert sink.events[2].message == "Smart Lightbulb Event Light brightness adjusted to 30%"
+
+
+# Test that the batching sink writes events on its background thread and flushes them
+def test_batching_sink_flush():
+    target = CollectingSink()
+    sink = BatchingSink(target, max_batch=8)
+    fridge = Refrigerator("Event Fridge")
+    fridge.event_sink = sink
+    for temp in range(100):
+        fridge.set_freezer_temp(temp)
+    assert sink.flush(timeout=5)
+    assert [e.new for e in target.events] == list(range(100))
+    sink.close(timeout=5)
+    assert not sink.writer.is_alive()
+
+
+# Test that the stdout, file and null sinks write the expected output
+def test_stdout_file_and_null_sinks(tmp_path, capsys):
+    path = tmp_path / "events.jsonl"
+    file_sink = FileSink(path)
+    garage = GarageDoor("Event Garage")
+    for sink in (StdoutSink(), file_sink, NullSink()):
+        garage.event_sink = sink
+        garage.open_door()
+    file_sink.close()
+    assert capsys.readouterr().out == "Garage Door Event Garage is now open.\n"
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    assert '"field": "is_open"' in lines[0]
+
+
+# Test that the default sink can be replaced
+def test_set_event_sink():
+    sink = CollectingSink()
+    previous = set_event_sink(sink)
+    try:
+        Lock("Default Sink Lock").unlocked()
+    finally:
+        set_event_sink(previous)
+    assert [e.new for e in sink.events] == [False]
+
+
+# Test that status reads don't wait for the hub lock held by a writer
+def test_get_device_status_is_lock_free():
+    hub = SmartHomeHub()
+    hub.add_device(Thermostat("Lock Free Thermostat"))
+    with hub.lock:
+        assert hub.get_device_status("Lock Free Thermostat") == "off"
+        assert hub.send_command("Lock Free Thermostat", "turn_on").result(timeout=5) is None
+    assert hub.get_device_status("Lock Free Thermostat") == "on"
+
+
+# Test that the contention benchmark reports read throughput for both read modes
+def test_bench_registry_contention():
+    result = bench_registry_contention(devices=10, readers=2, duration=0.05)
+    assert result["locked"]["reads_per_sec"] > 0
+    assert result["lock_free"]["reads_per_sec"] > 0
+
+
+'''Tests for Compact Devices'''
+
+
+# Test that the built in devices are slotted and don't carry a __dict__
+def test_devices_are_slotted():
+    for device in (light, thermostat, camera, system, fridge, lock, purifier, door):
+        assert not hasattr(device, "__dict__")
+    with pytest.raises(AttributeError):
+        light.colour = "red"
+
+
+# Test that striped locks are shared between devices and restored afterwards
+def test_lock_stripes():
+    use_lock_stripes(1)
+    try:
+        first, second = Lightbulb("Striped Light 1"), Thermostat("Striped Thermostat 2")
+    finally:
+        use_lock_stripes(None)
+    assert first.lock is second.lock
+    first.turn_on()
+    second.set_temperature(70)
+    assert first.status == "on" and second.temperature == 70
+    assert Lightbulb("Own Lock Light").lock is not first.lock
+
+
+# Test that the memory benchmark reports bytes per device for each size
+def test_bench_device_memory():
+    result = bench_device_memory(sizes=(100,), stripes=4)
+    row = result["sizes"][100]
+    assert 0 < row["striped_locks"] < row["lock_per_device"]
+
+
+'''Tests for DeviceTable Class'''
+
+
+# Test that attached devices read and write their state through the table
+def test_device_table_views():
+    pytest.importorskip("numpy")
+    table = DeviceTable(capacity=2)
+    bulbs = [Lightbulb(f"Table Light {i}") for i in range(5)]
+    for bulb in bulbs:
+        table.attach(bulb)
+    bulbs[0].turn_on()
+    bulbs[1].turn_on()
+    bulbs[1].change_brightness(40)
+    assert bulbs[0].status == "on" and bulbs[0].brightness == 100
+    assert bulbs[1].brightness == 40
+    assert table.aggregate(Lightbulb, "brightness", "max") == 100
+    assert table.aggregate("Smart Lightbulb", "brightness", "count", where=table.select(Lightbulb, status="on")) == 2
+    table.detach(bulbs[1])
+    assert bulbs[1].brightness == 40 and bulbs[1].status == "on"
+    assert table.aggregate(Lightbulb, "brightness", "count") == 4
+
+
+# Test vectorized masked updates across a fleet
+def test_device_table_bulk_update():
+    pytest.importorskip("numpy")
+    hub = SmartHomeHub(columnar=True)
+    thermostats = [Thermostat(f"Table Thermostat {i}") for i in range(10)]
+    for thermostat in thermostats:
+        hub.add_device(thermostat)
+    floor = [t.device_id for t in thermostats[:4]]
+    assert hub.table.update(Thermostat, where=hub.table.select(Thermostat, ids=floor), temperature=68) == 4
+    assert [t.temperature for t in thermostats[:5]] == [68, 68, 68, 68, 65]
+    hub.table.update(Thermostat, status="on")
+    assert all(t.get_status() == "on" for t in thermostats)
+    warm = hub.table.select(Thermostat, temperature=(66, 70))
+    assert hub.table.device_ids(Thermostat, where=warm) == floor
+    assert hub.table.aggregate(Thermostat, "temperature", "mean") == pytest.approx(66.2)
+    hub.remove_device(floor[0])
+    assert thermostats[0].temperature == 68
+    assert hub.table.aggregate(Thermostat, "temperature", "count") == 9
+
+
+# Test that devices attached in bulk behave like devices attached one at a time
+def test_device_table_attach_many():
+    pytest.importorskip("numpy")
+    table = DeviceTable(capacity=4)
+    locks = [Lock(f"Table Lock {i}") for i in range(10)]
+    locks[3].unlocked()
+    table.attach_many(locks)
+    assert table.device_ids(Lock, where=table.select(Lock, is_locked=False)) == ["Table Lock 3"]
+    locks[5].unlocked()
+    assert locks[5].get_lock_status() == "unlocked"
+    assert table.aggregate(Lock, "is_locked", "sum") == 8
+    result = bench_device_table(devices=100, loop_devices=10)
+    assert result["dimmed"] == 34
+
+
+# Test that a mask selected before the segment grew still applies, and leaves the newer rows out
+def test_device_table_mask_across_growth():
+    pytest.importorskip("numpy")
+    table = DeviceTable(capacity=2)
+    table.attach_many([Lock(f"Grown Lock {i}") for i in range(2)])
+    where = table.select(Lock, is_locked=True)
+    table.attach_many([Lock(f"Grown Lock {i}") for i in range(2, 6)])  # Grows the columns past the mask
+    assert table.update(Lock, where=where, is_locked=False) == 2
+    assert table.device_ids(Lock, where=table.select(Lock, is_locked=True)) == [f"Grown Lock {i}" for i in range(2, 6)]
+    assert table.groups(Lock, "is_locked", where=where) == {False: ["Grown Lock 0", "Grown Lock 1"]}
+
+
+'''Tests for SmartHomeHub Secondary Indexes'''
+
+
+# Test that queries follow the state changes made by commands
+def test_hub_query_follows_commands():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    for i in range(3):
+        hub.add_device(Lightbulb(f"Query Light {i}"))
+        hub.add_device(Lock(f"Query Lock {i}"))
+    hub.add_device(GarageDoor("Query Garage"))
+    wait_all([hub.send_command("Query Light 1", "turn_on"), hub.send_command("Query Lock 2", "unlock"),
+              hub.send_command("Query Garage", "open_door")], timeout=5)
+    assert [d.device_id for d in hub.query("Smart Lightbulb", status="on")] == ["Query Light 1"]
+    assert [d.device_id for d in hub.query("Lock", is_locked=False)] == ["Query Lock 2"]
+    assert [d.device_id for d in hub.query(is_open=True)] == ["Query Garage"]
+    assert len(hub.query("Lock")) == 3
+    hub.send_command("Query Lock 2", "lock").result(timeout=5)
+    assert hub.query("Lock", is_locked=False) == []
+    hub.remove_device("Query Light 1")
+    assert hub.query(status="on") == []
+    with pytest.raises(ValueError):
+        hub.query(brightness=100)
+    hub.shutdown()
+
+
+# Test that the index only touches the buckets involved in a query
+def test_device_index_buckets():
+    index = DeviceIndex(fields=("status",))
+    fridge = Refrigerator("Index Fridge")
+    index.add(fridge)
+    index.add(Thermostat("Index Thermostat"))
+    fridge.turn_on()
+    index.refresh(fridge, "status")
+    index.refresh(fridge, "door_open")
+    assert index.query(status="on") == {"Index Fridge"}
+    assert index.query("Thermostat", status="on") == set()
+    index.remove(fridge)
+    assert "on" not in index.by_field["status"]
+
+
+# Test that bulk table updates keep the indexes in step
+def test_hub_bulk_update_refreshes_index():
+    pytest.importorskip("numpy")
+    hub = SmartHomeHub(columnar=True, event_sink=NullSink())
+    for i in range(4):
+        hub.add_device(Lock(f"Bulk Lock {i}"))
+    assert hub.bulk_update(Lock, where=hub.table.select(Lock, ids=["Bulk Lock 0", "Bulk Lock 3"]),
+                           is_locked=False) == 2
+    assert sorted(d.device_id for d in hub.query("Lock", is_locked=False)) == ["Bulk Lock 0", "Bulk Lock 3"]
+    assert hub.bulk_update(Lock, is_locked=True) == 4
+    assert hub.query("Lock", is_locked=False) == [] and len(hub.query(is_locked=True)) == 4
+
+
+# Test range conditions on an indexed numeric field, kept in step by events and bulk updates
+def test_device_index_ranges():
+    pytest.importorskip("numpy")
+    hub = SmartHomeHub(columnar=True, event_sink=NullSink(), indexed_fields=("status", "brightness"))
+    bulbs = [Lightbulb(f"Range Light {i}") for i in range(5)]
+    for bulb in bulbs:
+        hub.add_device(bulb)
+        bulb.turn_on()
+    for i, bulb in enumerate(bulbs):
+        bulb.change_brightness(20 * i)
+    assert sorted(d.device_id for d in hub.query(brightness=(20, 60))) == [f"Range Light {i}" for i in (1, 2, 3)]
+    hub.bulk_update(Lightbulb, where=hub.table.select(Lightbulb, brightness=(0, 30)), brightness=90)
+    assert len(hub.query("Smart Lightbulb", status="on", brightness=(90, 100))) == 2
+    assert hub.query(brightness=(0, 39)) == []
+    with pytest.raises(ValueError):
+        DeviceIndex(fields=("brightness",)).query(temperature=(0, 1))
+
+
+'''Tests for SmartHomeHub Snapshots'''
+
+
+# Test that a snapshot restores the state of every device
+def test_snapshot_round_trip(tmp_path):
+    hub = SmartHomeHub(event_sink=NullSink())
+    tv = Television("Snapshot TV")
+    hub.add_device(tv)
+    hub.add_device(Thermostat("Snapshot Thermostat"))
+    hub.add_device(Lock("Snapshot Lock"))
+    tv.turn_on()
+    tv.set_volume(44)
+    tv.change_source("HDMI 2")
+    hub.send_command("Snapshot Thermostat", "set_temperature", 71.5).result(timeout=5)
+    hub.send_command("Snapshot Lock", "unlock").result(timeout=5)
+    assert hub.save_snapshot(tmp_path / "home.snap") == 3
+    restored = SmartHomeHub(event_sink=NullSink())
+    assert restored.load_snapshot(tmp_path / "home.snap") == 3
+    assert restored.get_device_status("Snapshot TV") == "on"
+    assert restored.devices["Snapshot TV"].volume == 44
+    assert restored.devices["Snapshot TV"].input_source == "HDMI 2"
+    assert restored.devices["Snapshot Thermostat"].temperature == 71.5
+    assert restored.devices["Snapshot Lock"].get_lock_status() == "unlocked"
+    restored.send_command("Snapshot Lock", "lock").result(timeout=5)
+    assert restored.devices["Snapshot Lock"].is_locked
+    hub.shutdown()
+    restored.shutdown()
+
+
+# Test that restored devices are only built when they are first looked up
+def test_snapshot_loads_lazily(tmp_path):
+    write_snapshot([Lightbulb(f"Lazy Light {i}") for i in range(5)] + [Lock("Lazy Lock")], tmp_path / "lazy.snap")
+    hub = SmartHomeHub(event_sink=NullSink())
+    hub.load_snapshot(tmp_path / "lazy.snap")
+    assert len(hub.devices) == 6
+    assert dict.__len__(hub.devices) == 0
+    assert "Lazy Light 2" in hub.devices
+    assert hub.get_device_status("Lazy Light 2") == "off"
+    assert dict.__len__(hub.devices) == 1
+    assert [d.device_id for d in hub.query("Lock", is_locked=True)] == ["Lazy Lock"]
+    assert dict.__len__(hub.devices) == 2
+    hub.shutdown()
+
+
+# Test that queries index restored devices from the file and only build the devices they return
+def test_snapshot_query_builds_only_matches(tmp_path):
+    lights = [Lightbulb(f"Indexed Light {i}") for i in range(6)]
+    for light in lights[:2]:
+        light.turn_on()
+    write_snapshot(lights + [Lock("Indexed Lock")], tmp_path / "indexed.snap")
+    hub = SmartHomeHub(event_sink=NullSink(), columnar=True)
+    hub.load_snapshot(tmp_path / "indexed.snap")
+    hub.execute_device_command(hub.devices["Indexed Light 5"], "turn_on")  # Built, then changed, before the first query
+    on = sorted(device.device_id for device in hub.query("Smart Lightbulb", status="on"))
+    assert on == ["Indexed Light 0", "Indexed Light 1", "Indexed Light 5"]
+    assert dict.__len__(hub.devices) == 3
+    assert len(hub.query("Smart Lightbulb", status="off")) == 3
+    assert hub.bulk_update(Lock, is_locked=False) == 1
+    assert len(hub.devices.pending) == 0
+    assert [device.device_id for device in hub.query(is_locked=False)] == ["Indexed Lock"]
+    hub.shutdown()
+
+
+# Test that files that aren't snapshots of this version are rejected
+def test_snapshot_rejects_other_files(tmp_path):
+    (tmp_path / "other.snap").write_bytes(b"not a snapshot at all")
+    with pytest.raises(ValueError):
+        SnapshotReader(tmp_path / "other.snap")
+    write_snapshot([Lightbulb("Version Light")], tmp_path / "old.snap")
+    data = bytearray((tmp_path / "old.snap").read_bytes())
+    data[8] = VERSION + 1
+    (tmp_path / "old.snap").write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        SnapshotReader(tmp_path / "old.snap")
+
+
+'''Tests for SmartHomeHub Command Journal'''
+
+
+# Test that applied commands are journaled, query commands aren't, and replay rebuilds the state
+def test_journal_replay_rebuilds_state(tmp_path):
+    journal = CommandJournal(tmp_path / "journal", fsync=False)
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), journal=journal)
+    hub.add_device(Lock("Journal Lock"))
+    hub.add_device(Lightbulb("Journal Light"))
+    hub.send_command("Journal Lock", "unlock").result(timeout=5)
+    wait_all([hub.send_command("Journal Lock", "get_lock_status"), hub.send_command("Journal Light", "turn_on"),
+              hub.send_command("Journal Light", "change_brightness", 60)], timeout=5)
+    assert journal.durable_offset == 2
+    assert [(e.device_id, e.command, e.args) for e in journal.replay()] == [
+        ("Journal Lock", "unlock", ()), ("Journal Light", "turn_on", ()), ("Journal Light", "change_brightness", (60,))]
+    hub.shutdown()
+    journal.close()
+
+    reopened = CommandJournal(tmp_path / "journal", fsync=False)
+    restored = SmartHomeHub(event_sink=NullSink(), journal=reopened)
+    restored.add_device(Lock("Journal Lock"))
+    restored.add_device(Lightbulb("Journal Light"))
+    assert restored.replay() == 3
+    assert restored.devices["Journal Lock"].get_lock_status() == "unlocked"
+    assert restored.devices["Journal Light"].brightness == 60
+    assert reopened.append("Journal Lock", "lock") == 3
+    reopened.close()
+
+
+# Test that commands racing on one device are journaled in the order they were applied
+def test_journal_order_matches_apply_order(tmp_path):
+    # Journal that stalls the append of one entry, as a preempted worker would
+    class StallingJournal(CommandJournal):
+        def append(self, device_id, command, args=(), on_durable=None):
+            if args == (61,):
+                time.sleep(0.2)
+            return super().append(device_id, command, args, on_durable)
+
+    journal = StallingJournal(tmp_path, fsync=False)
+    hub = SmartHomeHub(executor="thread", event_sink=NullSink(), journal=journal)
+    thermostat = Thermostat("Racing Thermostat")
+    hub.add_device(thermostat)
+    first = hub.send_command("Racing Thermostat", "set_temperature", 61)
+    while thermostat.temperature != 61:  # Applied, its append is stalled
+        time.sleep(0.001)
+    wait_all([first, hub.send_command("Racing Thermostat", "set_temperature", 62)], timeout=5)
+    hub.shutdown()
+    restored = SmartHomeHub(event_sink=NullSink(), journal=journal)
+    restored.add_device(Thermostat("Racing Thermostat"))
+    assert restored.replay() == 2
+    assert restored.devices["Racing Thermostat"].temperature == thermostat.temperature == 62
+    journal.close()
+
+
+# Test that a checkpoint compacts the journal and replay starts from it
+def test_journal_checkpoint_compacts(tmp_path):
+    journal = CommandJournal(tmp_path, segment_size=1, fsync=False)
+    hub = SmartHomeHub(event_sink=NullSink(), journal=journal)
+    hub.add_device(Thermostat("Journal Thermostat"))
+    for temperature in (60, 65, 70):
+        hub.send_command("Journal Thermostat", "set_temperature", temperature).result(timeout=5)
+    assert len(journal.segments()) == 3
+    assert hub.checkpoint() == 3
+    hub.send_command("Journal Thermostat", "set_temperature", 72).result(timeout=5)
+    assert [e.offset for e in journal.replay()] == [3]
+    restored = SmartHomeHub(event_sink=NullSink(), journal=journal)
+    assert restored.replay() == 1
+    assert restored.devices["Journal Thermostat"].temperature == 72
+    hub.shutdown()
+    journal.close()
+
+
+# Test that a torn record at the end of the journal is dropped when it is reopened
+def test_journal_drops_torn_record(tmp_path):
+    journal = CommandJournal(tmp_path, fsync=False)
+    journal.append("Torn Light", "turn_on")
+    journal.append("Torn Light", "change_brightness", (30,))
+    journal.close()
+    _, path = journal.segments()[-1]
+    with open(path, "r+b") as file:
+        file.truncate(file.seek(0, 2) - 3)  # Cuts the last record short, like a crash mid write
+    reopened = CommandJournal(tmp_path, fsync=False)
+    assert [e.command for e in reopened.replay()] == ["turn_on"]
+    assert reopened.append("Torn Light", "turn_off") == 1
+    assert reopened.sync(timeout=5)
+    assert [e.command for e in reopened.replay()] == ["turn_on", "turn_off"]
+    reopened.close()
+
+
+'''Tests for SmartHomeHub Event Bus'''
+
+
+# Test that subscribers only receive the change events matching their filters
+def test_bus_filters_events():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    hub.add_device(Thermostat("Bus Thermostat"))
+    hub.add_device(Lightbulb("Bus Light"))
+    temperatures = hub.subscribe(device_type="Thermostat", field="temperature")
+    light = hub.subscribe(device_id="Bus Light")
+    everything = hub.subscribe(kinds=("change", "notice"))
+    wait_all([hub.send_command("Bus Thermostat", "turn_on"), hub.send_command("Bus Thermostat", "set_temperature", 68),
+              hub.send_command("Bus Light", "change_brightness", 50)], timeout=5)
+    assert hub.bus.flush(timeout=5)
+    event = temperatures.get(timeout=1)
+    assert (event.device_id, event.field, event.new) == ("Bus Thermostat", "temperature", 68)
+    assert temperatures.get(timeout=0) is None
+    assert light.drain() == []  # The light was off, so it only emitted a notice
+    assert sorted((e.device_id, e.kind) for e in everything.drain()) == [
+        ("Bus Light", "notice"), ("Bus Thermostat", "change"), ("Bus Thermostat", "change"),
+        ("Bus Thermostat", "notice")]
+    hub.shutdown()
+
+
+# Test the drop_oldest, drop_newest and coalesce policies of a full buffer
+def test_bus_buffer_policies():
+    bus = EventBus()
+    oldest = bus.subscribe(maxsize=2)
+    newest = bus.subscribe(maxsize=2, policy="drop_newest")
+    coalesced = bus.subscribe(maxsize=2, policy="coalesce")
+    tv = Television("Bus TV")
+    tv.event_sink = bus
+    tv.turn_on()
+    for volume in (10, 20, 30):
+        tv.set_volume(volume)
+    assert bus.flush(timeout=5)
+    assert [e.new for e in oldest.drain()] == [20, 30]
+    assert newest.dropped == 2 and [e.new for e in newest.drain()] == ["on", 10]
+    assert [(e.field, e.new) for e in coalesced.drain()] == [("status", "on"), ("volume", 30)]
+    with pytest.raises(ValueError):
+        bus.subscribe(policy="block")
+
+
+# Test that a closed subscription stops receiving events and wakes its readers
+def test_bus_close_unsubscribes():
+    bus = EventBus()
+    with bus.subscribe(device_id="Bus Lock") as subscription:
+        assert bus.count == 1
+    assert bus.count == 0 and bus.by_device == {}
+    assert subscription.get(timeout=5) is None
+    lock = Lock("Bus Lock")
+    lock.event_sink = bus
+    lock.unlocked()
+    assert bus.flush(timeout=5)
+    assert subscription.drain() == []
+
+
+'''Tests for SmartHomeHub Automation Rules'''
+
+
+# Test that a rule in its time window sends its commands when the watched field matches
+def test_rule_runs_commands_in_window():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    hub.rules.clock = lambda: time.mktime((2026, 10, 17, 23, 0, 0, 0, 0, -1))  # 23:00 local time
+    hub.add_device(Lightbulb("Rule Light"))
+    hub.add_device(GarageDoor("Rule Garage"))
+    hub.add_device(Lock("Rule Lock"))
+    hub.send_command("Rule Garage", "open_door").result(timeout=5)
+    hub.add_rule(Rule("night motion", "is_locked", False, [("Rule Light", "turn_on"), ("Rule Garage", "close_door")],
+                      device_id="Rule Lock", between=("22:00", "06:00")))
+    hub.add_rule(Rule("day motion", "is_locked", False, [("Rule Light", "turn_off")], device_type="Lock",
+                      between=("06:00", "22:00")))
+    hub.send_command("Rule Lock", "unlock").result(timeout=5)
+    hub.shutdown()
+    assert hub.rules.rules["night motion"].fired == 1
+    assert hub.rules.rules["day motion"].fired == 0
+    assert hub.get_device_status("Rule Light") == "on"
+    assert hub.devices["Rule Garage"].is_open is False
+
+
+# Test that a rule with a duration only fires if its condition holds for the whole duration
+def test_rule_duration():
+    now = [1000.0]
+    hub = SmartHomeHub(event_sink=NullSink())
+    hub.rules = RuleEngine(hub, clock=lambda: now[0], timer=False)
+    fridge = Refrigerator("Rule Fridge")
+    hub.add_device(fridge)
+    alerts = []
+    hub.add_rule(Rule("door left open", "door_open", True, [lambda rule, event: alerts.append(event.device_id)],
+                      device_id="Rule Fridge", duration=120))
+    fridge.door_status(True)
+    now[0] += 60
+    fridge.door_status(False)  # Closed before the two minutes passed, the rule is disarmed
+    now[0] += 120
+    assert hub.rules.tick() == 0
+    fridge.door_status(True)
+    now[0] += 119
+    assert hub.rules.tick() == 0
+    now[0] += 1
+    assert hub.rules.tick() == 1
+    assert alerts == ["Rule Fridge"]
+
+
+# Test that rule commands don't run on the worker holding the device lock, so a small pool can't deadlock
+def test_rule_actions_leave_the_worker(capsys):
+    hub = SmartHomeHub(executor="pool", workers=1, queue_size=2, event_sink=NullSink())
+    for i in range(3):
+        hub.add_device(Lightbulb(f"Pool Light {i}"))
+    hub.add_rule(Rule("cascade", "status", "on", [("Pool Light 1", "turn_on"), ("Pool Light 2", "turn_on"),
+                                                  ("Missing Light", "turn_on")], device_id="Pool Light 0"))
+    hub.send_command("Pool Light 0", "turn_on").result(timeout=5)
+    assert hub.rules.drain(timeout=5)
+    assert hub.shutdown(timeout=5)
+    assert [hub.get_device_status(f"Pool Light {i}") for i in range(3)] == ["on"] * 3
+    assert "Rule 'cascade' action failed: DeviceNotFoundError" in capsys.readouterr().err
+
+
+# Test that removing a rule drops it from the index
+def test_rule_remove():
+    engine = RuleEngine(None, timer=False)
+    engine.add(Rule("lights", "brightness", lambda value: value > 50, device_id="Rule Bulb"))
+    engine.add(Rule("other lights", "brightness", 100, device_id="Rule Bulb"))
+    assert len(engine.by_device[("Rule Bulb", "brightness")]) == 2
+    assert engine.remove("lights")
+    assert not engine.remove("lights")
+    engine.remove("other lights")
+    assert engine.by_device == {}
+    with pytest.raises(ValueError):
+        Rule("nothing", "brightness")
+
+
+'''Tests for SmartHomeHub Scheduler'''
+
+
+# Test that scheduled commands are sent once due, in deadline order, and cancelled ones never are
+def test_scheduler_sends_due_commands():
+    now = [5000.0]
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    hub.scheduler = Scheduler(hub, clock=lambda: now[0], driver=False)
+    hub.add_device(Television("Scheduled TV"))
+    hub.send_command("Scheduled TV", "turn_on").result(timeout=5)
+    hub.schedule_after(1800, "Scheduled TV", "turn_off")
+    hub.schedule_after(600, "Scheduled TV", "set_volume", 20)
+    muted = hub.schedule_after(900, "Scheduled TV", "set_volume", 0)
+    far = hub.schedule_at(now[0] + 400 * 86400, "Scheduled TV", "set_volume", 90)  # Beyond the top level
+    assert hub.cancel(muted) and not hub.cancel(muted)
+    now[0] += 599
+    assert hub.scheduler.advance() == 0
+    now[0] += 1
+    assert hub.scheduler.advance() == 1
+    now[0] += 1200
+    assert hub.scheduler.advance() == 1
+    now[0] += 400 * 86400
+    assert hub.scheduler.advance() == 1 and far.runs == 1
+    hub.shutdown()
+    assert hub.devices["Scheduled TV"].volume == 90
+    assert hub.get_device_status("Scheduled TV") == "off"
+    assert hub.scheduler.pending == 0
+
+
+# Test that a command scheduled in the tick the wheel starts in isn't sent before its deadline
+def test_scheduler_starts_at_current_tick():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    hub.scheduler = Scheduler(hub, clock=lambda: 100.2, resolution=1.0, driver=False)
+    hub.add_device(Lightbulb("Early Light"))
+    hub.schedule_at(100.7, "Early Light", "turn_on")
+    assert hub.scheduler.advance(100.5) == 0
+    assert hub.scheduler.advance(101.0) == 1
+    hub.shutdown()
+    assert hub.get_device_status("Early Light") == "on"
+
+
+# Test that cron commands repeat until cancelled
+def test_scheduler_cron():
+    cron = CronSpec("30 22 * * 1-5")
+    monday = datetime.datetime(2026, 10, 19, 12, 0).timestamp()
+    assert datetime.datetime.fromtimestamp(cron.next_after(monday)) == datetime.datetime(2026, 10, 19, 22, 30)
+    friday = datetime.datetime(2026, 10, 23, 23, 0).timestamp()
+    assert datetime.datetime.fromtimestamp(cron.next_after(friday)) == datetime.datetime(2026, 10, 26, 22, 30)
+    with pytest.raises(ValueError):
+        CronSpec("61 * * * *")
+
+    now = [monday]
+    hub = SmartHomeHub(event_sink=NullSink())
+    hub.scheduler = Scheduler(hub, clock=lambda: now[0], driver=False)
+    hub.add_device(Lock("Scheduled Lock"))
+    nightly = hub.schedule_cron("30 22 * * *", "Scheduled Lock", "lock")
+    for day in range(3):
+        now[0] += 86400
+        hub.scheduler.advance()
+    assert nightly.runs == 3
+    assert hub.cancel(nightly)
+    now[0] += 86400
+    assert hub.scheduler.advance() == 0
+    hub.shutdown()
+
+
+# Test that the driver thread sends commands with the real clock
+def test_scheduler_driver():
+    hub = SmartHomeHub(event_sink=NullSink())
+    hub.add_device(Lightbulb("Scheduled Light"))
+    scheduled = hub.schedule_after(0.05, "Scheduled Light", "turn_on")
+    deadline = time.time() + 5
+    while scheduled.runs == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    hub.shutdown()
+    assert hub.get_device_status("Scheduled Light") == "on"
+
+
+'''Tests for SmartHomeHub Benchmark Suite'''
+
+
+# Test that the throughput benchmark reports every executor and covers every device class
+def test_bench_throughput():
+    assert set(COMMAND_MIX) == set(DEVICE_CLASSES)
+    result = bench_throughput(devices=16, commands=200, clients=2, executors=("pool", "lanes"))
+    assert set(result["executors"]) == {"pool", "lanes"}
+    for report in result["executors"].values():
+        assert report["commands_per_sec"] > 0
+        assert set(report["latency_ms"]) == {"p50", "p95", "p99", "p999"}
+        assert report["peak_threads"] >= 1
+
+
+# Test the latency percentiles on known samples
+def test_latency_percentiles():
+    samples = [n / 1000 for n in range(1, 1001)]  # 1ms to 1000ms
+    assert latency_percentiles(samples) == {"p50": 501.0, "p95": 951.0, "p99": 991.0, "p999": 1000.0}
+    assert latency_percentiles([]) == {}
+
+
+'''Tests for SmartHomeHub Metrics'''
+
+
+# Test that commands, errors and in-flight counts are recorded per device type and command
+def test_hub_metrics():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), metrics=True)
+    hub.add_device(Lock("Metrics Lock"))
+    wait_all([hub.send_command("Metrics Lock", "unlock"), hub.send_command("Metrics Lock", "lock"),
+              hub.send_command("Metrics Lock", "unlock")], timeout=5)
+    hub.send_command("Metrics Lock", "fly")
+    hub.send_commands([("Metrics Nowhere", "lock")])
+    hub.shutdown()
+    metrics = hub.metrics()
+    assert metrics["commands"]["Lock.unlock"]["latency"]["count"] == 2
+    assert metrics["commands"]["Lock.unlock"]["dispatch_wait"]["p50"] is not None
+    assert metrics["errors"] == {"Lock.fly.UnsupportedCommandError": 1, "None.lock.DeviceNotFoundError": 1}
+    assert metrics["in_flight"] == 0
+    assert hub.metrics()["in_flight"] == 0  # Reading the count doesn't change it
+    hub.remove_device("Metrics Lock")
+    with pytest.raises(RuntimeError):
+        SmartHomeHub().metrics()
+
+
+# Test that the lock wrapper only records contended waits
+def test_instrumented_lock():
+    waits = Histogram()
+    lock = InstrumentedLock(threading.Lock(), waits)
+    with lock:
+        assert lock.locked()
+        assert not lock.acquire(blocking=False)
+        waiter = threading.Thread(target=lambda: lock.acquire() and lock.release())
+        waiter.start()
+        time.sleep(0.02)
+    waiter.join(timeout=5)
+    assert waits.count == 1 and waits.sum >= 0.01
+
+
+# Test the Prometheus text output, written to a file and served over HTTP
+def test_prometheus_exporter(tmp_path):
+    import urllib.request
+    hub = SmartHomeHub(event_sink=NullSink(), metrics=True)
+    hub.add_device(Television("Metrics TV"))
+    hub.send_command("Metrics TV", "set_volume", 20).result(timeout=5)
+    hub.shutdown()
+    exporter = hub.prometheus_exporter()
+    exporter.write(tmp_path / "hub.prom")
+    text = (tmp_path / "hub.prom").read_text()
+    assert 'smarthome_command_latency_seconds_count{device_type="Television",command="set_volume"} 1' in text
+    assert 'smarthome_command_latency_seconds_bucket{device_type="Television",command="set_volume",le="+Inf"} 1' in text
+    assert "smarthome_commands_in_flight 0" in text
+    host, port = exporter.serve(port=0)
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=5) as response:
+            assert "# TYPE smarthome_hub_lock_wait_seconds histogram" in response.read().decode()
+    finally:
+        exporter.close()
+
+
+'''Tests for SmartHomeHub Command Coalescing'''
+
+
+# Test that queued setters are replaced by the newest one and every Future gets its result
+def test_coalescing_replaces_queued_setters():
+    hub = SmartHomeHub(executor="lanes", workers=1, event_sink=NullSink(), metrics=True, coalesce=True)
+    hub.add_device(Television("Slider TV"))
+    gate = threading.Event()
+    hub.executor.submit("Slider TV", gate.wait, 5)  # Holds the lane so the setters queue up
+    futures = [hub.send_command("Slider TV", "set_volume", volume) for volume in range(1, 51)]
+    futures += hub.send_commands([("Slider TV", "set_volume", (volume,)) for volume in range(51, 61)])
+    gate.set()
+    wait_all(futures, timeout=5)
+    assert hub.devices["Slider TV"].volume == 60
+    metrics = hub.metrics()
+    assert metrics["commands"]["Television.set_volume"]["latency"]["count"] == 1
+    assert metrics["coalesced"] == 59
+    hub.shutdown()
+    assert hub.metrics()["in_flight"] == 0
+
+
+# Test that setters aren't coalesced across other commands, or without coalescing enabled
+def test_coalescing_keeps_order_with_other_commands():
+    for coalesce, runs in ((True, 2), (False, 3)):
+        hub = SmartHomeHub(executor="lanes", workers=1, event_sink=NullSink(), metrics=True, coalesce=coalesce)
+        hub.add_device(Lightbulb("Slider Bulb"))
+        gate = threading.Event()
+        hub.executor.submit("Slider Bulb", gate.wait, 5)
+        futures = [hub.send_command("Slider Bulb", "change_brightness", 10),  # Ignored while the bulb is off
+                   hub.send_command("Slider Bulb", "turn_on"),
+                   hub.send_command("Slider Bulb", "change_brightness", 50),
+                   hub.send_command("Slider Bulb", "change_brightness", 70)]
+        gate.set()
+        wait_all(futures, timeout=5)
+        hub.shutdown()
+        assert hub.devices["Slider Bulb"].status == "on" and hub.devices["Slider Bulb"].brightness == 70
+        assert hub.metrics()["commands"]["Smart Lightbulb.change_brightness"]["latency"]["count"] == runs
+
+
+# Test that cancelling a command also cancels the commands it replaced
+def test_coalesced_commands_cancelled_on_shutdown():
+    hub = SmartHomeHub(executor="lanes", workers=1, event_sink=NullSink(), coalesce=True)
+    hub.add_device(Thermostat("Slider Thermostat"))
+    gate = threading.Event()
+    hub.executor.submit("Slider Thermostat", gate.wait, 5)
+    futures = [hub.send_command("Slider Thermostat", "set_temperature", temp) for temp in (70, 72, 74)]
+    hub.shutdown(drain=False, timeout=0)
+    gate.set()
+    assert hub.shutdown(timeout=5)
+    assert all(future.cancelled() for future in futures)
+
+
+'''Tests for SmartHomeHub Admission Control'''
+
+
+# Test that commands over the in-flight limit are rejected, or make room by dropping the oldest queued command
+def test_admission_in_flight_limit():
+    for policy in ("reject", "drop_oldest"):
+        admission = AdmissionController(max_in_flight=2, policy=policy)
+        hub = SmartHomeHub(executor="lanes", workers=1, event_sink=NullSink(), admission=admission)
+        hub.add_device(Thermostat("Busy Thermostat"))
+        gate = threading.Event()
+        hub.executor.submit("Busy Thermostat", gate.wait, 5)  # Holds the lane so the commands stay queued
+        futures = [hub.send_command("Busy Thermostat", "set_temperature", temp) for temp in (70, 72, 74)]
+        gate.set()
+        results = wait_all(futures, timeout=5, return_exceptions=True)
+        if policy == "reject":
+            assert isinstance(results[2], HubOverloadedError) and admission.rejected == 1
+            assert hub.devices["Busy Thermostat"].temperature == 72
+        else:
+            assert isinstance(results[0], CommandDroppedError) and admission.dropped == 1
+            assert hub.devices["Busy Thermostat"].temperature == 74
+        assert hub.send_commands([("Busy Thermostat", "set_temperature", (76,))])[0].exception(timeout=5) is None
+        hub.shutdown()
+        assert admission.in_flight == 0
+
+
+# Test the per-device token buckets, a flooding device doesn't use up the tokens of the others
+def test_admission_rate_limit():
+    now = [0.0]
+    admission = AdmissionController(rate=2, burst=2, policy="reject", clock=lambda: now[0])
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), admission=admission)
+    hub.add_device(Television("Flood TV"))
+    hub.add_device(Television("Quiet TV"))
+    futures = [hub.send_command("Flood TV", "set_volume", volume) for volume in (10, 20, 30)]
+    futures.append(hub.send_command("Quiet TV", "set_volume", 40))
+    results = wait_all(futures, timeout=5, return_exceptions=True)
+    assert isinstance(results[2], RateLimitedError) and results[3] is None
+    now[0] = 0.5  # Half a second refills one token
+    assert hub.send_command("Flood TV", "set_volume", 50).result(timeout=5) is None
+    assert isinstance(hub.send_command("Flood TV", "set_volume", 60).exception(timeout=5), RateLimitedError)
+    admission.limit("Flood TV", None)  # Removes the device's limit
+    assert hub.send_command("Flood TV", "set_volume", 70).result(timeout=5) is None
+    hub.shutdown()
+    assert hub.devices["Flood TV"].volume == 70
+
+
+# Test that the block policy waits for a token, and rejects once its timeout passes
+def test_admission_block_policy():
+    admission = AdmissionController(rate=20, burst=1, policy="block", timeout=1.0)
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), admission=admission)
+    hub.add_device(Lock("Paced Lock"))
+    start = time.monotonic()
+    wait_all([hub.send_command("Paced Lock", "unlock"), hub.send_command("Paced Lock", "lock")], timeout=5)
+    assert time.monotonic() - start >= 0.04  # The second command waited about 1/20 s for its token
+    admission.limit("Paced Lock", 0.1)
+    hub.send_command("Paced Lock", "unlock").result(timeout=5)
+    admission.timeout = 0.05
+    assert isinstance(hub.send_command("Paced Lock", "lock").exception(timeout=5), RateLimitedError)
+    hub.shutdown()
+    assert hub.devices["Paced Lock"].is_locked is False
+
+
+# Test that the block policy waits for an in-flight slot, and that admit(wait=False) never waits
+def test_admission_block_waits_for_slot():
+    admission = AdmissionController(max_in_flight=1, rate=1, burst=1, policy="block", timeout=5)
+    first, second = object(), object()
+    admission.admit("Slot Device", first)
+    threading.Timer(0.2, admission.release, (first,)).start()
+    start = time.monotonic()
+    admission.admit("Other Device", second)
+    assert 0.15 <= time.monotonic() - start < 4  # Waited for the first command to finish
+    admission.release(second)
+    start = time.monotonic()
+    with pytest.raises(RateLimitedError):
+        admission.admit("Slot Device", object(), wait=False)  # Its token is spent, and it may not wait for one
+    assert time.monotonic() - start < 0.1
+    assert admission.in_flight == 0
+
+
+# Test that rules work under a full admission controller and commands sent from a running command don't wait
+def test_admission_with_rules():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), admission=AdmissionController(max_in_flight=1))
+    for i in range(3):
+        hub.add_device(Lightbulb(f"Admitted Light {i}"))
+    inline = []  # Futures of the commands sent from inside the running command
+    hub.add_rule(Rule("follow", "status", "on", [("Admitted Light 1", "turn_on")], device_id="Admitted Light 0"))
+    hub.add_rule(Rule("inline", "status", "on", [lambda rule, event: inline.append(
+        hub.send_command("Admitted Light 2", "turn_on"))], device_id="Admitted Light 0"))
+    hub.send_command("Admitted Light 0", "turn_on").result(timeout=3)
+    assert isinstance(inline[0].exception(timeout=3), HubOverloadedError)  # Its own slot is the one in use
+    assert hub.rules.drain(timeout=3)
+    assert hub.shutdown(timeout=3)
+    assert [hub.get_device_status(f"Admitted Light {i}") for i in range(3)] == ["on", "on", "off"]
+
+
+'''Tests for ShardedHub Class'''
+
+
+# Test that devices pickle with their state and come back with a lock of their own
+def test_device_pickles_state():
+    import pickle
+    television = Television("Pickled TV")
+    television.turn_on()
+    television.set_volume(35)
+    television.change_source("HDMI 2")
+    copy = pickle.loads(pickle.dumps(television))
+    assert (copy.device_id, copy.status, copy.volume, copy.input_source) == ("Pickled TV", "on", 35, "HDMI 2")
+    assert copy.lock is not television.lock and not copy.lock.locked()
+
+
+# Test that shard_for is stable and spreads devices over the shards
+def test_shard_for():
+    assert shard_for("Living Room Light", 4) == shard_for("Living Room Light", 4)
+    assert {shard_for(f"Device {i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+# Test the SmartHomeHub surface of a ShardedHub, plus batches, broadcast and query across shards
+def test_sharded_hub():
+    hub = ShardedHub(shards=2, event_sink=NullSink())
+    try:
+        for i in range(6):
+            hub.add_device(Lock(f"Shard Lock {i}"))
+        hub.add_device(Television("Shard TV"))
+        assert {shard_for(f"Shard Lock {i}", 2) for i in range(6)} == {0, 1}  # The locks span both shards
+        assert hub.send_command("Shard Lock 0", "unlock").result(timeout=10) is None
+        assert hub.send_command("Shard Lock 0", "get_lock_status").result(timeout=10) == "unlocked"
+        assert hub.get_device_status("Shard Lock 0") == "off"  # Locks report the SmartDevice status
+        assert isinstance(hub.send_command("Shard Nowhere", "lock").exception(timeout=10), DeviceNotFoundError)
+        futures = hub.send_commands([("Shard Lock 1", "unlock"), ("Shard TV", "set_volume", (40,))])
+        assert wait_all(futures, timeout=10) == [None, None]
+        results = hub.send_batch([("Shard Lock 2", "unlock"), ("Shard Lock 2", "get_lock_status"),
+                                  ("Shard TV", "fly")]).result(timeout=10)
+        assert results[1] == "unlocked" and isinstance(results[2], UnsupportedCommandError)
+        assert sorted(hub.broadcast("lock", device_type="Lock")) == [f"Shard Lock {i}" for i in range(6)]
+        assert sorted(device.device_id for device in hub.query("Lock", is_locked=True)) == \
+            [f"Shard Lock {i}" for i in range(6)]
+        hub.remove_device("Shard TV")
+        assert hub.get_device_status("Shard TV") is None
+    finally:
+        assert hub.shutdown(timeout=10)
+
+
+
+# Class defines a device whose command returns a value that can't be pickled, to test the answers of a shard
+class LockingSensor(SmartDevice):
+    # Initialization of device
+    def __init__(self, device_id):
+        super().__init__(device_id, "Locking Sensor")
+
+    # Returns a lock, which can't be sent back from a shard process
+    @command("read_lock")
+    def read_lock(self):
+        return threading.Lock()
+
+
+# Test that requests and answers that can't be pickled fail their own Future and leave the shard answering
+def test_sharded_hub_unpicklable_answer():
+    hub = ShardedHub(shards=1, event_sink=NullSink())
+    try:
+        hub.add_device(LockingSensor("Locking Sensor"))
+        futures = hub.send_commands([("Locking Sensor", "turn_on", (threading.Lock(),)),
+                                     ("Locking Sensor", "turn_off")])
+        assert isinstance(futures[0].exception(timeout=10), pickle.PicklingError)
+        assert futures[1].result(timeout=10) is None
+        futures = hub.send_commands([("Locking Sensor", "read_lock"), ("Locking Sensor", "turn_on")])
+        assert isinstance(futures[0].exception(timeout=10), pickle.PicklingError)
+        assert futures[1].result(timeout=10) is None
+        assert hub.get_device_status("Locking Sensor") == "on"
+    finally:
+        assert hub.shutdown(timeout=10)
+
+
+'''Tests for HubServer Class'''
+
+
+# Test pipelined commands, status, query and remote errors over a Unix domain socket
+def test_hub_server_unix_socket(tmp_path):
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    hub.add_device(Television("Served TV"))
+    hub.add_device(Lock("Served Lock"))
+    server = HubServer(hub, str(tmp_path / "hub.sock"))
+    try:
+        with HubClient(server.start(), timeout=5) as client:
+            futures = client.send_commands([("Served TV", "set_volume", (i,)) for i in range(100)])
+            futures.append(client.send_command("Served Lock", "get_lock_status"))
+            assert wait_all(futures, timeout=10) == [None] * 100 + ["locked"]
+            assert hub.devices["Served TV"].volume == 99  # Lanes keep the commands of a device in order
+            assert client.get_device_status("Served Lock", timeout=10) == "off"
+            assert client.query("Lock", timeout=10, is_locked=True) == ["Served Lock"]
+            hub.add_device(Lightbulb("Served Light"))
+            hub.execute_device_command(hub.devices["Served Light"], "turn_on")
+            assert client.query(timeout=10, status=("on", "on")) == ["Served Light"]  # A range, sent as a list
+            assert sorted(client.query(timeout=10, status=("a", "og"))) == ["Served Lock", "Served TV"]
+            assert isinstance(client.send_command("Nowhere", "lock").exception(timeout=10), DeviceNotFoundError)
+            error = client.send_command("Served TV", "fly").exception(timeout=10)
+            assert isinstance(error, UnsupportedCommandError)
+    finally:
+        server.close()
+        hub.shutdown()
+
+
+# Test a ClientPool against a TCP server that runs non-blocking commands directly
+def test_hub_server_tcp_direct():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    for i in range(8):
+        hub.add_device(Lock(f"Pooled Lock {i}"))
+    server = HubServer(hub, ("127.0.0.1", 0), direct=True)
+    try:
+        with ClientPool(server.start(), size=3) as pool:
+            futures = pool.send_commands([(f"Pooled Lock {i}", "unlock") for i in range(8)])
+            assert wait_all(futures, timeout=10) == [None] * 8
+            assert pool.send_command("Pooled Lock 5", "get_lock_status").result(timeout=10) == "unlocked"
+            assert pool.query("Lock", timeout=10, is_locked=True) == []
+            assert sum(client is not None for client in pool.clients) == 3
+    finally:
+        server.close()
+        hub.shutdown()
+
+
+# Test that closing the server fails the requests still waiting for a response
+def test_hub_server_close_fails_pending(tmp_path):
+    release = threading.Event()
+
+    class StuckSensor(SmartDevice):
+        def __init__(self, device_id):
+            super().__init__(device_id, "Stuck Sensor")
+
+        @command("read_stuck", blocking=True)
+        def read_stuck(self):
+            return release.wait(10)
+
+    hub = SmartHomeHub(executor="thread", event_sink=NullSink())
+    hub.add_device(StuckSensor("Stuck Sensor"))
+    server = HubServer(hub, str(tmp_path / "hub.sock"))
+    client = HubClient(server.start(), timeout=5)
+    try:
+        future = client.send_command("Stuck Sensor", "read_stuck")
+        assert client.get_device_status("Stuck Sensor", timeout=10) == "off"  # The server answers meanwhile
+        server.close()
+        assert isinstance(future.exception(timeout=10), ConnectionError)
+        with pytest.raises(ConnectionError):
+            client.send_command("Stuck Sensor", "read_stuck")
+    finally:
+        release.set()
+        client.close()
+        hub.shutdown()
+
+
+# Test that results the server can't encode and arguments the client can't encode fail only their own request
+def test_hub_server_unencodable(tmp_path):
+    class OddSensor(SmartDevice):
+        def __init__(self, device_id):
+            super().__init__(device_id, "Odd Sensor")
+
+        @command("read_odd")
+        def read_odd(self, *args):
+            return "\ud800"  # A lone surrogate has no UTF-8 encoding
+
+        @command("read_even")
+        def read_even(self, *args):
+            return len(args)
+
+    hub = SmartHomeHub(executor="thread", event_sink=NullSink())
+    hub.add_device(OddSensor("Odd Sensor"))
+    server = HubServer(hub, str(tmp_path / "hub.sock"))
+    try:
+        with HubClient(server.start(), timeout=5) as client:
+            assert isinstance(client.send_command("Odd Sensor", "read_odd").exception(timeout=10), RemoteCommandError)
+            with pytest.raises(ValueError):
+                client.send_command("Odd Sensor", "read_even", "\ud800")  # Fails after staging its definitions
+            futures = client.send_commands([("Odd Sensor", "read_even", ("\ud800",)),
+                                            ("Odd Sensor", "read_even", (1, 2))])
+            assert isinstance(futures[0].exception(timeout=10), ValueError)
+            assert futures[1].result(timeout=10) == 2
+            assert client.send_command("Odd Sensor", "read_even", "x").result(timeout=10) == 1
+    finally:
+        server.close()
+        hub.shutdown()
+
+
+# Test that results too large for a frame are answered with an error, and batches over the limit are split
+def test_hub_server_frame_limit(tmp_path, monkeypatch):
+    import HubServer as server_module
+    monkeypatch.setattr(server_module, "_MAX_FRAME", 128)  # Shared by both ends, they run in this process
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    for i in range(8):
+        hub.add_device(Lock(f"Framed Lock {i}"))
+    server = HubServer(hub, str(tmp_path / "hub.sock"))
+    try:
+        with HubClient(server.start(), timeout=5) as client:
+            with pytest.raises(ValueError):
+                client.query("Lock", timeout=10)  # Eight ids don't fit in 128 bytes
+            futures = client.send_commands([(f"Framed Lock {i}", "get_lock_status") for i in range(8)] * 4)
+            assert wait_all(futures, timeout=10) == ["locked"] * 32  # More than one frame of responses
+            error = client.send_command("Framed Nowhere", "lock").exception(timeout=10)
+            assert isinstance(error, DeviceNotFoundError) and error.args[0] == "Framed Nowhere"
+    finally:
+        server.close()
+        hub.shutdown()
+
+
+'''Tests for CommandCodec'''
+
+
+# Test that commands round-trip with every kind of argument, including ones that fall back to JSON
+def test_codec_round_trip():
+    commands = [("Codec TV", "set_volume", (35,)), ("Codec TV", "turn_on", ()),
+                ("Codec Thermostat", "set_temperature", (71.5,)), ("Codec TV", "change_source", ("HDMI 2",)),
+                ("Codec Fridge", "door_status", (True,)), ("Codec Plugin", "configure", (None, [1, 2], {"a": 1})),
+                ("Codec TV", "set_volume", (2 ** 40,)), ("Codec TV", "set_volume", (2 ** 70,))]
+    for command in commands:
+        assert decode_command(encode_command(*command)) == command
+    encoder = CommandEncoder()
+    data = encoder.encode_many(commands)
+    assert CommandDecoder().decode(data) == commands
+    assert len(encoder.encode("Codec TV", "set_volume", (36,))) == 12  # Defined already, a fixed size record
+    assert decode_value(memoryview(b"xx" + encode_value("héllo")), 2) == ("héllo", 13)
+
+
+# Test that a decoder reads records in place from a memoryview and rejects what a stream never defined
+def test_codec_decoder_reads_stream():
+    encoder = CommandEncoder()
+    decoder = CommandDecoder()
+    first = encoder.encode("Stream Lock", "lock")
+    second = encoder.encode("Stream Lock", "unlock")
+    third = encoder.encode("Stream Lock", "lock")  # Needs no definitions, "lock" was defined by first
+    assert decoder.decode(first) == [("Stream Lock", "lock", ())]
+    assert decoder.decode(second) == [("Stream Lock", "unlock", ())]
+    with memoryview(third) as view:
+        assert decoder.read(view, 0) == (("Stream Lock", "lock", ()), len(third))
+    assert opcodes.name(opcodes.opcode("unlock")) == "unlock"
+    with pytest.raises(ValueError):
+        CommandDecoder().decode(second)  # Doesn't know the definitions sent before it
+    with pytest.raises(ValueError):
+        decoder.decode(first[:-1])
+
+
+# Test that the hub hands out device handles and runs commands from an encoded buffer
+def test_hub_send_encoded():
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink())
+    hub.add_device(Lightbulb("Encoded Light"))
+    hub.add_device(Lock("Encoded Lock"))
+    assert (hub.handles.handle("Encoded Light"), hub.handles.handle("Encoded Lock")) == (0, 1)
+    data = hub.command_encoder().encode_many([("Encoded Light", "turn_on"), ("Encoded Light", "change_brightness",
+                                                                           (40,)), ("Encoded Lock", "get_lock_status")])
+    assert wait_all(hub.send_encoded(data), timeout=5) == [None, None, "locked"]
+    assert hub.devices["Encoded Light"].brightness == 40
+    hub.remove_device("Encoded Lock")
+    assert hub.handles.handle("Encoded Lock") is None
+    hub.shutdown()
+
+
+# Test that NumPy scalar arguments replay as plain numbers and that other unsupported arguments are rejected
+def test_journal_replays_numpy_scalars(tmp_path):
+    np = pytest.importorskip("numpy")
+    journal = CommandJournal(tmp_path / "journal", fsync=False)
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), journal=journal)
+    hub.add_device(Thermostat("NumPy Thermostat"))
+    hub.send_command("NumPy Thermostat", "set_temperature", np.int64(70)).result(timeout=5)
+    hub.shutdown()
+    journal.close()
+    reopened = CommandJournal(tmp_path / "journal", fsync=False)
+    restored = SmartHomeHub(event_sink=NullSink(), journal=reopened)
+    restored.add_device(Thermostat("NumPy Thermostat"))
+    assert restored.replay() == 1
+    temperature = restored.devices["NumPy Thermostat"].temperature
+    assert temperature == 70 and type(temperature) is int
+    reopened.close()
+    with pytest.raises(TypeError):
+        encode_command("NumPy Thermostat", "set_temperature", (datetime.datetime(2024, 1, 1),))
+
+
+'''Tests for Device Versions'''
+
+
+# Test that every transition bumps the version once and read_state() returns it with the state
+def test_device_version_counts_transitions():
+    bulb = Lightbulb("Versioned Light")
+    bulb.event_sink = NullSink()
+    assert bulb.version == 0
+    bulb.turn_on()  # Status and brightness change in one transition
+    bulb.change_brightness(60)
+    assert bulb.version == 2
+    assert bulb.read_fields("status", "brightness") == ["on", 60]
+    assert bulb.read_state() == {"version": 2, "status": "on", "brightness": 60}
+    tv = Television("Versioned TV")
+    assert tv.read_state()["input_source"] == tv.input_source  # Plain slots are part of the state
+
+
+# Test that optimistic readers never see a lightbulb half turned on or off
+def test_lightbulb_transitions_are_atomic():
+    bulb = Lightbulb("Atomic Light")
+    bulb.event_sink = NullSink()
+    done = threading.Event()
+    seen = set()
+
+    def read():
+        while not done.is_set():
+            seen.add(tuple(bulb.read_fields("status", "brightness")))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for _ in range(2000):
+        bulb.turn_on()
+        bulb.turn_off()
+    done.set()
+    reader.join()
+    assert seen <= {("on", 100), ("off", 0)}
+    assert bulb.version == 4000
+
+
+# Test that an air purifier turns on in one transition, with its events emitted in order
+def test_air_purifier_turns_on_in_one_transition():
+    sink = CollectingSink()
+    purifier = AirPurifier("Atomic Purifier")
+    purifier.event_sink = sink
+    purifier.turn_on()
+    assert purifier.version == 1
+    assert [(e.field, e.new) for e in sink.events] == [("purification_level", 1), ("fan_speed", 1),
+                                                       ("status", "on"), (None, None)]
+    assert purifier.read_fields("status", "purification_level", "fan_speed") == ["on", 1, 1]
+    assert pickle.loads(pickle.dumps(purifier)).read_state()["fan_speed"] == 1
+
+
+'''Tests for TelemetryStore Class'''
+
+
+# Test that samples are kept raw and rolled up per minute and per hour with min/max/mean
+def test_telemetry_rollups():
+    pytest.importorskip("numpy")
+    store = TelemetryStore(raw_capacity=4, batch=3)
+    for i, temp in enumerate([70, 72, 74, 71, 69, 68]):
+        store.record("Chart Thermostat", "temperature", 3600 + 30 * i, temp)  # Two samples per minute
+    times, values = store.samples("Chart Thermostat", "temperature")
+    assert list(times) == [3660, 3690, 3720, 3750] and list(values) == [74, 71, 69, 68]  # Only the last 4 stay
+    minutes = store.history("temperature", 3600, 3780, resolution="minute")
+    assert list(minutes["time"]) == [3600, 3660, 3720]
+    assert minutes["min"].tolist() == [[70, 71, 68]] and minutes["max"].tolist() == [[72, 74, 69]]
+    assert minutes["mean"].tolist() == [[71, 72.5, 68.5]]
+    hour = store.aggregate("temperature", 3600, 7200, resolution="hour")
+    assert hour["device_ids"] == ["Chart Thermostat"] and hour["count"].tolist() == [6]
+    assert (hour["min"][0], hour["max"][0]) == (68, 74) and hour["mean"][0] == pytest.approx(424 / 6)
+    with pytest.raises(ValueError):
+        store.record("Chart Thermostat", "brightness", 0, 1)  # Not a recorded field
+
+
+# Test that the rings drop buckets that fall out of them and queries pick a resolution that covers the range
+def test_telemetry_rings_are_bounded():
+    pytest.importorskip("numpy")
+    store = TelemetryStore(minute_capacity=3, hour_capacity=2)
+    store.record_many("volume", ["Ring TV"], 0, 10)
+    store.record_many("volume", ["Ring TV"], 600, 20)  # Ten minutes later, the minute ring only holds 3 minutes
+    store.record_many("volume", ["Ring TV"], 30, 99)  # Too old for the minute ring, still in the hour ring
+    assert store.history("volume", 0, 660, resolution="minute")["count"].tolist() == [[0, 0, 1]]
+    assert store.aggregate("volume", 0, 660)["max"].tolist() == [99]  # The minute ring starts too late, uses hours
+    assert store.aggregate("volume", 480, 660)["mean"].tolist() == [20]
+    store.record_many("volume", ["Ring TV"], 3 * 3600, 30)  # Moves the hour ring past the first hour
+    assert store.aggregate("volume", 0, 4 * 3600, resolution="hour")["count"].tolist() == [1]
+    empty = store.aggregate("volume", 3600, 7200, resolution="hour")
+    assert empty["count"].tolist() == [0] and np.isnan(empty["mean"][0])
+
+
+# Test that many series are recorded and aggregated at once and forgotten series free their rows
+def test_telemetry_many_series():
+    pytest.importorskip("numpy")
+    store = TelemetryStore(capacity=2)
+    fridges = [f"Fleet Fridge {i}" for i in range(5)]  # More series than the initial capacity
+    for minute in range(10):
+        store.record_many("freezer_temp", fridges, 60.0 * minute, [float(i - minute) for i in range(5)])
+    result = store.aggregate("freezer_temp", 0, 600, device_ids=fridges[3:] + ["Unknown Fridge"])
+    assert result["device_ids"] == fridges[3:]
+    assert result["min"].tolist() == [-6, -5] and result["max"].tolist() == [3, 4]
+    assert store.aggregate("freezer_temp", 0, 600, resolution="raw")["count"].tolist() == [10] * 5
+    store.forget(fridges[0])
+    store.record_many("freezer_temp", ["New Fridge"], 600, 1.0)
+    assert store.histories["freezer_temp"].rows["New Fridge"] == 0  # Reuses the freed row, starting empty
+    assert store.samples("New Fridge", "freezer_temp")[1].tolist() == [1.0]
+    assert store.series_count() == 5
+
+
+# Test that a hub records the telemetry fields of its devices when added and on every change
+def test_hub_records_telemetry():
+    pytest.importorskip("numpy")
+    hub = SmartHomeHub(executor="lanes", event_sink=NullSink(), telemetry=TelemetryStore())
+    hub.add_device(Thermostat("Telemetry Thermostat"))
+    hub.add_device(Lightbulb("Telemetry Light"))
+    hub.send_command("Telemetry Thermostat", "set_temperature", 75).result(timeout=5)
+    hub.send_command("Telemetry Light", "change_brightness", 50).result(timeout=5)
+    times, values = hub.telemetry.samples("Telemetry Thermostat", "temperature")
+    assert values.tolist() == [65, 75] and times[0] <= times[1]
+    summary = hub.telemetry.aggregate("temperature", times[0], time.time() + 1)
+    assert summary["device_ids"] == ["Telemetry Thermostat"] and summary["max"].tolist() == [75]
+    hub.remove_device("Telemetry Thermostat")
+    assert hub.telemetry.series_count() == 0
+    hub.shutdown()
@@ -0,0 +1,316 @@
+from Devices import *
+from Devices import _RUNTIME_SLOTS
+from array import array
+import importlib
+import json
+import mmap
+import struct
+import sys
+import threading
+
+'''
+Snapshot file layout (version 1, little-endian):
+    header      8s magic, u16 version, u16 reserved, u32 section count
+    statuses    u16 count, then u16 length + UTF-8 bytes for each status name
+    sections    one per device class:
+                    u16 length + class path ("module:qualname"), u16 length + device_type
+                    u32 device count, u64 length + NUL separated UTF-8 device ids, padded to 8 bytes
+                    u16 field count, then per field: u16 length + name, 1 byte type, u64 length + data padded to 8 bytes
+Field types are "?" (bool), "b" (int8), "h" (int16), "d" (float64), "s" (int16 status code) and
+"j" (NUL separated JSON text, for slots that aren't StateFields). Numeric columns are read in place through
+memoryviews over the memory-mapped file.
+'''
+
+MAGIC = b"SHHSNAP\0"  # Marks a smart home hub snapshot file
+VERSION = 1  # Version of the layout written by write_snapshot()
+_HEADER = struct.Struct("<8sHHI")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_TYPES = {"bool": "?", "int8": "b", "int16": "h", "float64": "d", "status": "s"}  # StateField dtype to field type
+
+
+# Returns the (name, field type) pairs a snapshot stores for a device class
+def snapshot_fields(cls):
+    fields = [(name, _TYPES[dtype]) for name, dtype in cls.state_fields().items()]
+    stored = {"_" + name for name, _ in fields}
+    for klass in reversed(cls.__mro__):
+        for slot in getattr(klass, "__slots__", ()):
+            if slot not in _RUNTIME_SLOTS and slot not in stored and not slot.startswith("__"):
+                fields.append((slot, "j"))  # Plain slots, like Television.input_source, are stored as JSON
+                stored.add(slot)
+    return fields
+
+
+# Writes the state of the SmartDevices in devices to path, returns the number of devices written
+def write_snapshot(devices, path):
+    by_class = {}
+    for device in devices:
+        if isinstance(device, SmartDevice):  # Only SmartDevices know which of their attributes are state
+            by_class.setdefault(type(device), []).append(device)
+    statuses = {}  # Dictionary with status name as key and code as value
+    sections = []
+    for cls, group in by_class.items():
+        fields = snapshot_fields(cls)
+        columns = {name: [] for name, _ in fields}
+        names = [name for name, _ in fields]
+        for device in group:
+            # Optimistic read, each device is captured in a consistent state without stalling its commands
+            for name, value in zip(names, device.read_fields(*names)):
+                columns[name].append(value)
+        data = []
+        for name, kind in fields:
+            values = columns[name]
+            if kind == "s":
+                payload = array("h", (statuses.setdefault(value, len(statuses)) for value in values)).tobytes()
+            elif kind == "?":
+                payload = bytes(bytearray(bool(value) for value in values))
+            elif kind == "d":
+                payload = array("d", (float(value) for value in values)).tobytes()
+            elif kind == "j":
+                payload = "\0".join(json.dumps(value) for value in values).encode("utf-8")
+            else:
+                payload = array(kind, (int(value) for value in values)).tobytes()
+            data.append((name, kind, payload))
+        ids = "\0".join(device.device_id for device in group).encode("utf-8")
+        sections.append((f"{cls.__module__}:{cls.__qualname__}", group[0].device_type, len(group), ids, data))
+
+    with open(path, "wb") as file:
+        file.write(_HEADER.pack(MAGIC, VERSION, 0, len(sections)))
+        file.write(_U16.pack(len(statuses)))
+        for status in statuses:  # Dictionaries keep insertion order, which matches the codes
+            _write_text(file, status)
+        for class_path, device_type, count, ids, data in sections:
+            _write_text(file, class_path)
+            _write_text(file, device_type)
+            file.write(_U32.pack(count))
+            _write_blob(file, ids)
+            file.write(_U16.pack(len(data)))
+            for name, kind, payload in data:
+                _write_text(file, name)
+                file.write(kind.encode("ascii"))
+                _write_blob(file, payload)
+    return sum(len(group) for group in by_class.values())
+
+
+# Writes a u16 length prefixed UTF-8 string
+def _write_text(file, text):
+    encoded = text.encode("utf-8")
+    file.write(_U16.pack(len(encoded)))
+    file.write(encoded)
+
+
+# Writes a u64 length prefixed blob, padded so the next blob starts on an 8 byte boundary
+def _write_blob(file, payload):
+    file.write(_U64.pack(len(payload)))
+    file.write(payload)
+    file.write(b"\0" * (-file.tell() % 8))
+
+
+'''
+Purpose: Hold the devices of one class read from a snapshot, materializing each one only when it is needed
+Contract:
+    - ids lists the device ids of the section in row order
+    - materialize() builds the device object for a row from the memory-mapped columns
+    - columns() reads fields of some rows as plain values, without building the devices
+'''
+
+
+class _SnapshotSection:
+    # Initializes an instance of _SnapshotSection
+    def __init__(self, cls, device_type, ids, fields, statuses):
+        self.cls = cls  # Device class of the section
+        self.device_type = device_type  # device_type of the devices in the section
+        self.ids = ids  # Device ids in row order
+        self.fields = fields  # List of (name, field type, memoryview or list of JSON texts)
+        self.statuses = statuses  # Status names by code
+
+    # Builds the device object for a row
+    def materialize(self, row):
+        state = {}
+        for name, kind, column in self.fields:
+            if kind == "s":
+                state[name] = self.statuses[column[row]]
+            elif kind == "j":
+                state[name] = json.loads(column[row])
+            else:
+                state[name] = column[row]
+        return self.cls.restore(self.ids[row], self.device_type, state)
+
+    # Returns a dictionary with field name as key and the values of rows as value, for the given fields it has
+    def columns(self, names, rows):
+        values = {}
+        for name, kind, column in self.fields:
+            if name not in names:
+                continue
+            if kind == "s":
+                values[name] = [self.statuses[column[row]] for row in rows]
+            elif kind == "j":
+                values[name] = [json.loads(column[row]) for row in rows]
+            else:
+                values[name] = [column[row] for row in rows]
+        return values
+
+
+'''
+Purpose: Read a snapshot file through a memory map without building any device objects up front
+Contract:
+    - sections lists the _SnapshotSection of every device class in the file
+    - locations() returns a dictionary with device_id as key and (section, row) as value
+    - the memory map stays open for as long as the reader, or a section of it, is referenced
+'''
+
+
+class SnapshotReader:
+    # Initializes an instance of SnapshotReader and parses the section headers of the file at path
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)  # Pages are only read when touched
+        self.view = memoryview(self.map)
+        self.offset = 0
+        magic, version, _, section_count = self._unpack(_HEADER)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a smart home hub snapshot")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}, expected {VERSION}")
+        statuses = [sys.intern(self._text()) for _ in range(self._unpack(_U16)[0])]
+        self.sections = []
+        for _ in range(section_count):
+            cls = _resolve_class(self._text())
+            device_type = self._text()
+            count = self._unpack(_U32)[0]
+            ids = bytes(self._blob()).decode("utf-8").split("\0")[:count]
+            fields = []
+            for _ in range(self._unpack(_U16)[0]):
+                name = self._text()
+                kind = chr(self.view[self.offset])
+                self.offset += 1
+                blob = self._blob()
+                if kind == "j":
+                    column = bytes(blob).decode("utf-8").split("\0")
+                else:
+                    column = blob.cast("h" if kind == "s" else kind)  # Reads the mapped bytes in place
+                fields.append((name, kind, column))
+            self.sections.append(_SnapshotSection(cls, device_type, ids, fields, statuses))
+
+    # Returns a dictionary with device_id as key and (section, row) as value
+    def locations(self):
+        found = {}
+        for section in self.sections:
+            found.update(zip(section.ids, ((section, row) for row in range(len(section.ids)))))
+        return found
+
+    # Unpacks a struct at the current offset
+    def _unpack(self, layout):
+        values = layout.unpack_from(self.map, self.offset)
+        self.offset += layout.size
+        return values
+
+    # Reads a u16 length prefixed UTF-8 string
+    def _text(self):
+        length = self._unpack(_U16)[0]
+        text = bytes(self.view[self.offset:self.offset + length]).decode("utf-8")
+        self.offset += length
+        return text
+
+    # Returns a memoryview of a u64 length prefixed blob and skips its padding
+    def _blob(self):
+        length = self._unpack(_U64)[0]
+        blob = self.view[self.offset:self.offset + length]
+        self.offset += length + (-(self.offset + length) % 8)
+        return blob
+
+
+# Returns the class named by a "module:qualname" path
+def _resolve_class(class_path):
+    module, _, qualname = class_path.partition(":")
+    value = importlib.import_module(module)
+    for part in qualname.split("."):
+        value = getattr(value, part)
+    return value
+
+
+'''
+Purpose: Dictionary of devices that also holds devices restored from a snapshot but not built yet
+Contract:
+    - looking a device up, by get(), [] or in, builds it from the snapshot on first access and calls on_materialize
+    - iterating, len() and pop() see the pending devices too, iterating builds every pending device first
+'''
+
+
+class LazyDeviceMap(dict):
+    # Initializes an instance of LazyDeviceMap with the devices already built and the pending locations
+    def __init__(self, devices, pending, on_materialize):
+        super().__init__(devices)
+        self.pending = pending  # Dictionary with device_id as key and (section, row) as value
+        self.on_materialize = on_materialize  # Called with each device once it is built
+        self.lock = threading.Lock()  # Lock so each pending device is only built once
+
+    # Builds a pending device, returns None if device_id isn't pending
+    def _materialize(self, device_id):
+        with self.lock:  # Lock before building the device
+            device = dict.get(self, device_id)
+            if device is not None:
+                return device  # Another thread built it first
+            location = self.pending.get(device_id)
+            if location is None:
+                return None
+            section, row = location
+            device = section.materialize(row)
+            self.on_materialize(device)
+            dict.__setitem__(self, device_id, device)
+            del self.pending[device_id]
+            return device
+
+    # Builds every pending device
+    def materialize_all(self):
+        for device_id in list(self.pending):
+            self._materialize(device_id)
+
+    # Called by [] for ids that aren't built yet
+    def __missing__(self, device_id):
+        device = self._materialize(device_id)
+        if device is None:
+            raise KeyError(device_id)
+        return device
+
+    # Returns the device, building it if it is pending
+    def get(self, device_id, default=None):
+        device = dict.get(self, device_id)
+        if device is None and self.pending:
+            device = self._materialize(device_id)
+        return default if device is None else device
+
+    # Checks for built and pending devices
+    def __contains__(self, device_id):
+        return dict.__contains__(self, device_id) or device_id in self.pending
+
+    # Counts built and pending devices
+    def __len__(self):
+        return dict.__len__(self) + len(self.pending)
+
+    # Removes and returns a device, building it first if it is pending
+    def pop(self, device_id, *default):
+        if device_id in self.pending:
+            self._materialize(device_id)
+        return dict.pop(self, device_id, *default)
+
+    # Iterates the device ids after building every pending device
+    def __iter__(self):
+        self.materialize_all()
+        return dict.__iter__(self)
+
+    # Returns the device ids after building every pending device
+    def keys(self):
+        self.materialize_all()
+        return dict.keys(self)
+
+    # Returns the devices after building every pending device
+    def values(self):
+        self.materialize_all()
+        return dict.values(self)
+
+    # Returns the (device_id, device) pairs after building every pending device
+    def items(self):
+        self.materialize_all()
+        return dict.items(self)
@@ -0,0 +1,436 @@
+import math
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is only needed by the telemetry store, the rest of the system works without it
+    np = None
+
+# Fields recorded by default: thermostat and refrigerator temperatures, TV volume and air purifier fan speed
+TELEMETRY_FIELDS = ("temperature", "refrigerator_temp", "freezer_temp", "volume", "fan_speed")
+
+'''
+Purpose: Keep the last samples of every series of one field in fixed-size rings
+Contract:
+    - row r of times and values is the ring of series r, written counts the samples ever added to it
+    - add() writes a batch of samples, in arrival order per series, keeping the last capacity of each series
+    - slots that were never written hold NaN times, so time range masks skip them
+'''
+
+
+class _RawRing:
+    # Initializes an instance of _RawRing for rows series
+    def __init__(self, capacity, rows):
+        self.capacity = capacity  # Samples kept per series
+        self.times = np.full((rows, capacity), np.nan)  # Timestamp of each sample
+        self.values = np.zeros((rows, capacity))  # Value of each sample
+        self.written = np.zeros(rows, dtype=np.int64)  # Samples ever added to each series
+
+    # Makes room for rows series
+    def grow(self, rows):
+        self.times = _widen(self.times, rows, np.nan, axis=0)
+        self.values = _widen(self.values, rows, 0.0, axis=0)
+        self.written = _widen(self.written, rows, 0, axis=0)
+
+    # Writes samples, rows, times and values are arrays of the same length
+    def add(self, rows, times, values):
+        order = np.argsort(rows, kind="stable")  # Groups the samples by series, keeping their arrival order
+        rows, times, values = rows[order], times[order], values[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])  # First sample of each series
+        counts = np.diff(np.r_[starts, len(rows)])  # Samples of each series
+        rank = np.arange(len(rows)) - np.repeat(starts, counts)  # Position of each sample within its series
+        keep = rank >= np.repeat(counts, counts) - self.capacity  # Only the last capacity samples survive anyway
+        slots = (self.written[rows] + rank) % self.capacity
+        self.times[rows[keep], slots[keep]] = times[keep]
+        self.values[rows[keep], slots[keep]] = values[keep]
+        self.written[rows[starts]] += counts
+
+    # Drops every sample of one series
+    def clear(self, row):
+        self.times[row] = np.nan
+        self.written[row] = 0
+
+    # Returns the times and values of one series in [start, end), ordered by time
+    def samples(self, row, start, end):
+        times, values = self.times[row], self.values[row]
+        mask = _in_range(times, start, end)
+        times, values = times[mask], values[mask]
+        order = np.argsort(times, kind="stable")
+        return times[order], values[order]
+
+    # Returns the count, min, max and sum of every series over the samples in [start, end)
+    def aggregate(self, start, end):
+        mask = _in_range(self.times, start, end)
+        return (np.count_nonzero(mask, axis=1), np.where(mask, self.values, np.inf).min(axis=1),
+                np.where(mask, self.values, -np.inf).max(axis=1), np.where(mask, self.values, 0.0).sum(axis=1))
+
+
+'''
+Purpose: Keep one resolution of the history of every series of one field as rings of min/max/sum/count buckets
+Contract:
+    - bucket b covers [b * width, (b + 1) * width) seconds, the ring holds the newest capacity buckets
+    - the series share the ring's time axis, so row i of the arrays is one bucket and column r one series,
+      emptying a bucket or reducing a time range touches contiguous memory
+    - add() folds a batch of samples into their buckets, moving the ring forward to the newest one,
+      samples older than the ring are dropped
+    - a bucket no sample of a series fell in has count 0
+'''
+
+
+class _Rollup:
+    # Initializes an instance of _Rollup for rows series
+    def __init__(self, width, capacity, rows):
+        self.width = width  # Seconds covered by one bucket
+        self.capacity = capacity  # Buckets kept
+        self.head = None  # Newest bucket, None until the first sample
+        self.stamps = np.full(capacity, -1, dtype=np.int64)  # Bucket held by each slot
+        self.min = np.full((capacity, rows), np.inf, dtype=np.float32)
+        self.max = np.full((capacity, rows), -np.inf, dtype=np.float32)
+        self.sum = np.zeros((capacity, rows), dtype=np.float32)
+        self.count = np.zeros((capacity, rows), dtype=np.uint32)
+
+    # Makes room for rows series
+    def grow(self, rows):
+        self.min = _widen(self.min, rows, np.inf, axis=1)
+        self.max = _widen(self.max, rows, -np.inf, axis=1)
+        self.sum = _widen(self.sum, rows, 0, axis=1)
+        self.count = _widen(self.count, rows, 0, axis=1)
+
+    # Folds samples into their buckets, rows, times and values are arrays of the same length
+    def add(self, rows, times, values):
+        buckets = (times // self.width).astype(np.int64)
+        newest = int(buckets.max())
+        if self.head is None or newest > self.head:
+            self._advance(newest)
+        slots = buckets % self.capacity
+        keep = self.stamps[slots] == buckets  # False for samples older than the ring
+        if not keep.all():
+            rows, slots, values = rows[keep], slots[keep], values[keep]
+            if not len(rows):
+                return
+        # Reduces the samples of each cell first, sorting and reduceat beat ufunc.at by a wide margin
+        cells = slots * self.count.shape[1] + rows  # Index into the flattened arrays
+        order = np.argsort(cells, kind="stable")
+        cells, values = cells[order], values[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])  # First sample of each cell
+        cells = cells[starts]
+        low, high, total, count = (array.reshape(-1) for array in (self.min, self.max, self.sum, self.count))
+        low[cells] = np.minimum(low[cells], np.minimum.reduceat(values, starts))
+        high[cells] = np.maximum(high[cells], np.maximum.reduceat(values, starts))
+        total[cells] += np.add.reduceat(values, starts)
+        count[cells] += np.diff(np.r_[starts, len(values)]).astype(np.uint32)
+
+    # Moves the ring forward to bucket newest, emptying the slots of the buckets it passes
+    def _advance(self, newest):
+        first = newest - self.capacity + 1  # Oldest bucket the ring holds from now on
+        if self.head is not None:
+            first = max(first, self.head + 1)
+        buckets = np.arange(first, newest + 1)
+        slots = buckets % self.capacity
+        self.stamps[slots] = buckets
+        self.min[slots] = np.inf
+        self.max[slots] = -np.inf
+        self.sum[slots] = 0
+        self.count[slots] = 0
+        self.head = newest
+
+    # Empties every bucket of one series
+    def clear(self, row):
+        self.min[:, row] = np.inf
+        self.max[:, row] = -np.inf
+        self.sum[:, row] = 0
+        self.count[:, row] = 0
+
+    # Returns the time from which the ring holds every bucket, None before the first sample
+    def oldest(self):
+        return None if self.head is None else (self.head - self.capacity + 1) * self.width
+
+    # Returns the buckets overlapping [start, end) that the ring still holds, oldest first
+    def buckets(self, start, end):
+        if self.head is None:
+            return np.arange(0)
+        first = max(math.floor(start / self.width), self.head - self.capacity + 1)
+        last = min(math.ceil(end / self.width) - 1, self.head)
+        return np.arange(first, last + 1)
+
+    # Returns the count, min, max and sum of every series over the given consecutive buckets
+    def aggregate(self, buckets):
+        columns = self.count.shape[1]
+        count = np.zeros(columns, dtype=np.uint64)
+        low, high, total = np.full(columns, np.inf), np.full(columns, -np.inf), np.zeros(columns)
+        for part in _slices(buckets % self.capacity):  # Slices of the ring, so nothing is copied
+            count += self.count[part].sum(axis=0, dtype=np.uint64)
+            np.minimum(low, self.min[part].min(axis=0, initial=np.inf), out=low)
+            np.maximum(high, self.max[part].max(axis=0, initial=-np.inf), out=high)
+            total += self.sum[part].sum(axis=0, dtype=np.float64)
+        return count, low, high, total
+
+
+'''
+Purpose: Hold the series of one recorded field, one per device, in a raw ring and one rollup per resolution
+Contract:
+    - row() returns the row of a device's series, creating it, or reusing a released one, on first use
+    - release() empties the series of a device so its row can be reused
+    - select() returns the device ids and rows of the given devices that have a series, all of them for None
+'''
+
+
+class _FieldHistory:
+    # Initializes an instance of _FieldHistory
+    def __init__(self, raw_capacity, resolutions, capacity):
+        self.rows = {}  # Dictionary with device_id as key and row as value
+        self.device_ids = []  # Device id of each row, None for released rows
+        self.free = []  # Released rows, reused before new ones
+        self.capacity = capacity  # Rows the rings have room for
+        self.raw = _RawRing(raw_capacity, capacity)
+        # Dictionary with resolution name as key and its _Rollup as value, finest first
+        self.rollups = {name: _Rollup(width, buckets, capacity) for name, (width, buckets) in resolutions.items()}
+
+    # Returns the row of the series of device_id, creating the series if needed
+    def row(self, device_id):
+        row = self.rows.get(device_id)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+                self.device_ids[row] = device_id
+            else:
+                row = len(self.device_ids)
+                if row == self.capacity:
+                    self.capacity *= 2  # Doubles, so growing is amortized over many series
+                    self.raw.grow(self.capacity)
+                    for rollup in self.rollups.values():
+                        rollup.grow(self.capacity)
+                self.device_ids.append(device_id)
+            self.rows[device_id] = row
+        return row
+
+    # Adds samples to the raw ring and every rollup
+    def add(self, rows, times, values):
+        self.raw.add(rows, times, values)
+        for rollup in self.rollups.values():
+            rollup.add(rows, times, values)
+
+    # Empties the series of device_id and frees its row
+    def release(self, device_id):
+        row = self.rows.pop(device_id, None)
+        if row is not None:
+            self.raw.clear(row)
+            for rollup in self.rollups.values():
+                rollup.clear(row)
+            self.device_ids[row] = None
+            self.free.append(row)
+
+    # Returns the ids and the array of rows of the given devices that have a series
+    def select(self, device_ids):
+        if device_ids is None:
+            device_ids = [device_id for device_id in self.device_ids if device_id is not None]
+        else:
+            device_ids = [device_id for device_id in device_ids if device_id in self.rows]
+        return device_ids, np.array([self.rows[device_id] for device_id in device_ids], dtype=np.intp)
+
+    # Returns the name of the finest rollup that still holds every bucket from start on
+    def resolution(self, start):
+        for name, rollup in self.rollups.items():
+            oldest = rollup.oldest()
+            if oldest is None or oldest <= start:
+                return name
+        return name  # Nothing reaches back to start, the coarsest rollup holds the most of the range
+
+    # Returns the bytes taken by the series of the field
+    def nbytes(self):
+        arrays = [self.raw.times, self.raw.values, self.raw.written]
+        for rollup in self.rollups.values():
+            arrays += [rollup.stamps, rollup.min, rollup.max, rollup.sum, rollup.count]
+        return sum(array.nbytes for array in arrays)
+
+
+'''
+Purpose: Record the history of numeric device fields, like temperatures, volume and fan speed, in bounded rings
+Contract:
+    - every device and recorded field pair is a series, record() adds one sample to it, record_many() adds
+      samples of many devices at once
+    - a series keeps its last raw_capacity samples and min/max/mean rollups of its last minute_capacity minutes
+      and hour_capacity hours, so the memory of a series is fixed when it's created
+    - record() buffers samples, they are folded into the rings in vectorized batches of batch samples,
+      and before every query
+    - samples() returns the raw samples of one series, history() the rollup buckets of many series as a
+      device by bucket matrix, aggregate() the count/min/max/mean of many series over a time range
+    - rollup queries cover every bucket that overlaps the range, resolution None picks the finest resolution
+      that still holds the start of the range, aggregate() also takes "raw"
+    - queries leave out devices without a series, buckets and ranges without samples have NaN min/max/mean
+    - track() records the current values of a device, forget() drops its series and reuses their memory
+'''
+
+
+class TelemetryStore:
+    # Initializes an instance of TelemetryStore
+    # fields are the recorded field names, capacity the initial number of series per field
+    def __init__(self, fields=TELEMETRY_FIELDS, raw_capacity=128, minute_capacity=360, hour_capacity=168,
+                 capacity=1024, batch=1024, clock=time.time):
+        if np is None:
+            raise ImportError("TelemetryStore requires NumPy")  # The rings are NumPy arrays
+        self.fields = frozenset(fields)  # Fields recorded
+        self.raw_capacity = raw_capacity  # Raw samples kept per series
+        # Dictionary with resolution name as key and (bucket seconds, buckets kept) as value, finest first
+        self.resolutions = {"minute": (60, minute_capacity), "hour": (3600, hour_capacity)}
+        self.capacity = capacity  # Initial series per field
+        self.batch = batch  # Buffered samples that trigger a flush
+        self.clock = clock  # Returns the current time, stamps the values recorded by track()
+        self.histories = {}  # Dictionary with field name as key and its _FieldHistory as value
+        self.pending = []  # Buffered (field, device_id, timestamp, value) samples
+        self.lock = threading.Lock()  # Lock to keep the buffer and the rings consistent
+
+    # Buffers one sample of a device field
+    def record(self, device_id, field, timestamp, value):
+        if field not in self.fields:
+            raise ValueError(f"Field '{field}' isn't recorded")  # Rejected before it could spoil a batch
+        with self.lock:  # Lock before buffering
+            self.pending.append((field, device_id, timestamp, value))
+            if len(self.pending) >= self.batch:
+                self._flush()
+
+    # Adds one sample for each of device_ids, times and values are sequences of the same length or scalars
+    def record_many(self, field, device_ids, times, values):
+        with self.lock:  # Lock before writing the rings
+            self._flush()  # Keeps the samples of a series in arrival order
+            history = self._history(field)
+            try:
+                rows = np.array([history.rows[device_id] for device_id in device_ids], dtype=np.intp)
+            except KeyError:  # Some devices have no series yet
+                rows = np.array([history.row(device_id) for device_id in device_ids], dtype=np.intp)
+            history.add(rows, np.broadcast_to(np.asarray(times, dtype=np.float64), rows.shape),
+                        np.broadcast_to(np.asarray(values, dtype=np.float64), rows.shape))
+
+    # Records the current value of every recorded field of device
+    def track(self, device):
+        now = self.clock()
+        for field in self.fields:
+            value = getattr(device, field, None)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.record(device.device_id, field, now, value)
+
+    # Drops the series of a device
+    def forget(self, device_id):
+        with self.lock:  # Lock before releasing the rows
+            self._flush()  # Buffered samples of the device mustn't land in a reused row
+            for history in self.histories.values():
+                history.release(device_id)
+
+    # Folds the buffered samples into the rings
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    # Folds the buffered samples into the rings, the caller holds the lock
+    def _flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        batches = {}  # Dictionary with _FieldHistory as key and the (rows, times, values) of its samples as value
+        for field, device_id, timestamp, value in pending:
+            history = self._history(field)
+            rows, times, values = batches.setdefault(history, ([], [], []))
+            rows.append(history.row(device_id))
+            times.append(timestamp)
+            values.append(value)
+        for history, (rows, times, values) in batches.items():
+            history.add(np.array(rows, dtype=np.intp), np.array(times, dtype=np.float64),
+                        np.array(values, dtype=np.float64))
+
+    # Returns the _FieldHistory of field, creating it on first use
+    def _history(self, field):
+        history = self.histories.get(field)
+        if history is None:
+            if field not in self.fields:
+                raise ValueError(f"Field '{field}' isn't recorded")  # Message if the field isn't recorded
+            history = self.histories[field] = _FieldHistory(self.raw_capacity, self.resolutions, self.capacity)
+        return history
+
+    # Returns the times and values of the raw samples of one series in [start, end), None leaves a side open
+    def samples(self, device_id, field, start=None, end=None):
+        with self.lock:
+            self._flush()
+            history = self._history(field)
+            row = history.rows.get(device_id)
+            if row is None:
+                return np.zeros(0), np.zeros(0)  # The device has no series
+            return history.raw.samples(row, start, end)
+
+    # Returns the rollup buckets of field overlapping [start, end) for device_ids (every device for None)
+    # The dictionary holds the device ids, the bucket start times and (devices, buckets) count/min/max/mean
+    def history(self, field, start, end, device_ids=None, resolution=None):
+        with self.lock:
+            self._flush()
+            history = self._history(field)
+            rollup = history.rollups[resolution or history.resolution(start)]
+            device_ids, rows = history.select(device_ids)
+            buckets = rollup.buckets(start, end)
+            cells = np.ix_(rows, buckets % rollup.capacity)  # Device by bucket
+            count, low, high, total = (array.T[cells] for array in (rollup.count, rollup.min, rollup.max, rollup.sum))
+        result = _summary(count, low, high, total)
+        result.update(device_ids=device_ids, time=buckets * float(rollup.width))
+        return result
+
+    # Returns the count/min/max/mean of field over [start, end) for device_ids (every device for None)
+    def aggregate(self, field, start, end, device_ids=None, resolution=None):
+        with self.lock:
+            self._flush()
+            history = self._history(field)
+            device_ids, rows = history.select(device_ids)
+            if resolution == "raw":
+                count, low, high, total = history.raw.aggregate(start, end)
+            else:
+                rollup = history.rollups[resolution or history.resolution(start)]
+                count, low, high, total = rollup.aggregate(rollup.buckets(start, end))
+        result = _summary(count[rows], low[rows], high[rows], total[rows])
+        result["device_ids"] = device_ids
+        return result
+
+    # Returns the number of series of every field
+    def series_count(self):
+        with self.lock:
+            return sum(len(history.rows) for history in self.histories.values())
+
+    # Returns the bytes taken by the rings of every field
+    def nbytes(self):
+        with self.lock:
+            return sum(history.nbytes() for history in self.histories.values())
+
+
+# Returns a copy of array with room for rows entries along axis, the new entries hold fill
+def _widen(array, rows, fill, axis):
+    shape = list(array.shape)
+    shape[axis] = rows
+    wider = np.full(shape, fill, dtype=array.dtype)
+    wider[tuple(slice(0, size) for size in array.shape)] = array
+    return wider
+
+
+# Returns the mask of times in [start, end), None leaves a side open, NaN times are never in range
+def _in_range(times, start, end):
+    mask = ~np.isnan(times)
+    if start is not None:
+        mask &= times >= start
+    if end is not None:
+        mask &= times < end
+    return mask
+
+
+# Returns the slices of the ring covering slots, which are consecutive modulo the ring size
+def _slices(slots):
+    if len(slots) == 0:
+        return []
+    first, last = int(slots[0]), int(slots[-1])
+    if first <= last:
+        return [slice(first, last + 1)]
+    return [slice(first, None), slice(0, last + 1)]  # The range wraps around the end of the ring
+
+
+# Builds the count/min/max/mean dictionary of a query, empty cells get NaN min/max/mean
+def _summary(count, low, high, total):
+    empty = count == 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+    return {"count": count, "min": np.where(empty, np.nan, low), "max": np.where(empty, np.nan, high),
+            "mean": np.where(empty, np.nan, mean)}